@@ -1,22 +1,40 @@
-from flask import Flask, request, jsonify, send_file, redirect, Response
+from flask import Flask, request, jsonify, send_file, redirect, Response, g, has_request_context
 from flask_cors import CORS
 import yt_dlp
 import os
 import uuid
 import threading
 import shutil
+import stat
+import errno
+import socket
 import requests
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
 from dotenv import load_dotenv
 import time
 import json
+import re
 from werkzeug.utils import secure_filename
 import urllib.parse
 import hashlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import contextmanager
 from PIL import Image
 from io import BytesIO
+from metrics import registry as metrics
+import profiling
+from replica import LocalReplica
+from cache import create_cache
+from fsindex import DirectoryIndex
+from janitor import Janitor
+from jobs import Job, JobCancelled, JobRegistry
+from governor import HostLimits, Throttled, UpstreamGovernor
+import breaker
+from breaker import CircuitBreaker
 
 # Load environment variables
 load_dotenv()
@@ -61,22 +79,142 @@ def set_pwa_headers(response):
     
     return response
 
+# Request timing (opt-in): per-request breakdown of DB, outbound HTTP and
+# filesystem time; requests slower than slow_ms are logged with it.
+# Toggle at runtime with POST /api/admin/profiling.
+REQUEST_TIMING = {
+    'enabled': os.environ.get('REQUEST_TIMING', '0') == '1',
+    'slow_ms': float(os.environ.get('SLOW_REQUEST_MS', '1000')),
+}
+
+@app.before_request
+def start_request_timing():
+    """Start timing the request; owners can add ?profile=1 for a cProfile report"""
+    g.profiler = None
+    if request.args.get('profile') == '1' and is_owner(get_client_id()):
+        g.profiler = profiling.start_profiler()
+    if REQUEST_TIMING['enabled'] or g.profiler:
+        profiling.start_request()
+
+@app.after_request
+def finish_request_timing(response):
+    """Log slow requests with their breakdown and attach Server-Timing"""
+    timings = profiling.finish_request()
+    profiler = g.get('profiler')
+    if timings is None:
+        return response
+    
+    total_ms, parts = timings.breakdown()
+    response.headers['Server-Timing'] = ', '.join(
+        f"{category};dur={part['ms']}" for category, part in parts.items()
+    ) + f", total;dur={total_ms}"
+    
+    if total_ms >= REQUEST_TIMING['slow_ms']:
+        summary = ' '.join(f"{category}={part['ms']}ms/{part['calls']}" for category, part in parts.items())
+        logger.warning(f"🐢 Slow request {request.method} {request.path} took {total_ms}ms: {summary}")
+    
+    if profiler:
+        report = profiling.profiler_report(profiler)
+        header = f"{request.method} {request.full_path} -> {response.status_code} in {total_ms}ms\n"
+        header += json.dumps(parts, indent=2) + "\n\n"
+        return Response(header + report, mimetype='text/plain')
+    
+    return response
+
 # Supabase Configuration
 SUPABASE_URL = os.environ.get('SUPABASE_URL')
 SUPABASE_KEY = os.environ.get('SUPABASE_ANON_KEY')
 BUCKET_NAME = "yt-downloads"
 
+# How /api/folder_collage serves a collage stored in Supabase when no local copy
+# exists: 'redirect' (default) sends the client to the public URL, 'stream'
+# proxies it through without buffering.
+COLLAGE_SERVE_MODE = os.environ.get('COLLAGE_SERVE_MODE', 'redirect').strip().lower()
+
+# --- Metrics (exposed at /metrics, summarised in /api/health) ---
+CONVERSION_STAGE_SECONDS = metrics.histogram(
+    'ytmp3_conversion_stage_seconds', 'Time spent in each conversion stage', ['stage'])
+DB_REQUEST_SECONDS = metrics.histogram(
+    'ytmp3_db_request_seconds', 'PostgREST request latency', ['method'])
+CACHE_REQUESTS = metrics.counter(
+    'ytmp3_cache_requests_total', 'Cache lookups by cache and result', ['cache', 'result'])
+UPSTREAM_REQUESTS = metrics.counter(
+    'ytmp3_upstream_requests_total', 'Calls made to upstream services', ['upstream'])
+UPSTREAM_ERRORS = metrics.counter(
+    'ytmp3_upstream_errors_total', 'Failed calls to upstream services', ['upstream'])
+CONVERSIONS = metrics.counter(
+    'ytmp3_conversions_total', 'Finished conversions by result', ['result'])
+QUEUE_DEPTH = metrics.gauge(
+    'ytmp3_conversion_queue_depth', 'Conversions accepted but not started yet')
+ACTIVE_WORKERS = metrics.gauge(
+    'ytmp3_active_conversion_workers', 'Conversions currently being processed')
+DISK_FREE_BYTES = metrics.gauge(
+    'ytmp3_disk_free_bytes', 'Free space available to downloads/')
+JANITOR_DELETED = metrics.counter(
+    'ytmp3_janitor_deleted_files_total', 'Files removed by the disk janitor', ['kind'])
+JOBS_REJECTED = metrics.counter(
+    'ytmp3_jobs_rejected_total', 'Conversions refused at admission', ['reason'])
+DOWNLOAD_BYTES = metrics.counter(
+    'ytmp3_download_bytes_total', 'Media bytes downloaded for conversions', ['kind'])
+JOBS_CLAIMED = metrics.counter(
+    'ytmp3_jobs_claimed_total', 'Conversions claimed from the queue', ['source'])
+LEASES_LOST = metrics.counter(
+    'ytmp3_job_leases_lost_total', 'Running jobs whose lease another worker took over')
+JOBS_RESUMED = metrics.counter(
+    'ytmp3_jobs_resumed_total', 'Interrupted conversions resumed from a checkpoint', ['stage'])
+JOBS_REAPED = metrics.counter(
+    'ytmp3_jobs_reaped_total', 'Stuck conversions given up on after too many attempts')
+UPSTREAM_THROTTLED = metrics.counter(
+    'ytmp3_upstream_throttled_total', 'Throttling errors from upstream hosts', ['host'])
+UPSTREAM_WAIT_SECONDS = metrics.histogram(
+    'ytmp3_upstream_wait_seconds', 'Time spent waiting for an upstream slot', ['host'])
+UPSTREAM_BACKOFF_SECONDS = metrics.gauge(
+    'ytmp3_upstream_backoff_seconds', 'Remaining backoff per upstream host', ['host'])
+UPSTREAM_IN_FLIGHT = metrics.gauge(
+    'ytmp3_upstream_in_flight', 'Requests in flight per upstream host', ['host'])
+CIRCUIT_STATE = metrics.gauge(
+    'ytmp3_circuit_state', 'Circuit breaker state (0 closed, 1 half-open, 2 open)', ['circuit'])
+CIRCUIT_REJECTED = metrics.counter(
+    'ytmp3_circuit_rejected_total', 'Calls failed fast by an open circuit', ['circuit'])
+STALE_READS = metrics.counter(
+    'ytmp3_stale_reads_total', 'Reads answered with last known good data')
+TRASH_PURGED = metrics.counter(
+    'ytmp3_trash_purged_total', 'Deleted songs and folders purged from the trash', ['kind'])
+
 # Create directories
-DOWNLOADS_DIR = Path('downloads')
+# Absolute, so send_file() doesn't resolve cached files against the app root
+# when the server is started from another working directory
+DOWNLOADS_DIR = Path('downloads').resolve()
 DOWNLOADS_DIR.mkdir(exist_ok=True)
 
+# Local SQLite replica of conversions/folder_collages. Lives on the downloads
+# disk so every worker shares it; library reads are served from it once the
+# first full sync has finished, including while Supabase is unreachable.
+LOCAL_REPLICA = os.environ.get('LOCAL_REPLICA', '1') == '1'
+REPLICA_PATH = Path(os.environ.get('REPLICA_PATH', str(DOWNLOADS_DIR / '.replica.sqlite3')))
+REPLICA_SYNC_INTERVAL = int(os.environ.get('REPLICA_SYNC_INTERVAL', '30'))
+REPLICA_FULL_SYNC_INTERVAL = int(os.environ.get('REPLICA_FULL_SYNC_INTERVAL', '600'))
+
+# Cache shared by all gunicorn workers for song records, /api/files bodies,
+# folder summaries and the collage URL map: 'file' (SQLite next to the
+# replica, default), 'redis' (CACHE_URL, any Redis-protocol server) or
+# 'memory' (per process).
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'file').strip().lower()
+LIBRARY_CACHE_TTL = int(os.environ.get('LIBRARY_CACHE_TTL', '30'))
+SONG_CACHE_TTL = int(os.environ.get('SONG_CACHE_TTL', '300'))
+shared_cache = create_cache(CACHE_BACKEND, path=DOWNLOADS_DIR / '.cache.sqlite3',
+                            url=os.environ.get('CACHE_URL') or os.environ.get('REDIS_URL'))
+
 # Owner/Admin management
 OWNER_FILE = Path('owner_id.txt')
 CLIENT_ID_HEADER = 'X-Client-Id'
 
 def get_client_id():
     """Get client ID from request"""
-    cid = request.headers.get(CLIENT_ID_HEADER) or request.args.get('client_id')
+    return normalize_client_id(request.headers.get(CLIENT_ID_HEADER) or request.args.get('client_id'))
+
+def normalize_client_id(cid):
+    """Sanitize a raw client ID, generating a random one for anonymous users"""
     if not cid:
         # Generate a random ID for anonymous users
         return f"user_{uuid.uuid4().hex[:8]}"
@@ -84,43 +222,307 @@ def get_client_id():
     return cid or f"user_{uuid.uuid4().hex[:8]}"
 
 
+# Owner ID cached per process, keyed on owner_id.txt's inode/mtime/size, so the
+# hot paths cost one stat() instead of open/read/close. A change made by
+# another worker (or by hand) changes the stat and is picked up on the next call.
+_owner_cache = {'stat': None, 'owner_id': None}
+_owner_lock = threading.Lock()
+
 def get_owner_id():
     """Get the owner/admin ID"""
-    if OWNER_FILE.exists():
-        try:
-            return OWNER_FILE.read_text(encoding='utf-8').strip()
-        except:
-            return None
-    return None
+    try:
+        st = OWNER_FILE.stat()
+    except OSError:
+        return None
+    key = (st.st_ino, st.st_mtime_ns, st.st_size)
+    with _owner_lock:
+        if _owner_cache['stat'] == key:
+            return _owner_cache['owner_id']
+    try:
+        owner_id = OWNER_FILE.read_text(encoding='utf-8').strip()
+    except:
+        return None
+    with _owner_lock:
+        _owner_cache.update(stat=key, owner_id=owner_id)
+    return owner_id
+
+def _write_owner_tmp(client_id):
+    tmp = OWNER_FILE.with_name(f".{OWNER_FILE.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_text(str(client_id), encoding='utf-8')
+    return tmp
 
 def set_owner_id(client_id):
-    """Set the owner/admin ID"""
+    """Set the owner/admin ID (atomic replace, readers never see a partial file)"""
     try:
-        OWNER_FILE.write_text(str(client_id), encoding='utf-8')
+        tmp = _write_owner_tmp(client_id)
+        os.replace(tmp, OWNER_FILE)
         logger.info(f"Owner set to: {client_id}")
         return True
     except Exception as e:
         logger.error(f"Error setting owner: {e}")
         return False
 
+# A blank owner_id.txt (e.g. a crashed legacy claim) or a claim lock older
+# than this is left behind by a dead process and may be taken over
+OWNER_CLAIM_GRACE = 60
+
+def _blank_owner_stat():
+    """(inode, size, mtime_ns) of owner_id.txt if it exists with blank content
+    and is older than OWNER_CLAIM_GRACE, else None"""
+    try:
+        st = OWNER_FILE.stat()
+        if time.time() - st.st_mtime < OWNER_CLAIM_GRACE or OWNER_FILE.read_text(encoding='utf-8').strip():
+            return None
+    except (OSError, UnicodeDecodeError):
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+def _install_owner_locked(tmp, blank=None):
+    """Install tmp as owner_id.txt while holding owner_id.txt.lock (O_EXCL).
+    Only installs if there is no owner file, or it is still the blank file
+    described by `blank`, so a file some other claimer installed is never
+    replaced. Returns True if tmp was installed."""
+    lock = OWNER_FILE.with_name(f"{OWNER_FILE.name}.lock")
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        # A holder only keeps the lock for a few syscalls; an old one died.
+        # Move it aside (only one racer can) and check it was the old file.
+        try:
+            st = lock.stat()
+            if time.time() - st.st_mtime < OWNER_CLAIM_GRACE:
+                return False
+            aside = lock.with_name(f".{lock.name}.{os.getpid()}.{threading.get_ident()}.stale")
+            os.rename(lock, aside)
+            if aside.stat().st_ino != st.st_ino:
+                os.rename(aside, lock)  # a live lock taken after the stale one was cleared
+                return False
+            aside.unlink()
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except OSError:
+            return False
+    try:
+        try:
+            st = OWNER_FILE.stat()
+        except FileNotFoundError:
+            st = None
+        if st is not None and (st.st_ino, st.st_size, st.st_mtime_ns) != blank:
+            return False
+        os.replace(tmp, OWNER_FILE)
+        return True
+    finally:
+        os.close(fd)
+        lock.unlink(missing_ok=True)
+
+def claim_owner(client_id):
+    """Make client_id the owner if nobody is yet and return the owner ID.
+
+    The ID is written to a temp file first and installed with os.link(),
+    which fails if owner_id.txt already exists, so when several requests (in
+    any worker) race for a fresh install one of them wins and nobody ever
+    reads a half-written file. Where hard links aren't supported, and to
+    take over a stale blank owner_id.txt, the install happens under an O_EXCL
+    lock file instead. An owner file this call didn't create is never
+    removed."""
+    owner_id = get_owner_id()
+    if owner_id:
+        return owner_id
+    tmp = None
+    try:
+        tmp = _write_owner_tmp(client_id)
+        blank = _blank_owner_stat() if owner_id == '' else None
+        if blank is not None:
+            installed = _install_owner_locked(tmp, blank)
+        else:
+            try:
+                os.link(tmp, OWNER_FILE)
+                installed = True
+            except FileExistsError:
+                installed = False
+            except OSError:
+                installed = _install_owner_locked(tmp)
+        if installed:
+            logger.info(f"Owner set to: {client_id}")
+    except Exception as e:
+        logger.error(f"Error setting owner: {e}")
+    finally:
+        if tmp is not None:
+            tmp.unlink(missing_ok=True)
+    return get_owner_id()
+
 def is_owner(client_id):
     """Check if client is owner/admin"""
     owner_id = get_owner_id()
     if not owner_id:
         # First user becomes owner
-        set_owner_id(client_id)
-        return True
+        owner_id = claim_owner(client_id)
     return client_id == owner_id
 
+# In-memory index of downloads/ (folders, mp3 names, sizes, mtimes). Each
+# directory listing is revalidated with one stat() at most every
+# FS_INDEX_REVALIDATE seconds; our own writes invalidate it immediately.
+FS_INDEX_REVALIDATE = float(os.environ.get('FS_INDEX_REVALIDATE', '2'))
+downloads_index = DirectoryIndex(DOWNLOADS_DIR, revalidate=FS_INDEX_REVALIDATE)
+
+# Disk janitor: LRU-trims .thumbcache, removes leftovers of dead jobs and
+# reserves space for admitted conversions (downloads/ is a 1 GB disk on Render)
+THUMBCACHE_DIR = DOWNLOADS_DIR / '.thumbcache'
+THUMBCACHE_MAX_MB = int(os.environ.get('THUMBCACHE_MAX_MB', '200'))
+DISK_MIN_FREE_MB = int(os.environ.get('DISK_MIN_FREE_MB', '100'))
+DOWNLOADS_QUOTA_MB = int(os.environ.get('DOWNLOADS_QUOTA_MB', '0'))
+JANITOR_INTERVAL = int(os.environ.get('JANITOR_INTERVAL', '300'))
+# Reservations are shared by every worker process through a file on the
+# disk they reserve; one whose process died is dropped after this long
+DISK_RESERVATION_TTL = int(os.environ.get('DISK_RESERVATION_TTL', '300'))
+# Source length assumed when sizing a job before yt-dlp has seen it
+JOB_ESTIMATE_SECONDS = int(os.environ.get('JOB_ESTIMATE_SECONDS', '1200'))
+janitor = Janitor(
+    DOWNLOADS_DIR,
+    cache_dirs=[THUMBCACHE_DIR],
+    cache_budget=THUMBCACHE_MAX_MB * 1024 * 1024,
+    min_free=DISK_MIN_FREE_MB * 1024 * 1024,
+    quota=DOWNLOADS_QUOTA_MB * 1024 * 1024,
+    reservations=DOWNLOADS_DIR / '.reservations.sqlite3',
+    reservation_ttl=DISK_RESERVATION_TTL,
+)
+# Conversions running in this process, so they can be cancelled
+jobs = JobRegistry()
+
+def list_subdirs(path):
+    """Subdirectories of a downloads path, timed as filesystem work for request profiling.
+    Hidden ones (.trash, caches) are never library folders."""
+    with profiling.timed('fs'):
+        return [d for d in downloads_index.subdirs(path) if not d.name.startswith('.')]
+
+def list_mp3s(path, recursive=False):
+    """FileEntry(path, size, mtime) for the MP3s in a downloads path"""
+    with profiling.timed('fs'):
+        if recursive:
+            return downloads_index.files_recursive(path, '.mp3')
+        return downloads_index.files(path, '.mp3')
+
 def find_ffmpeg_path():
     ffmpeg_path = shutil.which('ffmpeg')
     if ffmpeg_path:
         return str(Path(ffmpeg_path).parent)
     return None
 
+# --- Supabase circuit breakers ---
+# After CIRCUIT_FAILURE_THRESHOLD failed calls in a row (timeouts, connection
+# errors, 5xx) PostgREST or Storage calls fail fast for CIRCUIT_RESET_SECONDS
+# instead of each holding a thread for its full timeout; then one probe call
+# checks whether Supabase is back. Library reads fall back to the last known
+# good copy meanwhile and flag the response as stale.
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_RESET_SECONDS = float(os.environ.get('CIRCUIT_RESET_SECONDS', '30'))
+# How long last known good reads are kept, and how often they are rewritten
+LAST_GOOD_TTL = int(os.environ.get('LAST_GOOD_TTL', '86400'))
+LAST_GOOD_REFRESH_SECONDS = float(os.environ.get('LAST_GOOD_REFRESH_SECONDS', '30'))
+
+def circuit_changed(circuit, state):
+    CIRCUIT_STATE.set(breaker.STATES.index(state), circuit=circuit.name)
+
+db_circuit = CircuitBreaker('supabase_db', CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS,
+                            on_change=circuit_changed)
+storage_circuit = CircuitBreaker('supabase_storage', CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS,
+                                 on_change=circuit_changed)
+
+def circuit_allows(circuit):
+    """circuit.allow(), counting the calls it fails fast"""
+    if circuit.allow():
+        return True
+    CIRCUIT_REJECTED.inc(circuit=circuit.name)
+    return False
+
+def record_status(circuit, status_code):
+    """Only server errors mean Supabase is unwell; a 4xx is a healthy answer"""
+    if status_code >= 500:
+        circuit.record_failure()
+    else:
+        circuit.record_success()
+
+# Last known good copies are kept for the library list queries only. A single
+# song is looked up in those lists instead of being stored on its own, so the
+# number of copies stays bounded (folder queries are capped, oldest first).
+ALL_SONGS_QUERY = 'conversions?status=eq.completed&order=created_at.desc'
+ALL_CONVERSIONS_QUERY = 'conversions?status=neq.deleting&order=created_at.desc'
+LAST_GOOD_MAX_QUERIES = 256
+_last_good_saved = OrderedDict()
+_last_good_lock = threading.Lock()
+
+def remember_good(endpoint, rows):
+    """Keep a successful library list read as the fallback for `endpoint`"""
+    now = time.monotonic()
+    with _last_good_lock:
+        saved = _last_good_saved.get(endpoint)
+        if saved is not None and now - saved < LAST_GOOD_REFRESH_SECONDS:
+            return
+        _last_good_saved[endpoint] = now
+        _last_good_saved.move_to_end(endpoint)
+        while len(_last_good_saved) > LAST_GOOD_MAX_QUERIES:
+            _last_good_saved.popitem(last=False)
+    try:
+        shared_cache.set_json(f'last_good:{endpoint}', rows, ttl=LAST_GOOD_TTL)
+    except Exception as e:
+        logger.error(f"Last good copy error: {e}")
+
+def _served_stale():
+    STALE_READS.inc()
+    if has_request_context():
+        g.stale = True
+
+def last_good(endpoint):
+    """The last successful read of `endpoint`, or None. Marks the current
+    request as served stale."""
+    try:
+        rows = shared_cache.get_json(f'last_good:{endpoint}')
+    except Exception:
+        return None
+    if rows is None:
+        return None
+    _served_stale()
+    return [dict(row) for row in rows]
+
+def last_good_song(file_id):
+    """A song as last seen in the last known good library lists, or None.
+    Marks the current request as served stale."""
+    for endpoint in (ALL_CONVERSIONS_QUERY, ALL_SONGS_QUERY):
+        try:
+            rows = shared_cache.get_json(f'last_good:{endpoint}')
+        except Exception:
+            continue
+        for row in rows or ():
+            if row.get('file_id') == file_id:
+                _served_stale()
+                return dict(row)
+    return None
+
+def served_stale():
+    """True when this request used last known good data"""
+    return has_request_context() and g.get('stale', False)
+
+def db_read(endpoint):
+    """GET rows from PostgREST; while Supabase is failing, the last known
+    good rows for the same endpoint (stale). None when there are neither."""
+    result = db_request('GET', endpoint)
+    if isinstance(result, list):
+        remember_good(endpoint, result)
+        return result
+    return last_good(endpoint)
+
 # --- Database Functions ---
-def db_request(method, endpoint, data=None, params=None):
-    """Generic DB request function"""
+_db_local = threading.local()
+
+def last_db_status():
+    """HTTP status of this thread's last db_request(), or None if it got no
+    answer (not configured, circuit open, timeout, connection error)"""
+    return getattr(_db_local, 'status', None)
+
+def db_request(method, endpoint, data=None, params=None, prefer=None):
+    """Generic DB request function.
+    `prefer` is appended to the PostgREST Prefer header, e.g.
+    'resolution=merge-duplicates' to turn a POST into an upsert."""
+    _db_local.status = None
     try:
         if not SUPABASE_URL or not SUPABASE_KEY:
             return None
@@ -132,18 +534,35 @@ def db_request(method, endpoint, data=None, params=None):
             'Content-Type': 'application/json',
             'Prefer': 'return=representation'
         }
+        if prefer:
+            headers['Prefer'] = f"{prefer},return=representation"
         
-        if method == 'GET':
-            response = requests.get(url, headers=headers, params=params, timeout=10)
-        elif method == 'POST':
-            response = requests.post(url, headers=headers, json=data, timeout=10)
-        elif method == 'PATCH':
-            response = requests.patch(url, headers=headers, json=data, timeout=10)
-        elif method == 'DELETE':
-            response = requests.delete(url, headers=headers, params=params, timeout=10)
-        else:
+        if not circuit_allows(db_circuit):
             return None
+        UPSTREAM_REQUESTS.inc(upstream='supabase_db')
+        started = time.perf_counter()
+        try:
+            if method == 'GET':
+                response = requests.get(url, headers=headers, params=params, timeout=10)
+            elif method == 'POST':
+                response = requests.post(url, headers=headers, json=data, timeout=10)
+            elif method == 'PATCH':
+                response = requests.patch(url, headers=headers, json=data, timeout=10)
+            elif method == 'DELETE':
+                response = requests.delete(url, headers=headers, params=params, timeout=10)
+            else:
+                return None
+        except Exception:
+            db_circuit.record_failure()
+            raise
+        finally:
+            # Timeouts and connection errors count towards DB latency too
+            elapsed = time.perf_counter() - started
+            DB_REQUEST_SECONDS.observe(elapsed, method=method)
+            profiling.record('db', elapsed)
         
+        _db_local.status = response.status_code
+        record_status(db_circuit, response.status_code)
         if response.status_code in [200, 201, 204]:
             if response.status_code == 204:
                 return True
@@ -153,57 +572,286 @@ def db_request(method, endpoint, data=None, params=None):
                 return response.text
         else:
             logger.error(f"DB {method} failed: {response.status_code} - {response.text}")
+            UPSTREAM_ERRORS.inc(upstream='supabase_db')
             return None
             
     except Exception as e:
         logger.error(f"DB request error: {e}")
+        UPSTREAM_ERRORS.inc(upstream='supabase_db')
         return None
 
 def save_to_db(song_data):
     result = db_request('POST', 'conversions', song_data)
     if result:
         logger.info(f"✅ DB: Saved {song_data['file_id']}")
+        if replica:
+            replica.upsert(result[0])
         return result[0]
     return None
 
-def update_in_db(file_id, update_data):
-    result = db_request('PATCH', f'conversions?file_id=eq.{file_id}', update_data)
+def update_in_db(file_id, update_data, conditions=''):
+    """PATCH a conversion row. `conditions` adds PostgREST filters, e.g.
+    '&status=neq.cancelled'; returns False when the row didn't match."""
+    result = db_request('PATCH', f'conversions?file_id=eq.{file_id}{conditions}', update_data)
+    if result:
+        if replica:
+            replica.patch(file_id, update_data)
+        shared_cache.delete(f'song:{file_id}')
+        # Progress ticks don't change the library; finishing or moving a song does
+        if update_data.get('status') in ('completed', 'error', 'cancelled', 'deleting') or 'folder' in update_data:
+            invalidate_library()
     return bool(result)
 
+def update_job(file_id, update_data):
+    """update_in_db() for a running conversion: never overwrites a cancellation or a delete"""
+    return update_in_db(file_id, update_data, conditions='&status=not.in.(cancelled,deleting)')
+
+def stop_if_cancelled(job):
+    """Call when a job's own row refused an update: stops the job (raises
+    JobCancelled) if that's because it was cancelled or deleted"""
+    job.check()
+    rows = db_request('GET', f'conversions?file_id=eq.{job.file_id}&select=status')
+    if rows is None:
+        return
+    if not rows or rows[0].get('status') in ('cancelled', 'deleting'):
+        job.cancel('cancelled' if rows and rows[0].get('status') == 'cancelled' else 'deleted')
+        job.check()
+
 def get_from_db(file_id):
+    """A song's row; songs being deleted read as missing"""
+    if replica_ready():
+        song = replica.get(file_id)
+        # The replica only learns about progress made on other hosts at the
+        # next full sync (or via updated_at); running jobs are read from the DB
+        if song and song.get('status') not in IN_PROGRESS_STATUSES:
+            CACHE_REQUESTS.inc(cache='song', result='hit')
+            return song if song.get('status') != 'deleting' else None
+    song = shared_cache.get_json(f'song:{file_id}')
+    if song:
+        CACHE_REQUESTS.inc(cache='song', result='hit')
+        return dict(song)
+    CACHE_REQUESTS.inc(cache='song', result='miss')
     result = db_request('GET', f'conversions?file_id=eq.{file_id}')
-    return result[0] if result else None
+    if not isinstance(result, list):
+        # Supabase is failing: answer with the song as last seen
+        song = last_good_song(file_id)
+        return song if song and song.get('status') != 'deleting' else None
+    if result:
+        if replica:
+            replica.upsert(result[0])
+        # Only finished records are stable enough to share between workers
+        if result[0].get('status') == 'completed':
+            shared_cache.set_json(f'song:{file_id}', result[0], ttl=SONG_CACHE_TTL)
+    return result[0] if result and result[0].get('status') != 'deleting' else None
+
+def get_songs_by_ids(file_ids):
+    """{file_id: song} for many songs at once: the replica and the shared
+    song cache first, then one file_id=in.(...) query per 100 of the rest"""
+    songs = {}
+    if replica_ready():
+        songs.update((song['file_id'], song) for song in replica.get_many(file_ids))
+    for file_id in file_ids:
+        if file_id not in songs:
+            cached = shared_cache.get_json(f'song:{file_id}')
+            if cached:
+                songs[file_id] = dict(cached)
+    CACHE_REQUESTS.inc(len(songs), cache='song', result='hit')
+    missing = [f for f in file_ids if f not in songs]
+    CACHE_REQUESTS.inc(len(missing), cache='song', result='miss')
+    for i in range(0, len(missing), 100):
+        result = db_request('GET', f"conversions?file_id=in.({','.join(missing[i:i + 100])})")
+        if not result:
+            continue
+        if replica:
+            replica.upsert(result)
+        for song in result:
+            songs[song['file_id']] = song
+            if song.get('status') == 'completed':
+                shared_cache.set_json(f"song:{song['file_id']}", song, ttl=SONG_CACHE_TTL)
+    return songs
+
+def invalidate_library():
+    """Drop cached /api/files bodies and folder summaries in every worker"""
+    try:
+        shared_cache.bump('library')
+    except Exception as e:
+        logger.error(f"Cache invalidation error: {e}")
+
+def library_cache_key(name):
+    return shared_cache.ns_key('library', name)
 
 def get_all_songs():
     """Get all songs from database (for all users)"""
-    result = db_request('GET', 'conversions?status=eq.completed&order=created_at.desc')
-    return result if result else []
+    if replica_ready():
+        return replica.list(status='completed')
+    return db_read(ALL_SONGS_QUERY) or []
+
+def get_all_conversions():
+    """Get every conversion except those being deleted (owner view)"""
+    if replica_ready():
+        return [row for row in replica.list() if row.get('status') != 'deleting']
+    return db_read(ALL_CONVERSIONS_QUERY) or []
 
 def get_songs_by_folder(folder_name):
     """Get songs by folder name"""
+    if replica_ready():
+        return replica.list(status='completed', folder=folder_name or None)
     if folder_name:
-        result = db_request('GET', f'conversions?folder=eq.{folder_name}&status=eq.completed&order=created_at.desc')
-    else:
-        result = db_request('GET', f'conversions?folder=is.null&status=eq.completed&order=created_at.desc')
-    return result if result else []
+        return db_read(f"conversions?folder=eq.{urllib.parse.quote(folder_name, safe='')}&status=eq.completed&order=created_at.desc") or []
+    return db_read('conversions?folder=is.null&status=eq.completed&order=created_at.desc') or []
 
 def get_user_songs(client_id):
     """Get songs for specific user"""
+    if replica_ready():
+        return replica.list(status='completed', client_id=client_id)
     result = db_request('GET', f'conversions?client_id=eq.{client_id}&status=eq.completed&order=created_at.desc')
     return result if result else []
 
+def find_conversions_by_url(url):
+    """Existing conversions of a source URL (duplicate check)"""
+    if replica_ready():
+        return replica.list(url=url)
+    result = db_request('GET', f'conversions?url=eq.{urllib.parse.quote_plus(url)}')
+    return result if result else []
+
+# --- Local replica sync ---
+replica = None
+if LOCAL_REPLICA and SUPABASE_URL and SUPABASE_KEY:
+    try:
+        replica = LocalReplica(REPLICA_PATH)
+    except Exception as e:
+        logger.error(f"❌ Local replica disabled: {e}")
+
+def replica_ready():
+    """True when library reads can be served from the local replica"""
+    return replica is not None and replica.ready
+
+def sync_replica(full=False):
+    """Pull Supabase changes into the local replica. Returns True on success."""
+    if replica is None:
+        return False
+    generation = replica.generation()
+    ok = replica.sync(lambda endpoint: db_request('GET', endpoint), full=full)
+    if ok and replica.generation() != generation:
+        # Rows changed elsewhere (another instance, the dashboard)
+        invalidate_library()
+    if not ok:
+        logger.warning("⚠️ Replica sync failed, serving local data")
+    return ok
+
+def replica_sync_loop():
+    """Background pull. Workers share the replica file, so a worker skips its
+    turn when another one synced within the interval."""
+    while True:
+        try:
+            full_age = replica.sync_age('last_full_sync')
+            age = replica.sync_age('last_sync')
+            if full_age is None or full_age >= REPLICA_FULL_SYNC_INTERVAL:
+                sync_replica(full=True)
+            elif age is None or age >= REPLICA_SYNC_INTERVAL:
+                sync_replica()
+        except Exception as e:
+            logger.error(f"Replica sync error: {e}")
+        time.sleep(REPLICA_SYNC_INTERVAL)
+
+if replica is not None:
+    threading.Thread(target=replica_sync_loop, daemon=True).start()
+
+# --- Disk janitor ---
+IN_PROGRESS_STATUSES = ('queued', 'downloading', 'converting', 'uploading')
+
+def job_download_dir(client_id, folder_name=None):
+    """Directory a conversion writes its files to"""
+    base = DOWNLOADS_DIR / client_id
+    if folder_name and folder_name.strip():
+        return base / folder_name.strip()
+    return base
+
+def expected_job_bytes(bitrate):
+    """Disk a conversion needs at peak: the downloaded source (~160 kbps
+    audio) plus the MP3 being encoded next to it"""
+    return int((160 + int(bitrate)) * 1000 / 8 * JOB_ESTIMATE_SECONDS)
+
+def cleanup_job_files(client_id, folder_name, file_id):
+    """Remove everything a failed job left behind (<file_id>.* incl. .part)"""
+    download_dir = job_download_dir(client_id, folder_name)
+    downloads_index.invalidate(download_dir)
+    for entry in downloads_index.files(download_dir):
+        if entry.path.name.startswith(f"{file_id}."):
+            try:
+                entry.path.unlink()
+                JANITOR_DELETED.inc(kind='failed_job')
+            except OSError:
+                pass
+    downloads_index.invalidate(download_dir)
+
+def active_job_ids():
+    """file_ids of conversions still in progress anywhere, or None if unknown"""
+    if replica_ready():
+        rows = [row for status in IN_PROGRESS_STATUSES for row in replica.list(status=status)]
+    else:
+        rows = db_request('GET', f"conversions?status=in.({','.join(IN_PROGRESS_STATUSES)})&select=file_id")
+        if rows is None:
+            return None
+    return {row.get('file_id') for row in rows}
+
+def run_janitor():
+    """One janitor pass: orphaned job files, then cache eviction"""
+    active = active_job_ids()
+    if active is not None:
+        active |= janitor.reserved_ids()
+    orphans, _ = janitor.sweep_orphans(active)
+    evicted, _ = janitor.evict_caches()
+    JANITOR_DELETED.inc(orphans, kind='orphan')
+    JANITOR_DELETED.inc(evicted, kind='cache')
+    DISK_FREE_BYTES.set(janitor.free_bytes())
+    if orphans or evicted:
+        downloads_index.invalidate()
+
+def janitor_loop():
+    """Runs at startup and every JANITOR_INTERVAL. A marker file's mtime
+    tells workers when another one has just done a pass."""
+    marker = DOWNLOADS_DIR / '.janitor'
+    while True:
+        try:
+            last_run = marker.stat().st_mtime if marker.exists() else 0
+            if time.time() - last_run >= JANITOR_INTERVAL:
+                marker.touch()
+                run_janitor()
+        except Exception as e:
+            logger.error(f"Janitor error: {e}")
+        time.sleep(JANITOR_INTERVAL)
+
+def reservation_refresh_loop():
+    """Keeps this process's disk reservations alive while its jobs run"""
+    while True:
+        time.sleep(DISK_RESERVATION_TTL / 3)
+        try:
+            janitor.refresh()
+        except Exception as e:
+            logger.error(f"Reservation refresh error: {e}")
+
+threading.Thread(target=janitor_loop, daemon=True).start()
+threading.Thread(target=reservation_refresh_loop, daemon=True).start()
+
 # --- Storage Upload ---
-def upload_with_retry(file_path, storage_path, max_retries=3):
+def upload_with_retry(file_path, storage_path, max_retries=3, content_type='audio/mpeg'):
     """Upload with retry logic"""
     for attempt in range(max_retries):
+        if not circuit_allows(storage_circuit):
+            logger.warning("⚠️ Storage is unavailable, not uploading")
+            break
         try:
             logger.info(f"📤 Upload attempt {attempt + 1}/{max_retries}")
             
             upload_url = f"{SUPABASE_URL}/storage/v1/object/{BUCKET_NAME}/{storage_path}"
             
+            # Overwrite: a job that runs twice (lost lease, resumed job)
+            # uploads to the same path
             headers = {
                 'Authorization': f'Bearer {SUPABASE_KEY}',
-                'Content-Type': 'audio/mpeg'
+                'Content-Type': content_type,
+                'x-upsert': 'true'
             }
             
             file_size = file_path.stat().st_size
@@ -215,12 +863,15 @@ def upload_with_retry(file_path, storage_path, max_retries=3):
             timeout = max(60, (file_size / (1024 * 1024)) * 10)
             timeout = min(timeout, 300)
             
-            response = requests.post(
-                upload_url,
-                headers=headers,
-                data=file_content,
-                timeout=timeout
-            )
+            UPSTREAM_REQUESTS.inc(upstream='supabase_storage')
+            with profiling.timed('http'):
+                response = requests.post(
+                    upload_url,
+                    headers=headers,
+                    data=file_content,
+                    timeout=timeout
+                )
+            record_status(storage_circuit, response.status_code)
             
             if response.status_code in [200, 201]:
                 public_url = f"{SUPABASE_URL}/storage/v1/object/public/{BUCKET_NAME}/{storage_path}"
@@ -228,13 +879,18 @@ def upload_with_retry(file_path, storage_path, max_retries=3):
                 return public_url
             else:
                 logger.warning(f"⚠️ Upload failed: {response.status_code} - {response.text}")
+                UPSTREAM_ERRORS.inc(upstream='supabase_storage')
                 
         except requests.exceptions.Timeout:
             logger.warning(f"⚠️ Upload timed out (attempt {attempt + 1})")
+            UPSTREAM_ERRORS.inc(upstream='supabase_storage')
+            storage_circuit.record_failure()
             if attempt < max_retries - 1:
                 time.sleep(5)
         except Exception as e:
             logger.warning(f"⚠️ Upload error: {e}")
+            UPSTREAM_ERRORS.inc(upstream='supabase_storage')
+            storage_circuit.record_failure()
             if attempt < max_retries - 1:
                 time.sleep(5)
     
@@ -242,8 +898,9 @@ def upload_with_retry(file_path, storage_path, max_retries=3):
     return None
 
 
-def upload_bytes_to_storage(content_bytes: bytes, storage_path: str, content_type: str = 'image/jpeg', max_retries: int = 3):
-    """Upload raw bytes to Supabase storage and return public URL on success."""
+def upload_bytes_to_storage(content_bytes: bytes, storage_path: str, content_type: str = 'image/jpeg', max_retries: int = 3, upsert: bool = False):
+    """Upload raw bytes to Supabase storage and return public URL on success.
+    With upsert=True an existing object at storage_path is overwritten."""
     try:
         if not SUPABASE_URL or not SUPABASE_KEY:
             logger.warning("Supabase credentials missing — skipping collage upload")
@@ -254,24 +911,37 @@ def upload_bytes_to_storage(content_bytes: bytes, storage_path: str, content_typ
             'Authorization': f'Bearer {SUPABASE_KEY}',
             'Content-Type': content_type
         }
+        if upsert:
+            headers['x-upsert'] = 'true'
 
         timeout = max(30, min(300, len(content_bytes) // (1024 * 1024) * 10))
 
         for attempt in range(max_retries):
+            if not circuit_allows(storage_circuit):
+                logger.warning("Storage is unavailable, not uploading collage")
+                break
             try:
                 logger.info(f"Uploading collage attempt {attempt+1}/{max_retries} -> {storage_path}")
-                resp = requests.post(upload_url, headers=headers, data=content_bytes, timeout=timeout)
+                UPSTREAM_REQUESTS.inc(upstream='supabase_storage')
+                with profiling.timed('http'):
+                    resp = requests.post(upload_url, headers=headers, data=content_bytes, timeout=timeout)
+                record_status(storage_circuit, resp.status_code)
                 if resp.status_code in (200, 201):
                     public_url = f"{SUPABASE_URL}/storage/v1/object/public/{BUCKET_NAME}/{storage_path}"
                     logger.info(f"✅ Collage uploaded: {public_url}")
                     return public_url
                 else:
                     logger.warning(f"Collage upload failed: {resp.status_code} - {resp.text}")
+                    UPSTREAM_ERRORS.inc(upstream='supabase_storage')
             except requests.exceptions.Timeout:
                 logger.warning("Collage upload timed out, retrying...")
+                UPSTREAM_ERRORS.inc(upstream='supabase_storage')
+                storage_circuit.record_failure()
                 time.sleep(2)
             except Exception as e:
                 logger.warning(f"Collage upload error: {e}")
+                UPSTREAM_ERRORS.inc(upstream='supabase_storage')
+                storage_circuit.record_failure()
                 time.sleep(2)
 
         logger.error("All collage upload attempts failed")
@@ -294,7 +964,17 @@ def delete_from_storage(storage_path):
             'Authorization': f'Bearer {SUPABASE_KEY}'
         }
         
-        response = requests.delete(delete_url, headers=headers, timeout=10)
+        if not circuit_allows(storage_circuit):
+            logger.error(f"❌ Storage is unavailable, not deleting {storage_path}")
+            return False
+        UPSTREAM_REQUESTS.inc(upstream='supabase_storage')
+        try:
+            with profiling.timed('http'):
+                response = requests.delete(delete_url, headers=headers, timeout=10)
+        except Exception:
+            storage_circuit.record_failure()
+            raise
+        record_status(storage_circuit, response.status_code)
         
         if response.status_code in [200, 204]:
             logger.info(f"✅ Deleted from storage: {storage_path}")
@@ -304,22 +984,568 @@ def delete_from_storage(storage_path):
             return True  # Already deleted
         else:
             logger.error(f"❌ Storage delete failed: {response.status_code} - {response.text}")
+            UPSTREAM_ERRORS.inc(upstream='supabase_storage')
             return False
             
     except Exception as e:
         logger.error(f"❌ Storage delete error: {e}")
+        UPSTREAM_ERRORS.inc(upstream='supabase_storage')
         return False
 
+# ==========================================
+# Renditions: one decode, several encodings
+# ==========================================
+
+# Extra encodings made for every new song, e.g. "opus_48,mp3_64,mp3_128"
+# (<codec>_<kbps>). They come from one ffmpeg run over the downloaded
+# source and are recorded in the `renditions` jsonb column of conversions.
+# The MP3 at the bitrate picked in /api/convert is always produced and stays
+# the song's storage_url. Empty (default) keeps the single-MP3 pipeline.
+RENDITIONS = [n.strip() for n in os.environ.get('RENDITIONS', '').split(',') if n.strip()]
+# EBU R128 loudness normalization applied to every rendition
+LOUDNORM = os.environ.get('LOUDNORM', '1') == '1'
+LOUDNORM_FILTER = os.environ.get('LOUDNORM_FILTER', 'loudnorm=I=-16:TP=-1.5:LRA=11')
+
+RENDITION_CODECS = {
+    'mp3': {'encoder': 'libmp3lame', 'ext': 'mp3', 'content_type': 'audio/mpeg'},
+    'opus': {'encoder': 'libopus', 'ext': 'opus', 'content_type': 'audio/ogg'},
+    'aac': {'encoder': 'aac', 'ext': 'm4a', 'content_type': 'audio/mp4'},
+}
+# Effective connection types (ECT client hint) that get the smallest rendition
+SLOW_CONNECTIONS = ('slow-2g', '2g', '3g')
+
+
+def parse_rendition(name):
+    """'opus_48' -> ('opus', 48); None if the name isn't valid"""
+    codec, _, kbps = name.partition('_')
+    if codec not in RENDITION_CODECS or not kbps.isdigit():
+        return None
+    return codec, int(kbps)
+
+
+def renditions_for_job(bitrate):
+    """Rendition names for a job, primary MP3 first"""
+    primary = f'mp3_{bitrate}'
+    return [primary] + [n for n in RENDITIONS if n != primary and parse_rendition(n)]
+
+
+def rendition_filename(file_id, name, primary):
+    ext = RENDITION_CODECS[parse_rendition(name)[0]]['ext']
+    return f'{file_id}.{ext}' if name == primary else f'{file_id}.{name}.{ext}'
+
+
+def downloaded_source(info, download_dir, file_id):
+    """Path of the media file yt-dlp downloaded for this job"""
+    for download in info.get('requested_downloads') or []:
+        path = download.get('filepath')
+        if path and Path(path).exists():
+            return Path(path)
+    downloads_index.invalidate(download_dir)
+    for entry in downloads_index.files(download_dir):
+        if entry.path.name.startswith(f'{file_id}.') and not entry.path.name.endswith('.part'):
+            return entry.path
+    raise FileNotFoundError(f'Downloaded source for {file_id} not found')
+
+
+def encode_renditions(source, download_dir, file_id, names, loudnorm=None):
+    """Encode every rendition in a single ffmpeg run: the source is decoded
+    (and loudness-normalized) once, then split to one encoder per output.
+    Returns {name: Path}."""
+    ffmpeg = shutil.which('ffmpeg')
+    if not ffmpeg:
+        raise RuntimeError('ffmpeg not found')
+
+    chain = [LOUDNORM_FILTER, 'aresample=48000'] if (LOUDNORM if loudnorm is None else loudnorm) else []
+    if len(names) > 1:
+        chain.append(f'asplit={len(names)}')
+    cmd = [ffmpeg, '-hide_banner', '-loglevel', 'error', '-y', '-i', str(source)]
+    if chain:
+        labels = ''.join(f'[r{i}]' for i in range(len(names)))
+        cmd += ['-filter_complex', f"[0:a]{','.join(chain)}{labels}"]
+
+    outputs = {}
+    for i, name in enumerate(names):
+        codec, kbps = parse_rendition(name)
+        out = download_dir / rendition_filename(file_id, name, names[0])
+        cmd += ['-map', f'[r{i}]' if chain else '0:a',
+                '-c:a', RENDITION_CODECS[codec]['encoder'], '-b:a', f'{kbps}k', str(out)]
+        outputs[name] = out
+
+    result = jobs.run(cmd)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.strip()[-300:]}")
+    logger.info(f"🎚️ Encoded {len(outputs)} renditions for {file_id}: {', '.join(outputs)}")
+    return outputs
+
+
+def upload_renditions(outputs, primary, primary_url, primary_path):
+    """Upload the non-primary renditions next to the primary MP3 and return
+    the `renditions` record. A failed extra upload is skipped, not fatal."""
+    prefix = primary_path.rsplit('/', 1)[0]
+    records = {}
+    for name, path in outputs.items():
+        codec, kbps = parse_rendition(name)
+        content_type = RENDITION_CODECS[codec]['content_type']
+        if name == primary:
+            url, storage_path = primary_url, primary_path
+        else:
+            storage_path = f"{prefix}/{path.name}"
+            url = upload_with_retry(path, storage_path, content_type=content_type)
+            if not url:
+                logger.warning(f"⚠️ Skipping rendition {name}: upload failed")
+                continue
+        records[name] = {
+            'url': url,
+            'path': storage_path,
+            'codec': codec,
+            'bitrate': kbps,
+            'size': path.stat().st_size,
+            'content_type': content_type,
+        }
+    return records
+
+
+def rendition_storage_paths(song):
+    """Storage paths of a song's extra renditions (file_path not included)"""
+    return [r['path'] for r in (song.get('renditions') or {}).values()
+            if r.get('path') and r.get('path') != song.get('file_path')]
+
+
+def rendition_hints(args, headers):
+    """Playback hints from /api/play's query string and client-hint headers"""
+    return {
+        'rendition': args.get('rendition'),
+        'quality': (args.get('quality') or '').lower(),
+        'codecs': [c.strip().lower() for c in (args.get('codecs') or '').split(',') if c.strip()],
+        'save_data': (headers.get('Save-Data') or '').lower() == 'on',
+        'ect': (headers.get('ECT') or '').lower(),
+    }
+
+
+def select_rendition(song, hints):
+    """Pick (name, record) to play, or None for the primary storage_url.
+    An explicit ?rendition= wins. Constrained clients (quality=low,
+    Save-Data, slow ECT) get the lowest bitrate and quality=high the
+    highest, among codecs the client can play (MP3 unless it lists more)."""
+    renditions = song.get('renditions') or {}
+    if not renditions:
+        return None
+    if hints['rendition'] in renditions:
+        return hints['rendition'], renditions[hints['rendition']]
+
+    playable = [c for c in hints['codecs'] if c != 'hls'] or ['mp3']
+    candidates = [(name, r) for name, r in renditions.items() if r.get('codec') in playable and r.get('url')]
+    if not candidates:
+        return None
+    by_bitrate = lambda item: item[1].get('bitrate', 0)
+    if hints['quality'] == 'low' or hints['save_data'] or hints['ect'] in SLOW_CONNECTIONS:
+        return min(candidates, key=by_bitrate)
+    if hints['quality'] == 'high':
+        return max(candidates, key=by_bitrate)
+    return None
+
+
+def play_payload(song, hints):
+    """/api/play response for a completed song (shared with the ASGI route)"""
+    payload = {
+        'url': song['storage_url'],
+        'title': song.get('title', 'Audio'),
+        'success': True
+    }
+    if song.get('content_type'):
+        payload['content_type'] = song['content_type']
+    choice = select_rendition(song, hints)
+    if choice:
+        name, record = choice
+        payload.update(url=record['url'], rendition=name, codec=record.get('codec'),
+                       bitrate=record.get('bitrate'), content_type=record.get('content_type'))
+    if song.get('renditions'):
+        payload['renditions'] = sorted(song['renditions'])
+    hls_url = (song.get('hls') or {}).get('url')
+    if hls_url:
+        payload['hls_url'] = hls_url
+        # Clients that play HLS start after the first segment; an explicit
+        # ?rendition= still gets that progressive file
+        if 'hls' in hints['codecs'] and not hints['rendition']:
+            payload.update(url=hls_url, format='hls', progressive_url=payload['url'])
+    return payload
+
+# ==========================================
+# HLS packaging for long tracks
+# ==========================================
+
+# Songs at least HLS_MIN_DURATION seconds long (DJ mixes, podcasts) also get
+# an HLS copy: the finished MP3 is cut into HLS_SEGMENT_SECONDS segments
+# (stream copy, no re-encode) plus a VOD playlist, uploaded next to the MP3
+# as <file_id>.m3u8 and <file_id>.<n>.ts. Recorded in the `hls` jsonb column
+# of conversions; /api/play returns the playlist to clients that can play it.
+HLS_ENABLED = os.environ.get('HLS', '0') == '1'
+HLS_MIN_DURATION = int(os.environ.get('HLS_MIN_DURATION', '900'))
+HLS_SEGMENT_SECONDS = int(os.environ.get('HLS_SEGMENT_SECONDS', '6'))
+HLS_UPLOAD_WORKERS = int(os.environ.get('HLS_UPLOAD_WORKERS', '4'))
+HLS_PLAYLIST_TYPE = 'application/vnd.apple.mpegurl'
+HLS_SEGMENT_TYPE = 'video/mp2t'
+
+
+def wants_hls(duration):
+    return HLS_ENABLED and (duration or 0) >= HLS_MIN_DURATION
+
+
+def hls_segment_name(file_id, index):
+    return f'{file_id}.{index:05d}.ts'
+
+
+def package_hls(audio_path, download_dir, file_id):
+    """Segment an MP3 (or AAC) file into MPEG-TS audio segments and a VOD playlist.
+    Returns (playlist, [segments]) as local paths."""
+    ffmpeg = shutil.which('ffmpeg')
+    if not ffmpeg:
+        raise RuntimeError('ffmpeg not found')
+    playlist = download_dir / f'{file_id}.m3u8'
+    cmd = [ffmpeg, '-hide_banner', '-loglevel', 'error', '-y', '-i', str(audio_path),
+           '-map', '0:a', '-c:a', 'copy',
+           '-f', 'hls', '-hls_time', str(HLS_SEGMENT_SECONDS), '-hls_playlist_type', 'vod',
+           '-hls_segment_filename', str(download_dir / f'{file_id}.%05d.ts'), str(playlist)]
+    result = jobs.run(cmd)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.strip()[-300:]}")
+    segments = []
+    while (download_dir / hls_segment_name(file_id, len(segments))).exists():
+        segments.append(download_dir / hls_segment_name(file_id, len(segments)))
+    downloads_index.invalidate(download_dir)
+    logger.info(f"📼 Packaged {file_id} as HLS: {len(segments)} segments")
+    return playlist, segments
+
+
+def upload_hls(playlist, segments, file_id, primary_path):
+    """Upload segments, then the playlist (so it never points at missing
+    segments), next to the primary MP3. Returns the `hls` record, or None
+    if anything failed; the song then just plays progressively."""
+    prefix = primary_path.rsplit('/', 1)[0]
+    with ThreadPoolExecutor(max_workers=HLS_UPLOAD_WORKERS) as pool:
+        uploaded = list(pool.map(
+            lambda seg: upload_with_retry(seg, f"{prefix}/{seg.name}", content_type=HLS_SEGMENT_TYPE),
+            segments))
+    playlist_url = None
+    if all(uploaded):
+        playlist_url = upload_with_retry(playlist, f"{prefix}/{playlist.name}", content_type=HLS_PLAYLIST_TYPE)
+    record = {
+        'url': playlist_url,
+        'path': f"{prefix}/{playlist.name}",
+        'segments': len(segments),
+        'segment_seconds': HLS_SEGMENT_SECONDS,
+    }
+    if not playlist_url:
+        logger.warning(f"⚠️ HLS upload failed for {file_id}, keeping progressive playback only")
+        for path in hls_storage_paths({'file_id': file_id, 'hls': record}):
+            delete_from_storage(path)
+        return None
+    return record
+
+
+def hls_storage_paths(song):
+    """Storage paths of a song's HLS playlist and segments"""
+    hls = song.get('hls')
+    if not hls or not hls.get('path'):
+        return []
+    prefix = hls['path'].rsplit('/', 1)[0]
+    return [hls['path']] + [f"{prefix}/{hls_segment_name(song['file_id'], i)}"
+                            for i in range(hls.get('segments', 0))]
+
+# ==========================================
+# Passthrough: store the native audio stream
+# ==========================================
+
+# Store YouTube's own AAC/Opus stream (stream copy into a web-playable
+# container) instead of transcoding to MP3. Needs the `content_type`
+# column in conversions. Only used when RENDITIONS is empty.
+PASSTHROUGH = os.environ.get('PASSTHROUGH', '0') == '1'
+# Native codecs to keep, in order of preference when choosing a download
+PASSTHROUGH_CODECS = [c.strip() for c in os.environ.get('PASSTHROUGH_CODECS', 'aac,opus').split(',') if c.strip()]
+
+PASSTHROUGH_CONTAINERS = {
+    'aac': {'ext': 'm4a', 'content_type': 'audio/mp4', 'args': ['-movflags', '+faststart']},
+    'opus': {'ext': 'webm', 'content_type': 'audio/webm', 'args': []},
+    'mp3': {'ext': 'mp3', 'content_type': 'audio/mpeg', 'args': []},
+}
+# Codecs an MPEG-TS HLS segment can carry
+HLS_CODECS = ('mp3', 'aac')
+
+
+# Extensions a stored song can have
+AUDIO_EXTENSIONS = ('.mp3', '.m4a', '.webm')
+
+
+def passthrough_enabled():
+    return PASSTHROUGH and not RENDITIONS
+
+
+def audio_codec_name(acodec):
+    """yt-dlp acodec ('mp4a.40.2', 'opus', ...) -> 'aac', 'opus', 'mp3' or None"""
+    acodec = (acodec or '').lower()
+    if acodec.startswith('mp4a') or acodec == 'aac':
+        return 'aac'
+    if acodec in ('opus', 'mp3'):
+        return acodec
+    return None
+
+
+def source_audio_codec(info, source):
+    """Codec of the downloaded audio, from yt-dlp's metadata or the file extension"""
+    codec = audio_codec_name(info.get('acodec'))
+    if codec is None:
+        codec = {'.m4a': 'aac', '.aac': 'aac', '.opus': 'opus', '.webm': 'opus', '.mp3': 'mp3'}.get(source.suffix.lower())
+    return codec
+
+
+def remux_audio(source, download_dir, file_id, codec):
+    """Copy the audio stream into its web container without re-encoding"""
+    ffmpeg = shutil.which('ffmpeg')
+    if not ffmpeg:
+        raise RuntimeError('ffmpeg not found')
+    container = PASSTHROUGH_CONTAINERS[codec]
+    out = download_dir / f"{file_id}.{container['ext']}"
+    if out == source:
+        out = download_dir / f"{file_id}.remux.{container['ext']}"
+    cmd = [ffmpeg, '-hide_banner', '-loglevel', 'error', '-y', '-i', str(source),
+           '-map', '0:a:0', '-c:a', 'copy', '-map_metadata', '-1', *container['args'], str(out)]
+    result = jobs.run(cmd)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.strip()[-300:]}")
+    logger.info(f"📦 Stored native {codec} stream for {file_id} (no re-encode)")
+    return out
+
+# ==========================================
+# Download format selection
+# ==========================================
+
+# Fragments fetched in parallel for DASH/HLS formats
+DOWNLOAD_FRAGMENTS = int(os.environ.get('DOWNLOAD_FRAGMENTS', '4'))
+
+
+def format_bitrate(fmt):
+    """Audio bitrate of a format in kbps, or None if yt-dlp doesn't know it"""
+    return fmt.get('abr') or (fmt.get('tbr') if fmt.get('vcodec') == 'none' else None)
+
+
+def format_size(fmt, duration):
+    """Expected download size in bytes (infinite when unknown)"""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if not size and fmt.get('tbr') and duration:
+        size = fmt['tbr'] * 1000 / 8 * duration
+    return size or float('inf')
+
+
+def pick_download_format(formats, target_kbps, duration=None, codecs=None):
+    """Smallest audio-only format with at least `target_kbps`, else the best
+    audio-only one below it. Formats with video are only used when there is
+    no audio-only stream, and then the smallest one with audio. With
+    `codecs`, audio-only streams in those codecs are preferred (in order)."""
+    usable = [f for f in formats if f.get('acodec') != 'none' and not f.get('has_drm')]
+    audio_only = [f for f in usable if f.get('vcodec') == 'none']
+    for codec in codecs or ():
+        native = [f for f in audio_only if audio_codec_name(f.get('acodec')) == codec]
+        if native:
+            audio_only = native
+            break
+    if audio_only:
+        known = [f for f in audio_only if format_bitrate(f)]
+        enough = [f for f in known if format_bitrate(f) >= target_kbps]
+
+        # Same bitrate: skip YouTube's dynamic-range-compressed variants,
+        # then prefer plain HTTP over fragmented protocols, then the smaller
+        def tie_break(f):
+            return ('drc' in str(f.get('format_id', '')),
+                    f.get('protocol') not in ('https', 'http'),
+                    format_size(f, duration))
+
+        if enough:
+            return min(enough, key=lambda f: (format_bitrate(f), *tie_break(f)))
+        if known:
+            return min(known, key=lambda f: (-format_bitrate(f), *tie_break(f)))
+        return min(audio_only, key=lambda f: format_size(f, duration))
+    if usable:
+        return min(usable, key=lambda f: (format_size(f, duration), f.get('tbr') or float('inf')))
+    return formats[-1] if formats else None
+
+
+def audio_format_selector(target_kbps, codecs=None):
+    """yt-dlp `format` callable wrapping pick_download_format()"""
+    def select(ctx):
+        formats = ctx['formats']
+        duration = next((f.get('duration') for f in formats if f.get('duration')), None)
+        chosen = pick_download_format(formats, target_kbps, duration, codecs)
+        if chosen:
+            logger.info(f"🎯 Download format {chosen.get('format_id')}: {chosen.get('acodec')} "
+                        f"{format_bitrate(chosen) or '?'} kbps, {chosen.get('protocol')} (target {target_kbps} kbps)")
+            yield chosen
+    return select
+
+# ==========================================
+# Upstream governor
+# ==========================================
+# YouTube answers bursts with 429s, "confirm you're not a bot" pages and slow
+# signature responses. Every request that reaches it goes through `upstream`:
+# a few at a time per host, paced by a token bucket, and paused with
+# exponential backoff (with jitter) after a throttling error. A conversion that
+# gets throttled goes back to the queue instead of failing.
+UPSTREAM_BACKOFF_BASE = int(os.environ.get('UPSTREAM_BACKOFF_BASE', '30'))
+UPSTREAM_BACKOFF_MAX = int(os.environ.get('UPSTREAM_BACKOFF_MAX', '900'))
+# How long a conversion waits for a slot before it is re-queued, and a
+# /api/song-info preview before it answers 503
+UPSTREAM_MAX_WAIT = float(os.environ.get('UPSTREAM_MAX_WAIT', '60'))
+SONG_INFO_MAX_WAIT = float(os.environ.get('SONG_INFO_MAX_WAIT', '5'))
+YOUTUBE_HOST = 'youtube.com'
+HOST_ALIASES = {'youtu.be': YOUTUBE_HOST, 'youtube-nocookie.com': YOUTUBE_HOST}
+THROTTLE_ERROR_RE = re.compile(
+    r"HTTP Error 429|Too Many Requests|rate[- ]?limit|confirm you.?re not a bot|try again later", re.I)
+
+
+def parse_upstream_limits(spec):
+    """'youtube.com=2:0.5:4,...' (host=concurrency:requests per second:burst) -> {host: HostLimits}"""
+    limits = {}
+    for item in spec.split(','):
+        host, _, values = item.strip().partition('=')
+        if not values:
+            continue
+        try:
+            concurrency, rate, burst = values.split(':')
+            limits[host.strip().lower()] = HostLimits(int(concurrency), float(rate), int(burst))
+        except ValueError:
+            logger.warning(f"Ignoring bad UPSTREAM_LIMITS entry: {item}")
+    return limits
+
+
+UPSTREAM_LIMITS = parse_upstream_limits(
+    os.environ.get('UPSTREAM_LIMITS', 'youtube.com=2:0.5:4,googlevideo.com=4:2:8'))
+upstream = UpstreamGovernor(UPSTREAM_LIMITS, backoff_base=UPSTREAM_BACKOFF_BASE,
+                            backoff_max=UPSTREAM_BACKOFF_MAX, shared=shared_cache)
+
+
+def upstream_host(url):
+    """The host a URL's requests are paced under: its registrable domain"""
+    host = (urllib.parse.urlsplit(url or '').hostname or '').lower()
+    if not re.fullmatch(r'[\d.]+|[\da-f:]+', host):
+        host = '.'.join(host.split('.')[-2:])
+    return HOST_ALIASES.get(host, host)
+
+
+@contextmanager
+def governed(host, max_wait=UPSTREAM_MAX_WAIT, interrupt=None):
+    """Hold an upstream slot for `host`. A throttling error raised inside
+    starts the host's backoff and comes out as Throttled."""
+    waiting = time.perf_counter()
+    with upstream.slot(host, max_wait, interrupt):
+        UPSTREAM_WAIT_SECONDS.observe(time.perf_counter() - waiting, host=host)
+        try:
+            yield
+        except Throttled:
+            raise
+        except Exception as e:
+            if not THROTTLE_ERROR_RE.search(str(e)):
+                raise
+            UPSTREAM_THROTTLED.inc(host=host)
+            raise Throttled(host, upstream.throttled(host)) from e
+    upstream.succeeded(host)
+
+
+def refresh_upstream_gauges():
+    for host, state in upstream.snapshot().items():
+        UPSTREAM_BACKOFF_SECONDS.set(state['backoff_seconds'], host=host)
+        UPSTREAM_IN_FLIGHT.set(state['in_flight'], host=host)
+
+# ==========================================
+# Job checkpoints
+# ==========================================
+# Each finished stage of a conversion is recorded next to its files as
+# <file_id>.checkpoint.json:
+#   downloaded: the source media is on disk (RENDITIONS/passthrough only)
+#   encoded:    the audio (and renditions) to upload are on disk
+#   uploaded:   the audio is in Storage, only the DB row is left to finish
+# When the job is run again after a restart, run_conversion() skips the
+# stages whose checkpoint and files are still there.
+
+# The parts of yt-dlp's info dict used after the download
+CHECKPOINT_INFO_KEYS = ('title', 'thumbnail', 'duration', 'uploader', 'channel', 'acodec', 'abr', 'ext')
+
+
+def checkpoint_path(download_dir, file_id):
+    return download_dir / f'{file_id}.checkpoint.json'
+
+
+def checkpoint_info(info):
+    return {key: info.get(key) for key in CHECKPOINT_INFO_KEYS}
+
+
+def save_checkpoint(download_dir, file_id, checkpoint):
+    """Atomically record a finished stage; returns the checkpoint"""
+    path = checkpoint_path(download_dir, file_id)
+    tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    tmp.write_text(json.dumps(checkpoint), encoding='utf-8')
+    os.replace(tmp, path)
+    return checkpoint
+
+
+def load_checkpoint(download_dir, file_id):
+    """The job's last checkpoint, or None when there is none or the files it
+    points to are gone (e.g. the job moved to another machine)"""
+    path = checkpoint_path(download_dir, file_id)
+    try:
+        checkpoint = json.loads(path.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return None
+    stage = checkpoint.get('stage')
+    if stage == 'downloaded':
+        needed = [checkpoint.get('source')]
+    elif stage == 'encoded':
+        needed = [checkpoint.get('audio'), *(checkpoint.get('renditions') or {}).values()]
+    elif stage == 'uploaded':
+        needed = []
+    else:
+        needed = [None]
+    if not all(name and (download_dir / name).exists() for name in needed):
+        logger.info(f"Checkpoint for {file_id} is stale, starting over")
+        path.unlink(missing_ok=True)
+        return None
+    return checkpoint
+
 # ==========================================
 # FIXED: Conversion Function with Folder Support
 # ==========================================
 
 def process_conversion(url, file_id, client_id, folder_name=None, bitrate='64'):
-    """Process YouTube conversion with folder support"""
+    """Process YouTube conversion with folder support. Callers count the job
+    in QUEUE_DEPTH (inc()) when they accept it; this takes it off."""
+    QUEUE_DEPTH.dec()
+    ACTIVE_WORKERS.inc()
+    started = time.perf_counter()
+    success = False
+    job = jobs.start(file_id)
+    try:
+        success = run_conversion(url, file_id, client_id, folder_name, bitrate)
+        return success
+    finally:
+        # A job that lost its lease leaves its files to the worker that took
+        # over; a re-queued one (None) keeps them to resume from
+        if success is False and job.reason != LEASE_LOST:
+            cleanup_job_files(client_id, folder_name, file_id)
+        jobs.finish(file_id)
+        janitor.release(file_id)
+        ACTIVE_WORKERS.dec()
+        CONVERSION_STAGE_SECONDS.observe(time.perf_counter() - started, stage='total')
+        CONVERSIONS.inc(result='completed' if success else 'requeued' if success is None
+                        else 'cancelled' if job.cancelled else 'error')
+
+
+def run_conversion(url, file_id, client_id, folder_name=None, bitrate='64'):
+    """Download, convert and upload one song, updating its DB row as it goes.
+    Returns True when done, False when it failed or was cancelled, and None
+    when YouTube throttled it and it went back to the queue."""
+    job = jobs.current() or Job(file_id)
     try:
         if not is_owner(client_id):
             logger.error(f"❌ User {client_id} is not owner, cannot convert")
-            update_in_db(file_id, {
+            update_job(file_id, {
                 'status': 'error',
                 'message': 'Only owner can add songs',
                 'error_time': datetime.utcnow().isoformat()
@@ -328,125 +1554,668 @@ def process_conversion(url, file_id, client_id, folder_name=None, bitrate='64'):
         
         logger.info(f"🎵 Owner processing: {file_id}, Folder: {folder_name}")
         
-        update_in_db(file_id, {'status': 'downloading', 'progress': 10})
+        if not update_job(file_id, {'status': 'downloading', 'progress': 10}):
+            stop_if_cancelled(job)
         
         # Create downloads directory
         base_download_dir = DOWNLOADS_DIR / client_id
         base_download_dir.mkdir(exist_ok=True)
+        downloads_index.invalidate(base_download_dir)
         
         # Create folder directory if folder specified
-        if folder_name and folder_name.strip():
-            folder_dir = base_download_dir / folder_name.strip()
-            folder_dir.mkdir(exist_ok=True)
-            logger.info(f"📁 Created folder: {folder_dir}")
-            download_dir = folder_dir
-        else:
-            download_dir = base_download_dir
+        download_dir = job_download_dir(client_id, folder_name)
+        if download_dir != base_download_dir:
+            download_dir.mkdir(exist_ok=True)
+            downloads_index.invalidate(download_dir)
+            logger.info(f"📁 Created folder: {download_dir}")
         
         ffmpeg_path = find_ffmpeg_path()
         
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': bitrate,
-            }],
-            'outtmpl': str(download_dir / f'{file_id}.%(ext)s'),  # Save to correct folder
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': False,
-            'noplaylist': True,
+        # An interrupted job (restart, deploy, crashed worker) picks up after
+        # the last stage it finished on this disk
+        checkpoint = load_checkpoint(download_dir, file_id)
+        if checkpoint:
+            logger.info(f"♻️ Resuming {file_id} after stage '{checkpoint['stage']}'")
+            JOBS_RESUMED.inc(stage=checkpoint['stage'])
+        else:
+            # The highest bitrate we'll encode decides how good the source must be
+            encodings = renditions_for_job(bitrate) if RENDITIONS else [f'mp3_{bitrate}']
+            target_kbps = max(parse_rendition(name)[1] for name in encodings)
+            ydl_opts = {
+                'format': audio_format_selector(target_kbps, PASSTHROUGH_CODECS if passthrough_enabled() else None),
+                'concurrent_fragment_downloads': DOWNLOAD_FRAGMENTS,
+                'outtmpl': str(download_dir / f'{file_id}.%(ext)s'),  # Save to correct folder
+                'quiet': True,
+                'no_warnings': True,
+                'extract_flat': False,
+                'noplaylist': True,
+                # Abort rather than fill the disk mid-download
+                'max_filesize': max(janitor.available_bytes(file_id), 1024 * 1024),
+            }
+            
+            if ffmpeg_path:
+                ydl_opts['ffmpeg_location'] = ffmpeg_path
+            
+            # yt-dlp only downloads; the outputs are made from the source by our
+            # own ffmpeg run, which a cancellation can terminate. The progress
+            # hook runs for every chunk, so raising JobCancelled there aborts the
+            # download. A .part file left by an interrupted run is resumed.
+            stage_marks = {}
+            
+            def on_progress(d):
+                job.check()
+                if d.get('status') == 'finished':
+                    stage_marks['downloaded'] = time.perf_counter()
+                    DOWNLOAD_BYTES.inc(d.get('downloaded_bytes') or d.get('total_bytes') or 0, kind='media')
+            
+            ydl_opts['progress_hooks'] = [on_progress]
+            
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                UPSTREAM_REQUESTS.inc(upstream='youtube')
+                extract_started = time.perf_counter()
+                try:
+                    # Extraction and the media download hit different hosts
+                    # (youtube.com, googlevideo.com), so they are paced apart
+                    with governed(upstream_host(url), interrupt=job.check):
+                        info = ydl.extract_info(url, download=False)
+                    media_url = info.get('url') or next(
+                        (f.get('url') for f in info.get('requested_formats') or []), url)
+                    with governed(upstream_host(media_url), interrupt=job.check):
+                        info = ydl.process_ie_result(info, download=True)
+                except Exception:
+                    UPSTREAM_ERRORS.inc(upstream='youtube')
+                    raise
+                extract_finished = time.perf_counter()
+                CONVERSION_STAGE_SECONDS.observe(
+                    stage_marks.get('downloaded', extract_finished) - extract_started, stage='download')
+            
+            source = downloaded_source(info, download_dir, file_id)
+            if source.suffix == '.mp3':
+                # Keep the encoder from writing over its own input
+                source = source.rename(source.with_name(f'{file_id}.source.mp3'))
+            checkpoint = save_checkpoint(download_dir, file_id, {
+                'stage': 'downloaded',
+                'info': checkpoint_info(info),
+                'source': source.name,
+            })
+        job.check()
+        
+        info = checkpoint['info']
+        title = info.get('title', 'audio')
+        thumbnail = info.get('thumbnail')
+        duration = info.get('duration', 0)
+        
+        logger.info(f"Downloaded: {title} to {download_dir}")
+        converting = {
+            'status': 'converting', 
+            'progress': 50,
+            'title': title,
+            'thumbnail': thumbnail,
+            'duration': duration
         }
+        if STORE_UPLOADER:
+            converting['uploader'] = info.get('uploader') or info.get('channel')
+        if not update_job(file_id, converting):
+            stop_if_cancelled(job)
         
-        if ffmpeg_path:
-            ydl_opts['ffmpeg_location'] = ffmpeg_path
+        if checkpoint['stage'] == 'downloaded':
+            source = download_dir / checkpoint['source']
+            audio_path = download_dir / f'{file_id}.mp3'
+            content_type = 'audio/mpeg'
+            codec = 'mp3'
+            renditions = {}
+            native = source_audio_codec(info, source) if passthrough_enabled() else None
+            with CONVERSION_STAGE_SECONDS.time(stage='encode'):
+                if RENDITIONS:
+                    renditions = encode_renditions(source, download_dir, file_id, renditions_for_job(bitrate))
+                elif native in PASSTHROUGH_CODECS and native in PASSTHROUGH_CONTAINERS:
+                    codec = native
+                    audio_path = remux_audio(source, download_dir, file_id, codec)
+                    content_type = PASSTHROUGH_CONTAINERS[codec]['content_type']
+                else:
+                    if passthrough_enabled():
+                        logger.info(f"Source codec {native or info.get('acodec')} can't be passed through, encoding MP3")
+                    audio_path = encode_renditions(source, download_dir, file_id, [f'mp3_{bitrate}'],
+                                                   loudnorm=False)[f'mp3_{bitrate}']
+            checkpoint = save_checkpoint(download_dir, file_id, {
+                'stage': 'encoded',
+                'info': info,
+                'audio': audio_path.name,
+                'codec': codec,
+                'content_type': content_type,
+                'renditions': {name: path.name for name, path in renditions.items()},
+            })
+            if source != audio_path:
+                source.unlink(missing_ok=True)
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            title = info.get('title', 'audio')
-            thumbnail = info.get('thumbnail')
-            duration = info.get('duration', 0)
+        audio_path = download_dir / checkpoint['audio']
+        content_type = checkpoint['content_type']
+        codec = checkpoint['codec']
+        renditions = {name: download_dir / filename for name, filename in checkpoint.get('renditions', {}).items()}
+        
+        if checkpoint['stage'] == 'encoded':
+            job.check()
+            if not audio_path.exists():
+                update_job(file_id, {
+                    'status': 'error',
+                    'message': 'MP3 file not found',
+                    'error_time': datetime.utcnow().isoformat()
+                })
+                return False
             
-            logger.info(f"Downloaded: {title} to {download_dir}")
-            update_in_db(file_id, {
-                'status': 'converting', 
-                'progress': 50,
-                'title': title,
-                'thumbnail': thumbnail,
-                'duration': duration
-            })
+            file_size = audio_path.stat().st_size
+            logger.info(f"Audio ready ({codec}): {file_size/(1024*1024):.2f} MB")
             
-            mp3_path = download_dir / f'{file_id}.mp3'
+            if not update_job(file_id, {
+                'status': 'uploading',
+                'progress': 70,
+                'file_size': file_size
+            }):
+                stop_if_cancelled(job)
             
-            if mp3_path.exists():
-                file_size = mp3_path.stat().st_size
-                logger.info(f"MP3 created: {file_size/(1024*1024):.2f} MB")
-                
-                update_in_db(file_id, {
-                    'status': 'uploading',
-                    'progress': 70,
-                    'file_size': file_size
-                })
-                
-                # Use folder name in storage path
-                if folder_name and folder_name.strip():
-                    # Keep original folder name
-                    storage_path = f"owner/{folder_name.strip()}/{file_id}.mp3"
-                    logger.info(f"📁 Uploading to folder: {folder_name.strip()}, Path: {storage_path}")
-                else:
-                    storage_path = f"owner/{file_id}.mp3"
-                    logger.info(f"📁 Uploading to root, Path: {storage_path}")
-                    
-                storage_url = upload_with_retry(mp3_path, storage_path)
-                
-                if storage_url:
-                    update_in_db(file_id, {
-                        'status': 'completed',
-                        'progress': 100,
-                        'folder': folder_name.strip() if folder_name else None,
-                        'storage_url': storage_url,
-                        'file_path': storage_path,
-                        'completed_at': datetime.utcnow().isoformat()
-                    })
-                    # Warm thumbnail cache in background so clients don't need to wait later
-                    try:
-                        if thumbnail:
-                            threading.Thread(target=cache_thumbnail, args=(thumbnail,)).start()
-                    except Exception as e:
-                        logger.warning(f"Failed to start thumbnail cache thread: {e}")
-                    
-                    try:
-                        mp3_path.unlink()
-                    except:
-                        pass
-                    
-                    logger.info(f"✅ Owner successfully added: {file_id} to folder: {folder_name}")
-                    return True
-                else:
-                    update_in_db(file_id, {
-                        'status': 'error',
-                        'message': 'Storage upload failed',
-                        'error_time': datetime.utcnow().isoformat()
-                    })
-                    return False
+            # Use folder name in storage path
+            if folder_name and folder_name.strip():
+                # Keep original folder name
+                storage_path = f"owner/{folder_name.strip()}/{file_id}{audio_path.suffix}"
+                logger.info(f"📁 Uploading to folder: {folder_name.strip()}, Path: {storage_path}")
             else:
-                update_in_db(file_id, {
+                storage_path = f"owner/{file_id}{audio_path.suffix}"
+                logger.info(f"📁 Uploading to root, Path: {storage_path}")
+                
+            with CONVERSION_STAGE_SECONDS.time(stage='upload'):
+                storage_url = upload_with_retry(audio_path, storage_path, content_type=content_type)
+                uploaded_renditions = upload_renditions(
+                    renditions, f'mp3_{bitrate}', storage_url, storage_path) if storage_url and renditions else None
+            
+            if not storage_url:
+                update_job(file_id, {
                     'status': 'error',
-                    'message': 'MP3 file not found',
+                    'message': 'Storage upload failed',
                     'error_time': datetime.utcnow().isoformat()
                 })
                 return False
+            
+            checkpoint = save_checkpoint(download_dir, file_id, {
+                **checkpoint,
+                'stage': 'uploaded',
+                'file_size': file_size,
+                'storage_url': storage_url,
+                'storage_path': storage_path,
+                'uploaded_renditions': uploaded_renditions,
+            })
+        job.check()
+        
+        storage_url = checkpoint['storage_url']
+        storage_path = checkpoint['storage_path']
+        file_size = checkpoint['file_size']
+        completed = {
+            'status': 'completed',
+            'progress': 100,
+            'folder': folder_name.strip() if folder_name else None,
+            'storage_url': storage_url,
+            'file_path': storage_path,
+            'completed_at': datetime.utcnow().isoformat()
+        }
+        if passthrough_enabled():
+            completed['content_type'] = content_type
+        if checkpoint.get('uploaded_renditions'):
+            completed['renditions'] = checkpoint['uploaded_renditions']
+        hls_files = []
+        # yt-dlp doesn't always know the duration; the file size and bitrate do
+        track_seconds = duration or file_size * 8 / (float(info.get('abr') or bitrate) * 1000)
+        if codec in HLS_CODECS and wants_hls(track_seconds) and audio_path.exists():
+            try:
+                with CONVERSION_STAGE_SECONDS.time(stage='package'):
+                    playlist, segments = package_hls(audio_path, download_dir, file_id)
+                    hls_files = [playlist, *segments]
+                    hls = upload_hls(playlist, segments, file_id, storage_path)
+                if hls:
+                    completed['hls'] = hls
+            except JobCancelled:
+                raise
+            except Exception as e:
+                logger.warning(f"⚠️ HLS packaging failed for {file_id}: {e}")
+        if not update_job(file_id, completed):
+            try:
+                stop_if_cancelled(job)
+            except JobCancelled:
+                # Cancelled while uploading: don't leave the uploads behind
+                uploaded = {**completed, 'file_id': file_id}
+                for path in [storage_path, *rendition_storage_paths(uploaded), *hls_storage_paths(uploaded)]:
+                    delete_from_storage(path)
+                raise
+        # Warm thumbnail cache in background so clients don't need to wait later
+        try:
+            if thumbnail:
+                threading.Thread(target=cache_thumbnail, args=(thumbnail,)).start()
+        except Exception as e:
+            logger.warning(f"Failed to start thumbnail cache thread: {e}")
+        
+        for local_file in [audio_path, *renditions.values(), *hls_files, checkpoint_path(download_dir, file_id)]:
+            try:
+                local_file.unlink()
+            except:
+                pass
+        downloads_index.invalidate(download_dir)
+        
+        logger.info(f"✅ Owner successfully added: {file_id} to folder: {folder_name}")
+        return True
                 
     except Exception as e:
+        # yt-dlp may wrap the JobCancelled raised in its progress hook
+        if job.cancelled:
+            logger.info(f"🛑 Stopped {file_id}: {job.reason}")
+            return False
+        if isinstance(e, Throttled):
+            logger.warning(f"🐢 Re-queueing {file_id}: {e}")
+            # A fresh started_at keeps stuck-job sweeps off the row while
+            # the job waits to retry (see hold_requeued_job)
+            update_job(file_id, {
+                'status': 'queued',
+                'progress': 0,
+                'started_at': datetime.utcnow().isoformat(),
+                'message': f'YouTube is rate limiting, retrying in {e.retry_after:.0f}s'
+            })
+            return None
         logger.error(f"❌ Processing error: {e}")
-        update_in_db(file_id, {
+        update_job(file_id, {
             'status': 'error',
             'message': str(e)[:200],
             'error_time': datetime.utcnow().isoformat()
         })
         return False
 
+# ==========================================
+# Job queue: claims, leases and heartbeats
+# ==========================================
+# With JOB_QUEUE=1, /api/convert only inserts the `queued` row and any number
+# of workers (`python worker.py`, or WEB_QUEUE_WORKERS threads in the web
+# process) drain it. A worker claims a row by moving it to `downloading` with
+# its worker_id and a lease; while the job runs a heartbeat pushes the lease
+# forward. A worker that crashes stops heartbeating, its lease runs out and the
+# row becomes claimable again; the job then resumes from its last checkpoint.
+#
+# Without the queue, JOB_RECOVERY=1 gives inline jobs the same lease, and each
+# web process sweeps for jobs whose process died (a worker timeout or a deploy)
+# and resumes them. Either way a job is given up on after JOB_MAX_ATTEMPTS.
+# Deploys without the lease columns still get a sweep: rows stuck in progress
+# for JOB_STUCK_SECONDS are resumed (see resume_stuck_jobs).
+JOB_QUEUE = os.environ.get('JOB_QUEUE', '0') == '1'
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', '90'))
+JOB_HEARTBEAT_SECONDS = int(os.environ.get('JOB_HEARTBEAT_SECONDS', '20'))
+JOB_POLL_SECONDS = float(os.environ.get('JOB_POLL_SECONDS', '2'))
+# Postgres function doing the claim in one statement (see README); when unset
+# or missing, claims fall back to conditional PATCHes
+JOB_CLAIM_RPC = os.environ.get('JOB_CLAIM_RPC', '').strip()
+JOB_CLAIM_CANDIDATES = 5
+WEB_QUEUE_WORKERS = int(os.environ.get('WEB_QUEUE_WORKERS', '0'))
+JOB_RECOVERY = os.environ.get('JOB_RECOVERY', '0') == '1'
+JOB_RECOVERY_INTERVAL = int(os.environ.get('JOB_RECOVERY_INTERVAL', '60'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))
+# Rows in progress without a lease (e.g. started before leases were enabled)
+# count as stuck after this long
+JOB_STUCK_SECONDS = int(os.environ.get('JOB_STUCK_SECONDS', '1800'))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# Statuses a worker holds a lease on (everything in progress except `queued`)
+LEASED_STATUSES = tuple(s for s in IN_PROGRESS_STATUSES if s != 'queued')
+# Cancellation reason of a job whose row another worker has taken over
+LEASE_LOST = 'lease lost'
+
+_claim_rpc_state = {'failed_at': 0.0}
+
+
+def lease_expiry(seconds=None):
+    return (datetime.utcnow() + timedelta(seconds=seconds or JOB_LEASE_SECONDS)).isoformat()
+
+
+def claim_update(worker_id, attempts):
+    return {
+        'status': 'downloading',
+        'worker_id': worker_id,
+        'lease_expires_at': lease_expiry(),
+        'attempts': attempts,
+    }
+
+
+def claim_job_rpc(worker_id):
+    """Claim through the JOB_CLAIM_RPC function (FOR UPDATE SKIP LOCKED).
+    Returns the row, {} when the queue is empty, or None if the call failed."""
+    rows = db_request('POST', f'rpc/{JOB_CLAIM_RPC}',
+                      {'p_worker': worker_id, 'p_lease_seconds': JOB_LEASE_SECONDS,
+                       'p_stuck_seconds': JOB_STUCK_SECONDS})
+    if rows is None:
+        return None
+    if isinstance(rows, dict):
+        rows = [rows]
+    return rows[0] if rows and rows[0].get('file_id') else {}
+
+
+def claim_job_patch(worker_id, include_queued=True):
+    """Claim with conditional PATCHes: the filter repeats the state we read
+    (status, and for an expired lease its holder and expiry), so when several
+    workers race for a row only the first PATCH matches and returns it."""
+    now = datetime.utcnow()
+    fields = 'file_id,status,worker_id,lease_expires_at,attempts'
+    queued = []
+    if include_queued:
+        queued = db_request('GET', 'conversions', params={
+            'status': 'eq.queued', 'order': 'created_at.asc', 'limit': JOB_CLAIM_CANDIDATES,
+            'select': fields,
+        }) or []
+    expired = db_request('GET', 'conversions', params={
+        'status': f"in.({','.join(LEASED_STATUSES)})", 'lease_expires_at': f'lt.{now.isoformat()}',
+        'order': 'lease_expires_at.asc', 'limit': JOB_CLAIM_CANDIDATES,
+        'select': fields,
+    }) or []
+    stuck = db_request('GET', 'conversions', params={
+        'status': f"in.({','.join(IN_PROGRESS_STATUSES)})", 'worker_id': 'is.null',
+        'started_at': f'lt.{(now - timedelta(seconds=JOB_STUCK_SECONDS)).isoformat()}',
+        'order': 'started_at.asc', 'limit': JOB_CLAIM_CANDIDATES,
+        'select': fields,
+    }) or []
+    for row in [*queued, *expired, *stuck]:
+        conditions = f"file_id=eq.{row['file_id']}&status=eq.{row['status']}"
+        if row.get('worker_id'):
+            conditions += (f"&worker_id=eq.{urllib.parse.quote(row['worker_id'], safe='')}"
+                           f"&lease_expires_at=eq.{urllib.parse.quote(str(row.get('lease_expires_at')), safe='')}")
+        else:
+            conditions += '&worker_id=is.null'
+        claimed = db_request('PATCH', f'conversions?{conditions}',
+                             claim_update(worker_id, (row.get('attempts') or 0) + 1))
+        if claimed:
+            return claimed[0]
+    return {}
+
+
+def claim_job_by_id(file_id, worker_id=WORKER_ID):
+    """Claim one specific queued conversion; None if another worker has it"""
+    claimed = db_request('PATCH', f'conversions?file_id=eq.{file_id}&status=eq.queued&worker_id=is.null',
+                         claim_update(worker_id, 1))
+    return claimed[0] if claimed else None
+
+
+def claim_job(worker_id=WORKER_ID, include_queued=True):
+    """Claim the oldest queued conversion, or one that stopped making progress
+    (expired lease, or stuck without one). Returns its row, or None when there
+    is nothing to do. include_queued=False only recovers dead jobs."""
+    row = None
+    # A missing or broken RPC is retried every few minutes, not on every poll
+    if JOB_CLAIM_RPC and include_queued and time.time() - _claim_rpc_state['failed_at'] > 300:
+        row = claim_job_rpc(worker_id)
+        # Only a 4xx means the function is missing or broken; a timeout, 5xx
+        # or open circuit is an outage that PATCH claims won't get past either
+        status = last_db_status() if row is None else None
+        if status is not None and 400 <= status < 500:
+            _claim_rpc_state['failed_at'] = time.time()
+            logger.warning(f"⚠️ Claim RPC {JOB_CLAIM_RPC} failed ({status}), claiming with PATCH")
+        source = 'rpc'
+    if row is None:
+        row = claim_job_patch(worker_id, include_queued)
+        source = 'patch'
+    if not row:
+        return None
+    JOBS_CLAIMED.inc(source=source)
+    if replica:
+        replica.upsert(row)
+    shared_cache.delete(f"song:{row['file_id']}")
+    logger.info(f"📥 {worker_id} claimed {row['file_id']} (attempt {row.get('attempts') or 1})")
+    return row
+
+
+def release_job(file_id, worker_id=WORKER_ID, attempts=None):
+    """Hand a claimed job back to the queue untouched. Pass the row's
+    `attempts` to take back the claim's attempt: a job that never got to run
+    (no disk, YouTube throttling) shouldn't count towards JOB_MAX_ATTEMPTS."""
+    update = {'status': 'queued', 'worker_id': None, 'lease_expires_at': None}
+    if attempts:
+        update['attempts'] = attempts - 1
+    db_request('PATCH', f"conversions?file_id=eq.{file_id}&worker_id=eq.{urllib.parse.quote(worker_id, safe='')}", update)
+    if replica:
+        replica.patch(file_id, {'status': 'queued'})
+
+
+def hold_lease(file_id, worker_id, done):
+    """Heartbeat: extend the lease every JOB_HEARTBEAT_SECONDS until `done`
+    is set. Stops when the row no longer belongs to this worker."""
+    endpoint = f"conversions?file_id=eq.{file_id}&worker_id=eq.{urllib.parse.quote(worker_id, safe='')}"
+    while not done.wait(JOB_HEARTBEAT_SECONDS):
+        result = db_request('PATCH', endpoint, {'lease_expires_at': lease_expiry()})
+        if result == []:
+            LEASES_LOST.inc()
+            logger.warning(f"⚠️ {worker_id} lost the lease on {file_id}")
+            # Stop working on it; the new holder runs the job from here
+            jobs.cancel(file_id, LEASE_LOST)
+            return
+        if result is None:
+            logger.warning(f"⚠️ Heartbeat for {file_id} failed, retrying")
+
+
+def reap_job(row):
+    """Give up on a job that keeps getting interrupted: fail it and delete its files"""
+    file_id = row['file_id']
+    JOBS_REAPED.inc()
+    logger.warning(f"🪦 Giving up on {file_id} after {JOB_MAX_ATTEMPTS} attempts")
+    update_in_db(file_id, {
+        'status': 'error',
+        'message': f'Conversion was interrupted {JOB_MAX_ATTEMPTS} times',
+        'error_time': datetime.utcnow().isoformat()
+    })
+    cleanup_job_files(row['client_id'], row.get('folder'), file_id)
+    janitor.release(file_id)
+
+
+def run_claimed_job(row, worker_id=WORKER_ID, admitted=False):
+    """Run a claimed conversion with its lease held. Returns None if the job
+    was handed back (no disk, or throttled), otherwise whether it succeeded."""
+    file_id = row['file_id']
+    bitrate = str(row.get('bitrate') or '64')
+    if (row.get('attempts') or 1) > JOB_MAX_ATTEMPTS:
+        reap_job(row)
+        return False
+    if not admitted and not janitor.admit(file_id, expected_job_bytes(bitrate)):
+        JOBS_REJECTED.inc(reason='disk')
+        logger.warning(f"💾 Not enough disk for {file_id}, returning it to the queue")
+        release_job(file_id, worker_id, row.get('attempts'))
+        return None
+    done = threading.Event()
+    heartbeat = threading.Thread(target=hold_lease, args=(file_id, worker_id, done), daemon=True)
+    heartbeat.start()
+    QUEUE_DEPTH.inc()
+    try:
+        success = process_conversion(row['url'], file_id, row['client_id'], row.get('folder'), bitrate)
+    finally:
+        done.set()
+        heartbeat.join()
+    if success is None:
+        release_job(file_id, worker_id, row.get('attempts'))
+    return success
+
+
+def queue_worker(worker_id=WORKER_ID, stop=None):
+    """Claim and run jobs until `stop` is set; one job at a time"""
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        try:
+            # Don't take jobs off the queue while YouTube is throttling us
+            backoff = upstream.backoff_remaining(YOUTUBE_HOST)
+            if backoff:
+                stop.wait(min(backoff, JOB_LEASE_SECONDS))
+                continue
+            row = claim_job(worker_id)
+            if row is None:
+                stop.wait(JOB_POLL_SECONDS)
+                continue
+            if run_claimed_job(row, worker_id) is None:
+                stop.wait(JOB_POLL_SECONDS)
+        except Exception as e:
+            logger.error(f"Queue worker {worker_id} error: {e}")
+            stop.wait(JOB_POLL_SECONDS)
+
+
+def run_inline_job(file_id, worker_id=WORKER_ID):
+    """Run a just-submitted conversion in this process, holding a lease like a
+    queue worker so the recovery sweep can tell it from a job that died"""
+    row = claim_job_by_id(file_id, worker_id)
+    if row is None:
+        janitor.release(file_id)
+        return False
+    return run_claimed_job(row, worker_id, admitted=True)
+
+
+def run_local_job(url, file_id, client_id, folder_name=None, bitrate='64'):
+    """Run a conversion submitted to this process (no JOB_QUEUE). A throttled
+    job waits out YouTube's backoff here and tries again."""
+    while True:
+        if JOB_RECOVERY:
+            success = run_inline_job(file_id)
+        else:
+            QUEUE_DEPTH.inc()
+            success = process_conversion(url, file_id, client_id, folder_name, bitrate)
+        if success is not None:
+            return success
+        if not hold_requeued_job(file_id, client_id, folder_name, bitrate):
+            return False
+
+
+def hold_requeued_job(file_id, client_id, folder_name=None, bitrate='64'):
+    """Wait until a re-queued local job may run again: YouTube's backoff is
+    over and its disk space is admitted. Meanwhile the job stays in `jobs`, so
+    it can be cancelled and this process's sweep skips it. Its started_at is
+    refreshed every JOB_HEARTBEAT_SECONDS, so no other process's sweep resumes
+    or reaps it. Each refresh, the last one included, only matches while the
+    row is still queued with the started_at written before. Returns False if
+    the job was cancelled or the row changed meanwhile. Its files are then
+    deleted, unless another process has resumed it."""
+    job = jobs.start(file_id)
+    token = None
+    admitted = False
+    try:
+        while not job.cancelled:
+            backoff = upstream.backoff_remaining(YOUTUBE_HOST)
+            if not backoff and not admitted:
+                admitted = janitor.admit(file_id, expected_job_bytes(bitrate))
+            now = datetime.utcnow().isoformat()
+            endpoint = f'conversions?file_id=eq.{file_id}&status=eq.queued'
+            if token:
+                endpoint += f"&started_at=eq.{urllib.parse.quote(token, safe='')}"
+            held = db_request('PATCH', endpoint, {'started_at': now})
+            if held:
+                token = now
+                if admitted:
+                    return True
+            elif held is not None:
+                break  # cancelled, deleted, reaped or resumed elsewhere
+            job.wait(min(JOB_HEARTBEAT_SECONDS, max(backoff, JOB_POLL_SECONDS * (1 if admitted else 5))))
+    finally:
+        jobs.finish(file_id)
+    if admitted:
+        janitor.release(file_id)
+    rows = db_request('GET', f'conversions?file_id=eq.{file_id}&select=status')
+    if rows is not None and not (rows and rows[0].get('status') in IN_PROGRESS_STATUSES):
+        cleanup_job_files(client_id, folder_name, file_id)
+    logger.info(f"🛑 Not retrying {file_id}: {job.reason or 'its row changed while it waited'}")
+    return False
+
+
+def recover_jobs(worker_id=WORKER_ID):
+    """Claim every dead job and resume it in the background; returns how many"""
+    recovered = 0
+    while True:
+        row = claim_job(worker_id, include_queued=False)
+        if row is None:
+            break
+        threading.Thread(target=run_claimed_job, args=(row, worker_id), daemon=True).start()
+        recovered += 1
+    if recovered:
+        logger.info(f"♻️ Recovered {recovered} interrupted conversion(s)")
+    return recovered
+
+
+def recovery_loop():
+    """Runs at startup and every JOB_RECOVERY_INTERVAL"""
+    while True:
+        try:
+            recover_jobs()
+        except Exception as e:
+            logger.error(f"Job recovery error: {e}")
+        time.sleep(JOB_RECOVERY_INTERVAL)
+
+def job_files_active(row, within):
+    """True if any of the job's files changed in the last `within` seconds,
+    i.e. some process on this host is still working on it"""
+    cutoff = time.time() - within
+    for path in job_download_dir(row['client_id'], row.get('folder')).glob(f"{row['file_id']}.*"):
+        try:
+            if path.stat().st_mtime > cutoff:
+                return True
+        except OSError:
+            continue
+    return False
+
+
+def resume_stuck_jobs():
+    """Lease-free recovery, for deploys without the lease columns: resume rows
+    still in progress JOB_STUCK_SECONDS after they (re)started whose files
+    have gone quiet. started_at is the claim token, so only one process takes
+    a row. A row stuck for JOB_MAX_ATTEMPTS such periods since it was created
+    is given up on. Returns how many jobs were resumed."""
+    now = datetime.utcnow()
+    rows = db_request('GET', 'conversions', params={
+        'status': f"in.({','.join(IN_PROGRESS_STATUSES)})",
+        'started_at': f'lt.{(now - timedelta(seconds=JOB_STUCK_SECONDS)).isoformat()}',
+        'order': 'started_at.asc', 'limit': JOB_CLAIM_CANDIDATES,
+        'select': 'file_id,status,url,client_id,folder,bitrate,created_at,started_at',
+    }) or []
+    resumed = 0
+    for row in rows:
+        file_id = row['file_id']
+        if jobs.get(file_id) or job_files_active(row, JOB_STUCK_SECONDS):
+            continue
+        bitrate = str(row.get('bitrate') or '64')
+        if not janitor.admit(file_id, expected_job_bytes(bitrate)):
+            break
+        claimed = db_request(
+            'PATCH',
+            f"conversions?file_id=eq.{file_id}&status=eq.{row['status']}"
+            f"&started_at=eq.{urllib.parse.quote(str(row['started_at']), safe='')}",
+            {'started_at': now.isoformat()})
+        if not claimed:
+            janitor.release(file_id)
+            continue
+        try:
+            created = datetime.fromisoformat(str(row['created_at']).replace('Z', '+00:00')).replace(tzinfo=None)
+        except ValueError:
+            created = now
+        if now - created > timedelta(seconds=JOB_STUCK_SECONDS * JOB_MAX_ATTEMPTS):
+            reap_job(row)
+            continue
+        logger.info(f"♻️ Resuming stuck conversion {file_id} ({row['status']})")
+        threading.Thread(target=run_local_job,
+                         args=(row['url'], file_id, row['client_id'], row.get('folder'), bitrate),
+                         daemon=True).start()
+        resumed += 1
+    return resumed
+
+
+def stuck_job_loop():
+    """Runs at startup and every JOB_RECOVERY_INTERVAL"""
+    while True:
+        try:
+            resume_stuck_jobs()
+        except Exception as e:
+            logger.error(f"Stuck job sweep error: {e}")
+        time.sleep(JOB_RECOVERY_INTERVAL)
+
+if JOB_QUEUE:
+    for i in range(WEB_QUEUE_WORKERS):
+        threading.Thread(target=queue_worker, args=(f"{WORKER_ID}:{i}",), daemon=True).start()
+elif JOB_RECOVERY:
+    threading.Thread(target=recovery_loop, daemon=True).start()
+else:
+    # Both loops above already pick up stuck rows without a lease
+    threading.Thread(target=stuck_job_loop, daemon=True).start()
+
 # ==========================================
 # API ENDPOINTS
 # ==========================================
@@ -502,12 +2271,8 @@ def logo_styles():
 def check_owner():
     """Check if current user is owner/admin"""
     client_id = get_client_id()
-    owner_status = is_owner(client_id)
-    
     # If no owner set yet, first user becomes owner
-    if not get_owner_id():
-        set_owner_id(client_id)
-        owner_status = True
+    owner_status = is_owner(client_id)
     
     return jsonify({
         'is_owner': owner_status,
@@ -563,8 +2328,8 @@ def convert():
 
     # Check for duplicate URL (prevent duplicate conversions)
     try:
-        encoded_url = urllib.parse.quote_plus(url)
-        dup = db_request('GET', f'conversions?url=eq.{encoded_url}')
+        # A cancelled conversion doesn't block converting the URL again
+        dup = [d for d in find_conversions_by_url(url) if d.get('status') not in ('cancelled', 'deleting')]
         if dup and len(dup) > 0:
             # Return conflict with existing file info
             existing = dup[0]
@@ -580,6 +2345,19 @@ def convert():
 
     file_id = str(uuid.uuid4())
     
+    # Admission control: reserve disk for the job or ask the client to come back.
+    # Queued jobs are admitted by whichever worker claims them.
+    if not JOB_QUEUE and not janitor.admit(file_id, expected_job_bytes(bitrate)):
+        JOBS_REJECTED.inc(reason='disk')
+        logger.warning(f"💾 Refusing conversion, low disk: {janitor.free_bytes() / (1024 * 1024):.0f} MB free")
+        response = jsonify({
+            'error': 'Server is low on disk space',
+            'message': 'Too many conversions are in progress, try again in a minute.',
+            'retry_after': 60
+        })
+        response.headers['Retry-After'] = '60'
+        return response, 507
+    
     # Save initial data
     initial_data = {
         'file_id': file_id,
@@ -594,15 +2372,17 @@ def convert():
     }
     
     if not save_to_db(initial_data):
+        janitor.release(file_id)
         return jsonify({'error': 'Failed to save to database'}), 500
     
-    # Start processing
-    thread = threading.Thread(
-        target=process_conversion,
-        args=(url, file_id, client_id, folder_name, bitrate)
-    )
-    thread.daemon = True
-    thread.start()
+    # Start processing, unless the queue workers will pick it up
+    if not JOB_QUEUE:
+        thread = threading.Thread(
+            target=run_local_job,
+            args=(url, file_id, client_id, folder_name, bitrate)
+        )
+        thread.daemon = True
+        thread.start()
     
     return jsonify({
         'file_id': file_id,
@@ -617,6 +2397,8 @@ def status(file_id):
     song = get_from_db(file_id)
     if not song:
         return jsonify({'error': 'Not found'}), 404
+    if served_stale():
+        song = {**song, 'stale': True}
     return jsonify(song)
 
 @app.route('/api/status')
@@ -626,12 +2408,12 @@ def all_status():
     
     if is_owner(client_id):
         # Owner sees all
-        result = db_request('GET', f'conversions?order=created_at.desc')
+        result = get_all_conversions()
     else:
         # Users see only completed songs
-        result = db_request('GET', f'conversions?status=eq.completed&order=created_at.desc')
+        result = get_all_songs()
     
-    return jsonify({'statuses': result if result else []})
+    return jsonify({'statuses': result, 'stale': served_stale()})
 
 @app.route('/api/download/<file_id>')
 def download(file_id):
@@ -646,6 +2428,266 @@ def download(file_id):
     
     return jsonify({'error': 'Download URL not available'}), 404
 
+# ==========================================
+# Job cancellation
+# ==========================================
+# Cancelling marks the row `cancelled`; the job's own progress updates never
+# overwrite that (update_job). A job running in this process is stopped at
+# once; the others are found by each process's watcher within
+# JOB_CANCEL_POLL_SECONDS. A stopped job's partial files are deleted and its
+# disk reservation and worker slot are freed.
+JOB_CANCEL_POLL_SECONDS = float(os.environ.get('JOB_CANCEL_POLL_SECONDS', '2'))
+JOB_CANCEL_BATCH_MAX = 100
+
+
+def cancel_jobs(file_ids):
+    """Cancel conversions that are queued or running. Returns the file_ids
+    that were cancelled, or None if the database couldn't be reached."""
+    rows = db_request(
+        'PATCH',
+        f"conversions?file_id=in.({','.join(file_ids)})&status=in.({','.join(IN_PROGRESS_STATUSES)})",
+        {'status': 'cancelled', 'message': 'Cancelled', 'error_time': datetime.utcnow().isoformat()})
+    if rows is None:
+        return None
+    cancelled = [row['file_id'] for row in rows]
+    for file_id in cancelled:
+        if replica:
+            replica.patch(file_id, {'status': 'cancelled'})
+        shared_cache.delete(f'song:{file_id}')
+        jobs.cancel(file_id)
+    if cancelled:
+        invalidate_library()
+    return cancelled
+
+
+def cancel_watch_loop():
+    """Stop jobs of this process that were cancelled or deleted through another one"""
+    while True:
+        time.sleep(JOB_CANCEL_POLL_SECONDS)
+        running = jobs.ids()
+        if not running:
+            continue
+        try:
+            rows = db_request('GET', f"conversions?file_id=in.({','.join(running)})"
+                                     "&status=in.(cancelled,deleting)&select=file_id,status")
+            for row in rows or []:
+                jobs.cancel(row['file_id'], 'cancelled' if row['status'] == 'cancelled' else 'deleted')
+        except Exception as e:
+            logger.error(f"Cancel watcher error: {e}")
+
+threading.Thread(target=cancel_watch_loop, daemon=True).start()
+
+
+@app.route('/api/jobs/<file_id>', methods=['DELETE'])
+def cancel_job(file_id):
+    """Cancel a queued or running conversion - Owner only"""
+    if not is_owner(get_client_id()):
+        return jsonify({'error': 'Only the owner can cancel conversions'}), 403
+    if not FILE_ID_RE.match(file_id):
+        return jsonify({'error': 'Invalid file_id'}), 400
+    cancelled = cancel_jobs([file_id])
+    if cancelled is None:
+        return jsonify({'error': 'Database unavailable'}), 503
+    if not cancelled:
+        song = get_from_db(file_id)
+        if not song:
+            return jsonify({'error': 'Conversion not found'}), 404
+        return jsonify({'error': 'Conversion is not in progress', 'status': song.get('status')}), 409
+    return jsonify({'success': True, 'file_id': file_id, 'status': 'cancelled'})
+
+
+@app.route('/api/jobs', methods=['DELETE'])
+def cancel_job_batch():
+    """Cancel several conversions: {"file_ids": [...]} - Owner only"""
+    if not is_owner(get_client_id()):
+        return jsonify({'error': 'Only the owner can cancel conversions'}), 403
+    file_ids = (request.get_json(silent=True) or {}).get('file_ids')
+    if not isinstance(file_ids, list) or not file_ids:
+        return jsonify({'error': 'file_ids (a list) is required'}), 400
+    if len(file_ids) > JOB_CANCEL_BATCH_MAX:
+        return jsonify({'error': f'At most {JOB_CANCEL_BATCH_MAX} file_ids per request'}), 400
+    file_ids = list(dict.fromkeys(str(f) for f in file_ids))
+    valid = [f for f in file_ids if FILE_ID_RE.match(f)]
+    cancelled = cancel_jobs(valid) if valid else []
+    if cancelled is None:
+        return jsonify({'error': 'Database unavailable'}), 503
+    return jsonify({
+        'success': True,
+        'cancelled': cancelled,
+        'not_cancelled': [f for f in file_ids if f not in cancelled],
+    })
+
+# ==========================================
+# Trash: deferred deletes
+# ==========================================
+# Deleting a song or folder only marks its rows 'deleting', which hides them
+# from every read at once, and moves the folder's directory into
+# downloads/.trash. Storage objects, DB rows and files are removed later by
+# purge_trash() in the background, in batches. The 'deleting' rows and .trash
+# are the queue: nothing is lost on a restart. A song whose Storage delete
+# fails is retried with exponential backoff (the row's error_time holds when it
+# is due again, so one bounded query finds the due batch) and, after
+# TRASH_MAX_ATTEMPTS, marked 'error' so the owner sees it and can delete it
+# again. While the Storage circuit is open nothing is purged or counted.
+TRASH_DIR = DOWNLOADS_DIR / '.trash'
+TRASH_PURGE_INTERVAL = int(os.environ.get('TRASH_PURGE_INTERVAL', '30'))
+TRASH_BATCH_SIZE = int(os.environ.get('TRASH_BATCH_SIZE', '50'))
+TRASH_MAX_ATTEMPTS = int(os.environ.get('TRASH_MAX_ATTEMPTS', '5'))
+TRASH_RETRY_MAX_SECONDS = 3600
+_trash_wakeup = threading.Event()
+
+
+def trash_rows(filters):
+    """Mark the conversions matching PostgREST `filters` as deleting and stop
+    their jobs. Returns the rows, or None if the database couldn't be reached."""
+    rows = db_request('PATCH', f'conversions?{filters}&status=neq.deleting',
+                      {'status': 'deleting', 'message': 'Deleting'})
+    if rows is None:
+        return None
+    if replica and rows:
+        replica.upsert(rows)
+    for row in rows:
+        shared_cache.delete(f"song:{row['file_id']}")
+        jobs.cancel(row['file_id'], 'deleted')
+    invalidate_library()
+    _trash_wakeup.set()
+    return rows
+
+
+def move_to_trash(path):
+    """Take a directory out of the library with one rename; the purger deletes it"""
+    TRASH_DIR.mkdir(exist_ok=True)
+    path.rename(TRASH_DIR / f'{uuid.uuid4().hex}-{path.name}')
+    downloads_index.invalidate(path)
+    _trash_wakeup.set()
+
+
+def remove_tree(path):
+    """shutil.rmtree that also removes read-only files (Windows). Returns
+    whether the directory is gone."""
+    def handle_remove_readonly(func, path, exc):
+        excvalue = exc[1]
+        if func in (os.rmdir, os.remove, os.unlink) and excvalue.errno == errno.EACCES:
+            os.chmod(path, stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO)  # 0777
+            func(path)
+        else:
+            raise
+
+    try:
+        shutil.rmtree(path, onerror=handle_remove_readonly)
+        return True
+    except OSError as e:
+        logger.error(f"❌ Error deleting {path}: {e}")
+        return False
+
+
+def due_trash_rows():
+    """Up to TRASH_BATCH_SIZE deleting songs, oldest first, leaving out those
+    still backing off after a failed purge"""
+    return db_request('GET', 'conversions', params={
+        'status': 'eq.deleting',
+        'or': f'(error_time.is.null,error_time.lt.{datetime.utcnow().isoformat()})',
+        'order': 'created_at.asc,file_id.asc', 'limit': TRASH_BATCH_SIZE,
+    }) or []
+
+
+def trash_failed(row):
+    """Back off a song that couldn't be purged; give up after TRASH_MAX_ATTEMPTS"""
+    file_id = row['file_id']
+    key = f'trash_attempts:{file_id}'
+    attempts = int(shared_cache.get(key) or 0) + 1
+    if attempts >= TRASH_MAX_ATTEMPTS:
+        logger.error(f"❌ Giving up on purging {file_id} after {attempts} attempts")
+        shared_cache.delete(key)
+        update_in_db(file_id, {
+            'status': 'error',
+            'message': 'Could not delete from storage, delete it again to retry',
+            'error_time': datetime.utcnow().isoformat()
+        }, conditions='&status=eq.deleting')
+        return
+    delay = min(TRASH_RETRY_MAX_SECONDS, TRASH_PURGE_INTERVAL * 2 ** (attempts - 1))
+    logger.warning(f"⚠️ Could not purge {file_id} from storage, retrying in {delay}s")
+    shared_cache.set(key, str(attempts), ttl=TRASH_RETRY_MAX_SECONDS * TRASH_MAX_ATTEMPTS)
+    update_in_db(file_id, {
+        'message': f'Could not delete from storage, retrying in {delay}s',
+        'error_time': (datetime.utcnow() + timedelta(seconds=delay)).isoformat()
+    }, conditions='&status=eq.deleting')
+
+
+def purge_trash():
+    """One purge pass: up to TRASH_BATCH_SIZE deleting songs, then the trashed
+    directories. Returns how many songs it tried to purge (fewer than a batch
+    when Storage is down)."""
+    rows = due_trash_rows()
+    purged = []
+    tried = 0
+    for row in rows:
+        # Storage is down: wait for the circuit instead of using up attempts
+        if storage_circuit.retry_after() > 0:
+            break
+        tried += 1
+        file_id = row['file_id']
+        paths = [row['file_path']] if row.get('file_path') else []
+        paths += rendition_storage_paths(row) + hls_storage_paths(row)
+        # A list, not a generator: try every object even after one fails
+        if not all([delete_from_storage(path) for path in paths]):
+            if storage_circuit.state != breaker.CLOSED:
+                break
+            trash_failed(row)
+            continue
+        cleanup_job_files(row['client_id'], row.get('folder'), file_id)
+        purged.append(file_id)
+    if purged and db_request('DELETE', f"conversions?file_id=in.({','.join(purged)})&status=eq.deleting"):
+        for file_id in purged:
+            if replica:
+                replica.delete(file_id)
+            shared_cache.delete(f'song:{file_id}')
+            shared_cache.delete(f'trash_attempts:{file_id}')
+        TRASH_PURGED.inc(len(purged), kind='song')
+        logger.info(f"🗑️ Purged {len(purged)} deleted song(s)")
+
+    if TRASH_DIR.exists():
+        for entry in TRASH_DIR.iterdir():
+            if not entry.is_dir():
+                entry.unlink(missing_ok=True)
+            elif remove_tree(entry):
+                TRASH_PURGED.inc(kind='folder')
+    return tried
+
+
+def claim_purger():
+    """True if this process is the host's purger. Like the janitor's marker,
+    but the marker also names its owner: others leave the trash alone until
+    the owner hasn't refreshed it for three intervals."""
+    marker = DOWNLOADS_DIR / '.trash-purger'
+    try:
+        owner = marker.read_text()
+        age = time.time() - marker.stat().st_mtime
+    except OSError:
+        owner, age = None, float('inf')
+    if owner != WORKER_ID and age < 3 * TRASH_PURGE_INTERVAL:
+        return False
+    tmp = marker.with_name(f'.trash-purger.{os.getpid()}')
+    tmp.write_text(WORKER_ID)
+    tmp.replace(marker)
+    return True
+
+
+def trash_loop():
+    """Purge every TRASH_PURGE_INTERVAL, or right after something was deleted
+    in this process; only the host's purger (claim_purger) does the work"""
+    while True:
+        _trash_wakeup.wait(TRASH_PURGE_INTERVAL)
+        _trash_wakeup.clear()
+        try:
+            # Keep going while full batches come back, refreshing the marker
+            while claim_purger() and purge_trash() == TRASH_BATCH_SIZE:
+                pass
+        except Exception as e:
+            logger.error(f"Trash purge error: {e}")
+
+threading.Thread(target=trash_loop, daemon=True).start()
+
 # ==========================================
 # FIXED: Play Endpoint - Now returns direct audio URL
 # ==========================================
@@ -668,19 +2710,67 @@ def play(file_id):
             logger.error(f"❌ No storage URL for: {file_id}")
             return jsonify({'error': 'Audio URL not available'}), 404
         
-        logger.info(f"🎵 Playing {file_id}: {storage_url}")
-        
-        # Return the direct audio URL for HTML5 audio player
-        return jsonify({
-            'url': storage_url,
-            'title': song.get('title', 'Audio'),
-            'success': True
-        })
+        # Return the direct audio URL for HTML5 audio player, picking the
+        # rendition that suits the client's hints when there are several
+        payload = play_payload(song, rendition_hints(request.args, request.headers))
+        logger.info(f"🎵 Playing {file_id}: {payload['url']}")
+        return jsonify(payload)
     
     except Exception as e:
         logger.error(f"❌ Error in play endpoint: {e}")
         return jsonify({'error': str(e)}), 500
 
+# Most tracks one /api/play/batch request resolves
+PLAY_BATCH_MAX = int(os.environ.get('PLAY_BATCH_MAX', '500'))
+FILE_ID_RE = re.compile(r'^[\w-]+$')
+
+
+def play_batch_response(args, headers, body):
+    """(payload, status) for /api/play/batch (shared with the ASGI route).
+    Resolves the listed file_ids, or every song in ?folder= / "folder",
+    to /api/play payloads in queue order."""
+    hints = rendition_hints(args, headers)
+    folder = args.get('folder', body.get('folder'))
+    if folder is not None:
+        ordered = get_songs_by_folder(None if folder in ('', 'root') else folder)[:PLAY_BATCH_MAX]
+        file_ids = [song['file_id'] for song in ordered]
+        songs = {song['file_id']: song for song in ordered}
+    else:
+        file_ids = body.get('file_ids')
+        if not isinstance(file_ids, list) or not file_ids:
+            return {'error': 'file_ids (a list) or folder is required'}, 400
+        if len(file_ids) > PLAY_BATCH_MAX:
+            return {'error': f'At most {PLAY_BATCH_MAX} file_ids per request'}, 400
+        file_ids = list(dict.fromkeys(str(f) for f in file_ids))
+        songs = get_songs_by_ids([f for f in file_ids if FILE_ID_RE.match(f)])
+
+    tracks, unavailable = [], []
+    for file_id in file_ids:
+        song = songs.get(file_id)
+        if not song or song.get('status') != 'completed' or not song.get('storage_url'):
+            unavailable.append(file_id)
+            continue
+        track = play_payload(song, hints)
+        track.update(file_id=file_id, duration=song.get('duration', 0), thumbnail=song.get('thumbnail'),
+                     folder=song.get('folder'))
+        tracks.append(track)
+    return {'success': True, 'tracks': tracks, 'unavailable': unavailable}, 200
+
+
+@app.route('/api/play/batch', methods=['POST', 'OPTIONS'])
+def play_batch():
+    """Resolve a whole play queue in one request so the player can switch
+    tracks without a round trip: {"file_ids": [...]} or {"folder": "..."}"""
+    if request.method == 'OPTIONS':
+        return '', 200
+    try:
+        payload, status_code = play_batch_response(request.args, request.headers,
+                                                   request.get_json(silent=True) or {})
+        return jsonify(payload), status_code
+    except Exception as e:
+        logger.error(f"❌ Error in play batch endpoint: {e}")
+        return jsonify({'error': str(e)}), 500
+
 # ==========================================
 # FIXED: Folder Management Endpoints - SIMPLE AND WORKING
 # ==========================================
@@ -707,6 +2797,7 @@ def handle_folders():
         # Create the folder in downloads directory
         folder_path = DOWNLOADS_DIR / client_id / folder_name
         folder_path.mkdir(parents=True, exist_ok=True)
+        downloads_index.invalidate(folder_path)
         
         logger.info(f"📁 Owner {client_id} created folder: {folder_path}")
         
@@ -737,106 +2828,47 @@ def handle_folders():
             logger.error(f"❌ Folder does not exist: {folder_path}")
             return jsonify({'error': f'Folder "{folder_name}" does not exist'}), 404
         
-        logger.info(f"🗑️ Starting folder deletion: {folder_name} at path: {folder_path}")
-        
-        # FIXED: Get ALL songs from the folder regardless of status
-        all_songs_result = db_request('GET', f'conversions?folder=eq.{folder_name}')
-        songs_in_folder = all_songs_result if all_songs_result else []
-        
-        logger.info(f"📊 Found {len(songs_in_folder)} total songs in folder '{folder_name}' (all statuses)")
-        
-        deleted_count = 0
-        error_count = 0
+        logger.info(f"🗑️ Deleting folder: {folder_name} at path: {folder_path}")
         
-        # Delete all songs from the folder (all statuses)
-        for song in songs_in_folder:
-            file_id = song.get('file_id')
-            storage_path = song.get('file_path')
-            
-            # Log song details for debugging
-            logger.info(f"🗑️ Processing song: {file_id}, status: {song.get('status')}, storage: {storage_path}")
-            
-            # Delete from storage if path exists
-            if storage_path:
-                logger.info(f"🗑️ Deleting from storage: {storage_path}")
-                if not delete_from_storage(storage_path):
-                    error_count += 1
-                    logger.error(f"❌ Failed to delete from storage: {storage_path}")
-            
-            # Delete from database
-            logger.info(f"🗑️ Deleting from database: {file_id}")
-            result = db_request('DELETE', f'conversions?file_id=eq.{file_id}')
-            if result:
-                deleted_count += 1
-                logger.info(f"✅ Deleted from database: {file_id}")
-            else:
-                error_count += 1
-                logger.error(f"❌ Failed to delete from database: {file_id}")
+        # One PATCH however big the folder is; Storage objects, DB rows and
+        # files are purged in the background (see purge_trash)
+        songs_in_folder = trash_rows(f"folder=eq.{urllib.parse.quote(folder_name, safe='')}")
+        if songs_in_folder is None:
+            return jsonify({'success': False, 'error': 'Failed to delete folder from database'}), 500
         
-        # FIXED: Windows-compatible folder deletion with proper error handling
-        logger.info(f"🗑️ Attempting to delete folder from filesystem: {folder_path}")
         try:
-            # First, change file permissions to ensure we can delete
-            for root, dirs, files in os.walk(folder_path):
-                for file in files:
-                    file_path = Path(root) / file
-                    try:
-                        # On Windows, we need to ensure the file is not read-only
-                        os.chmod(file_path, 0o777)
-                    except:
-                        pass  # Ignore permission errors on some files
-            
-            # Now try to delete the folder
-            try:
-                shutil.rmtree(folder_path)
-                logger.info(f"✅ Successfully deleted folder from filesystem: {folder_path}")
-            except PermissionError as pe:
-                logger.warning(f"⚠️ Permission error, trying alternative method: {pe}")
-                # Try alternative method for Windows
-                import stat
-                import errno
-                
-                def handle_remove_readonly(func, path, exc):
-                    excvalue = exc[1]
-                    if func in (os.rmdir, os.remove, os.unlink) and excvalue.errno == errno.EACCES:
-                        os.chmod(path, stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO)  # 0777
-                        func(path)
-                    else:
-                        raise
-                
-                shutil.rmtree(folder_path, onerror=handle_remove_readonly)
-                logger.info(f"✅ Successfully deleted folder using alternative method: {folder_path}")
-                
-        except Exception as e:
-            logger.error(f"❌ Error deleting folder {folder_path}: {e}")
-            error_count += 1
+            move_to_trash(folder_path)
+        except OSError as e:
+            logger.error(f"❌ Error moving folder {folder_path} to trash: {e}")
             return jsonify({
                 'success': False,
                 'error': f'Failed to delete folder from filesystem: {str(e)}',
-                'deleted_count': deleted_count,
-                'error_count': error_count
+                'deleted_count': len(songs_in_folder),
+                'error_count': 1
             }), 500
         
-        logger.info(f"✅ Folder deletion completed: '{folder_name}'. {deleted_count} songs removed, {error_count} errors.")
+        logger.info(f"✅ Folder '{folder_name}' moved to trash with {len(songs_in_folder)} songs")
         
         return jsonify({
             'success': True,
-            'message': f'Folder "{folder_name}" deleted. {deleted_count} songs removed.',
-            'deleted_count': deleted_count,
-            'error_count': error_count
-        })
+            'message': f'Folder "{folder_name}" deleted. {len(songs_in_folder)} songs removed.',
+            'deleted_count': len(songs_in_folder),
+            'error_count': 0
+        }), 202
     
     elif request.method == 'GET':
         # Get list of existing folders - ALL USERS CAN SEE FOLDERS
         folders = get_existing_folders(client_id)
-        return jsonify({'folders': folders})
+        return jsonify({'folders': folders, 'stale': served_stale()})
 
 # ==========================================
 # FIXED: get_existing_folders() function for BOTH owner and users
 # ==========================================
 
-def get_existing_folders(client_id):
-    """Get list of existing folders - SHOWS FOLDERS FOR ALL USERS (OPTIMIZED)"""
+def get_existing_folders(client_id, all_songs=None, stale=False):
+    """Get list of existing folders - SHOWS FOLDERS FOR ALL USERS (OPTIMIZED)
+    `all_songs` lets callers that already fetched completed songs skip the DB query;
+    `stale` says they are last known good rows, which aren't cached."""
     if not client_id:
         return []
     
@@ -848,27 +2880,36 @@ def get_existing_folders(client_id):
     
     # Try to get folders from database first
     db_folders = []
+    summary_key = library_cache_key('folder_summaries')
     try:
-        if SUPABASE_URL and SUPABASE_KEY:
+        cached = shared_cache.get_json(summary_key) if all_songs is None else None
+        if cached:
+            CACHE_REQUESTS.inc(cache='library', result='hit')
+            db_folders = [dict(f) for f in cached]
+            all_songs = []
+        elif all_songs is None and SUPABASE_URL and SUPABASE_KEY:
+            CACHE_REQUESTS.inc(cache='library', result='miss')
             # OPTIMIZED: Get all completed songs ONCE instead of N+1 queries
             all_songs = get_all_songs()
+
+        if all_songs:
+            # Count songs by folder in memory (fast!)
+            folder_counts = {}
+            for song in all_songs:
+                folder = song.get('folder')
+                if folder and folder.strip():
+                    folder = folder.strip()
+                    folder_counts[folder] = folder_counts.get(folder, 0) + 1
             
-            if all_songs:
-                # Count songs by folder in memory (fast!)
-                folder_counts = {}
-                for song in all_songs:
-                    folder = song.get('folder')
-                    if folder and folder.strip():
-                        folder = folder.strip()
-                        folder_counts[folder] = folder_counts.get(folder, 0) + 1
-                
-                # Create folder entries from counts
-                for folder_name, file_count in folder_counts.items():
-                    db_folders.append({
-                        'name': folder_name,
-                        'file_count': file_count,
-                        'path': f"owner/{folder_name}"
-                    })
+            # Create folder entries from counts
+            for folder_name, file_count in folder_counts.items():
+                db_folders.append({
+                    'name': folder_name,
+                    'file_count': file_count,
+                    'path': f"owner/{folder_name}"
+                })
+            if not (stale or served_stale()):
+                shared_cache.set_json(summary_key, db_folders, ttl=LIBRARY_CACHE_TTL)
     except Exception as e:
         logger.error(f"Error getting folders from database: {e}")
     
@@ -882,13 +2923,13 @@ def get_existing_folders(client_id):
             
             # List all directories in the owner's downloads folder
             if base_dir.exists():
-                for item in base_dir.iterdir():
-                    if item.is_dir() and item.name != '.git' and item.name != '__pycache__':  # Skip hidden dirs
+                for item in list_subdirs(base_dir):
+                    if item.name != '.git' and item.name != '__pycache__':  # Skip hidden dirs
                         # Check if folder already in list (from database)
                         existing = next((f for f in db_folders if f['name'] == item.name), None)
                         
                         # Check filesystem for MP3 files
-                        mp3_files = list(item.glob('*.mp3'))
+                        mp3_files = list_mp3s(item)
                         file_count_from_fs = len(mp3_files)
                         
                         if existing:
@@ -914,19 +2955,18 @@ def get_existing_folders(client_id):
             # Scan the downloads directory for any subdirectories with MP3 files
             downloads_root = DOWNLOADS_DIR
             if downloads_root.exists():
-                for user_dir in downloads_root.iterdir():
-                    if user_dir.is_dir():
-                        for folder_dir in user_dir.iterdir():
-                            if folder_dir.is_dir() and folder_dir.name != '__pycache__':
-                                mp3_files = list(folder_dir.glob('**/*.mp3'))
-                                if mp3_files:
-                                    # Check if not already in list
-                                    if not any(f['name'] == folder_dir.name for f in db_folders):
-                                        db_folders.append({
-                                            'name': folder_dir.name,
-                                            'file_count': len(mp3_files),
-                                            'path': str(folder_dir)
-                                        })
+                for user_dir in list_subdirs(downloads_root):
+                    for folder_dir in list_subdirs(user_dir):
+                        if folder_dir.name != '__pycache__':
+                            mp3_files = list_mp3s(folder_dir, recursive=True)
+                            if mp3_files:
+                                # Check if not already in list
+                                if not any(f['name'] == folder_dir.name for f in db_folders):
+                                    db_folders.append({
+                                        'name': folder_dir.name,
+                                        'file_count': len(mp3_files),
+                                        'path': str(folder_dir)
+                                    })
         except Exception as e:
             logger.error(f"Error in fallback filesystem scan: {e}")
     
@@ -939,6 +2979,28 @@ def get_existing_folders(client_id):
     return folders
 
 
+def thumbnail_cache_file(url: str):
+    """Cache path for a thumbnail URL: sha256 of the URL plus its extension (default .jpg)"""
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    ext = '.jpg'
+    parsed = urllib.parse.urlparse(url)
+    if parsed.path:
+        pext = Path(parsed.path).suffix
+        if pext and len(pext) <= 5:
+            ext = pext
+    return DOWNLOADS_DIR / '.thumbcache' / f"{key}{ext}"
+
+
+def mimetype_for_path(p: Path):
+    """Map an image file extension to its mimetype"""
+    ext = p.suffix.lower()
+    if ext in ('.jpg', '.jpeg'): return 'image/jpeg'
+    if ext == '.png': return 'image/png'
+    if ext == '.webp': return 'image/webp'
+    if ext == '.gif': return 'image/gif'
+    return 'application/octet-stream'
+
+
 def cache_thumbnail(url: str, force=False):
     """Download and cache a thumbnail into downloads/.thumbcache to warm proxy.
     Non-blocking caller should start this in a thread.
@@ -947,28 +3009,25 @@ def cache_thumbnail(url: str, force=False):
         if not url or not (url.startswith('http://') or url.startswith('https://')):
             return False
 
-        cache_dir = DOWNLOADS_DIR / '.thumbcache'
+        cache_file = thumbnail_cache_file(url)
+        cache_dir = cache_file.parent
         cache_dir.mkdir(parents=True, exist_ok=True)
-
-        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
-        parsed = urllib.parse.urlparse(url)
-        ext = '.jpg'
-        if parsed.path:
-            pext = Path(parsed.path).suffix
-            if pext and len(pext) <= 5:
-                ext = pext
-
-        cache_file = cache_dir / f"{key}{ext}"
+        key = cache_file.stem
 
         # If already cached recently and not forced, skip
         if cache_file.exists() and not force and (time.time() - cache_file.stat().st_mtime) < 86400:
             logger.info(f"Thumbnail already cached (fresh): {url}")
+            CACHE_REQUESTS.inc(cache='thumbnail', result='hit')
             return True
 
+        CACHE_REQUESTS.inc(cache='thumbnail', result='miss')
         headers = {'User-Agent': 'TuneVerse/1.0 (+https://example.com)'}
-        resp = requests.get(url, headers=headers, stream=True, timeout=10)
+        UPSTREAM_REQUESTS.inc(upstream='thumbnail')
+        with profiling.timed('http'):
+            resp = requests.get(url, headers=headers, stream=True, timeout=10)
         if resp.status_code != 200:
             logger.warning(f"Failed to prefetch thumbnail {url}: status {resp.status_code}")
+            UPSTREAM_ERRORS.inc(upstream='thumbnail')
             return False
 
         tmp_path = cache_dir / f"{key}.tmp"
@@ -1012,6 +3071,84 @@ def derive_youtube_thumb(source_url: str):
     return None
 
 
+def collage_key(folder_name: str):
+    """Stable hash used for collage file names (local cache and storage)."""
+    return hashlib.sha256(folder_name.encode('utf-8')).hexdigest()
+
+
+def collage_cache_file(folder_name: str):
+    """Local path of the cached collage JPEG for a folder."""
+    return DOWNLOADS_DIR / '.thumbcache' / f"collage_{collage_key(folder_name)}.jpg"
+
+
+# --- Folder collage URL map ---
+# folder -> collage_url map, loaded with a single folder_collages query and
+# kept in the shared cache for COLLAGE_URL_MAP_TTL seconds, so one worker's
+# load or new collage is seen by all of them.
+COLLAGE_URL_MAP_TTL = int(os.environ.get('COLLAGE_URL_MAP_TTL', '300'))
+COLLAGE_URLS_KEY = 'collage_urls'
+
+
+def collage_urls_fresh():
+    """True if a collage URL map loaded within COLLAGE_URL_MAP_TTL is cached."""
+    return shared_cache.get(COLLAGE_URLS_KEY) is not None
+
+
+def load_collage_urls(force=False):
+    """Return a copy of the folder -> collage_url map, reloading it if stale."""
+    if not force:
+        cached = shared_cache.get_json(COLLAGE_URLS_KEY)
+        if cached is not None:
+            return dict(cached)
+
+    entries = db_request('GET', 'folder_collages?select=folder,collage_url')
+    if entries is None and replica_ready():
+        # Supabase unreachable: fall back to the replicated table
+        entries = replica.collages()
+    return store_collage_urls(entries)
+
+
+def store_collage_urls(entries):
+    """Replace the map with a folder_collages query result and return a copy.
+    A failed query (None) keeps the previous map."""
+    if not isinstance(entries, list):
+        return dict(shared_cache.get_json(COLLAGE_URLS_KEY) or {})
+    urls = {e['folder']: e['collage_url'] for e in entries if e.get('folder') and e.get('collage_url')}
+    shared_cache.set_json(COLLAGE_URLS_KEY, urls, ttl=COLLAGE_URL_MAP_TTL)
+    logger.info(f"📸 Loaded {len(urls)} collage URLs")
+    return dict(urls)
+
+
+def get_collage_url(folder_name):
+    """Look up the stored collage URL for a folder from the shared map."""
+    url = load_collage_urls().get(folder_name)
+    CACHE_REQUESTS.inc(cache='collage', result='hit' if url else 'miss')
+    return url
+
+
+def remember_collage_url(folder_name, url):
+    """Record a freshly written collage URL in the shared map."""
+    urls = shared_cache.get_json(COLLAGE_URLS_KEY)
+    if urls is not None:
+        urls = dict(urls)
+        urls[folder_name] = url
+        shared_cache.set_json(COLLAGE_URLS_KEY, urls, ttl=COLLAGE_URL_MAP_TTL)
+
+
+def save_collage_url(folder_name, url):
+    """Upsert a folder's collage URL (folder_collages has a unique index on folder)."""
+    data = {
+        'folder': folder_name,
+        'collage_url': url,
+        'created_at': datetime.utcnow().isoformat()
+    }
+    result = db_request('POST', 'folder_collages?on_conflict=folder', data,
+                        prefer='resolution=merge-duplicates')
+    if result and replica:
+        replica.upsert_collage(folder_name, url)
+    return bool(result)
+
+
 def generate_collage_for_folder(folder_name: str, max_tiles=9, size=360):
     """Generate a square collage image for a folder from up to `max_tiles` thumbnail URLs.
     Returns path to cached collage image or None on failure.
@@ -1022,15 +3159,16 @@ def generate_collage_for_folder(folder_name: str, max_tiles=9, size=360):
             return None
         
         logger.info(f"📸 Generating collage for folder: {folder_name}")
-        cache_dir = DOWNLOADS_DIR / '.thumbcache'
-        cache_dir.mkdir(parents=True, exist_ok=True)
-        key = hashlib.sha256(folder_name.encode('utf-8')).hexdigest()
-        collage_file = cache_dir / f"collage_{key}.jpg"
+        collage_file = collage_cache_file(folder_name)
+        collage_file.parent.mkdir(parents=True, exist_ok=True)
+        key = collage_key(folder_name)
 
         # If exists and fresh (24h), return immediately
         if collage_file.exists() and (time.time() - collage_file.stat().st_mtime) < 86400:
             logger.info(f"✅ Using cached collage file for {folder_name}: {collage_file}")
+            CACHE_REQUESTS.inc(cache='collage_file', result='hit')
             return str(collage_file)
+        CACHE_REQUESTS.inc(cache='collage_file', result='miss')
 
         # Get song thumbnails for folder
         songs = []
@@ -1089,7 +3227,8 @@ def generate_collage_for_folder(folder_name: str, max_tiles=9, size=360):
         images = []
         for url in thumbs[:max_tiles]:
             try:
-                resp = requests.get(url, headers={'User-Agent': 'TuneVerse/1.0'}, timeout=6, stream=True)
+                with profiling.timed('http'):
+                    resp = requests.get(url, headers={'User-Agent': 'TuneVerse/1.0'}, timeout=6, stream=True)
                 if resp.status_code == 200:
                     data = resp.content
                     img = Image.open(BytesIO(data)).convert('RGB')
@@ -1172,36 +3311,20 @@ def generate_collage_for_folder(folder_name: str, max_tiles=9, size=360):
                 content = cf.read()
             # Storage path: owner/folder_collages/<hash>.jpg
             storage_path = f"owner/folder_collages/collage_{key}.jpg"
-            public_url = upload_bytes_to_storage(content, storage_path, content_type='image/jpeg')
+            public_url = upload_bytes_to_storage(content, storage_path, content_type='image/jpeg', upsert=True)
             if public_url:
                 logger.info(f"☁️ Uploaded collage to Supabase: {public_url}")
                 
-                # Save public URL into folder_collages table (preferred)
+                # Upsert the public URL into folder_collages (unique on folder):
+                # one DB write per folder, however many songs it holds.
                 try:
-                    # First try to insert/upsert into folder_collages table
-                    data = {
-                        'folder': folder_name,
-                        'collage_url': public_url,
-                        'created_at': datetime.now().isoformat()
-                    }
-                    result = db_request('POST', 'folder_collages', data)
-                    if result:
+                    if save_collage_url(folder_name, public_url):
+                        remember_collage_url(folder_name, public_url)
                         logger.info(f"✅ Saved collage URL to folder_collages table for {folder_name}")
                     else:
-                        logger.warning(f"⚠️ Could not save to folder_collages, trying conversions table")
-                        # Fall back to updating conversions table
-                        update = {'folder_collage_url': public_url}
-                        db_request('PATCH', f"conversions?folder=eq.{urllib.parse.quote(folder_name)}", update)
-                        logger.info(f"✅ Saved collage URL to conversions table for {folder_name}")
+                        logger.warning(f"⚠️ Could not save collage URL to folder_collages for {folder_name}")
                 except Exception as e:
                     logger.warning(f"⚠️ Failed to save collage URL to database: {e}")
-                    # Try fallback
-                    try:
-                        update = {'folder_collage_url': public_url}
-                        db_request('PATCH', f"conversions?folder=eq.{urllib.parse.quote(folder_name)}", update)
-                        logger.info(f"✅ Saved collage URL to conversions table (fallback) for {folder_name}")
-                    except Exception as e2:
-                        logger.error(f"❌ Failed to save collage URL even to conversions: {e2}")
             else:
                 logger.warning(f"⚠️ Could not upload collage to storage for {folder_name}")
 
@@ -1239,8 +3362,8 @@ def delete_file(filename):
         return jsonify({'error': 'Only owner can delete files'}), 403
     
     # Parse filename to get file_id
-    if decoded_filename.endswith('.mp3'):
-        file_id = decoded_filename.replace('.mp3', '')
+    if decoded_filename.endswith(AUDIO_EXTENSIONS):
+        file_id = decoded_filename.rsplit('.', 1)[0]
         
         # If there's a folder path, extract just the file_id
         if '/' in file_id:
@@ -1255,23 +3378,17 @@ def delete_file(filename):
         logger.error(f"❌ File not found in database: {file_id}")
         return jsonify({'error': 'File not found in database'}), 404
     
-    # Delete from storage
-    storage_path = song.get('file_path')
-    if storage_path:
-        if not delete_from_storage(storage_path):
-            logger.warning(f"⚠️ Could not delete from storage, but continuing with DB deletion")
+    # Hide it now; storage and the row itself are purged in the background
+    result = trash_rows(f'file_id=eq.{file_id}')
     
-    # Delete from database
-    result = db_request('DELETE', f'conversions?file_id=eq.{file_id}')
-    
-    if result:
-        logger.info(f"✅ Successfully deleted file: {decoded_filename}")
+    if result is not None:
+        logger.info(f"✅ Marked for deletion: {decoded_filename}")
         return jsonify({
             'success': True,
             'message': 'File deleted successfully',
             'filename': decoded_filename,
             'file_id': file_id
-        })
+        }), 202
     else:
         logger.error(f"❌ Failed to delete from database: {file_id}")
         return jsonify({'error': 'Failed to delete from database'}), 500
@@ -1283,9 +3400,16 @@ def delete_file(filename):
 @app.route('/api/files')
 def list_files():
     """List all songs - Everyone can see all completed songs"""
-    client_id = get_client_id()
     folder_filter = request.args.get('folder')
     
+    # Rendered bodies are shared by all workers until the library changes
+    cache_key = library_cache_key(f"files:{folder_filter or ''}")
+    body = shared_cache.get(cache_key)
+    if body is not None:
+        CACHE_REQUESTS.inc(cache='library', result='hit')
+        return Response(body, mimetype='application/json')
+    CACHE_REQUESTS.inc(cache='library', result='miss')
+    
     # Try to get songs from database first
     songs = []
     if SUPABASE_URL and SUPABASE_KEY:
@@ -1294,6 +3418,40 @@ def list_files():
         else:
             songs = get_all_songs()
     
+    listing = build_files_listing(songs, folder_filter)
+    stale = served_stale()
+    if stale:
+        listing['stale'] = True
+    body = app.json.dumps(listing)
+    if songs and not stale:
+        # Filesystem and stale fallbacks aren't cached so the DB is retried next time
+        shared_cache.set(cache_key, body, ttl=LIBRARY_CACHE_TTL)
+    return Response(body, mimetype='application/json')
+
+
+def song_file_entry(song):
+    """/api/files entry for a DB song (also used by /api/search)"""
+    file_id = song.get('file_id')
+    extension = Path(song.get('file_path') or '').suffix or '.mp3'
+    return {
+        'filename': f"{file_id}{extension}",
+        'display_name': song.get('title', 'Unknown'),
+        'size': song.get('file_size', 0),
+        'modified': int(datetime.fromisoformat(song.get('completed_at', datetime.utcnow().isoformat())).timestamp()),
+        'url': f"/api/play/{file_id}",  # This is the correct play URL
+        'source_url': song.get('url'),
+        'folder': song.get('folder'),
+        'thumbnail': song.get('thumbnail'),
+        'duration': song.get('duration', 0),
+        'created_at': song.get('created_at'),
+        'file_id': file_id,
+        'download_url': f"/api/download/{file_id}"
+    }
+
+
+def build_files_listing(songs, folder_filter=None):
+    """Shape DB songs into the /api/files payload, scanning the filesystem
+    when the database returned nothing. Shared by the Flask and ASGI routes."""
     files = {'folders': {}, 'root': []}
     
     # Process database songs
@@ -1309,20 +3467,7 @@ def list_files():
         file_id = song.get('file_id')
         
         # Create file object with correct play URL
-        file_obj = {
-            'filename': f"{file_id}.mp3",
-            'display_name': song.get('title', 'Unknown'),
-            'size': song.get('file_size', 0),
-            'modified': int(datetime.fromisoformat(song.get('completed_at', datetime.utcnow().isoformat())).timestamp()),
-            'url': f"/api/play/{file_id}",  # This is the correct play URL
-            'source_url': song.get('url'),
-            'folder': folder,
-            'thumbnail': song.get('thumbnail'),
-            'duration': song.get('duration', 0),
-            'created_at': song.get('created_at'),
-            'file_id': file_id,
-            'download_url': f"/api/download/{file_id}"
-        }
+        file_obj = song_file_entry(song)
         
         # If folder filter is applied, just return files
         if folder_filter:
@@ -1343,67 +3488,119 @@ def list_files():
             logger.info("📂 Database unavailable or empty, scanning filesystem for MP3 files...")
             downloads_root = DOWNLOADS_DIR
             if downloads_root.exists():
-                for user_dir in downloads_root.iterdir():
-                    if user_dir.is_dir():
-                        for folder_dir in user_dir.iterdir():
-                            if folder_dir.is_dir() and folder_dir.name != '__pycache__':
-                                mp3_files = list(folder_dir.glob('*.mp3'))
-                                for mp3_file in mp3_files:
-                                    try:
-                                        file_id = mp3_file.stem
-                                        folder_name = folder_dir.name
-                                        
-                                        file_obj = {
-                                            'filename': mp3_file.name,
-                                                'display_name': file_id,
-                                            'size': mp3_file.stat().st_size,
-                                            'modified': int(mp3_file.stat().st_mtime),
-                                            'url': f"/api/play/{file_id}",
-                                                'folder': folder_name,
-                                                'source_url': None,
-                                            'file_id': file_id,
-                                            'download_url': f"/api/download/{file_id}"
-                                        }
-                                        
-                                        if folder_name not in files['folders']:
-                                            files['folders'][folder_name] = []
-                                        files['folders'][folder_name].append(file_obj)
-                                    except Exception as e:
-                                        logger.error(f"Error processing file {mp3_file}: {e}")
-        except Exception as e:
-            logger.error(f"Error scanning filesystem: {e}")
-    elif folder_filter and not (files.get('files') or songs):
-        # Fallback for specific folder
-        try:
-            logger.info(f"📂 Database unavailable for folder '{folder_filter}', scanning filesystem...")
-            downloads_root = DOWNLOADS_DIR
-            if downloads_root.exists():
-                for user_dir in downloads_root.iterdir():
-                    if user_dir.is_dir():
-                        folder_dir = user_dir / folder_filter
-                        if folder_dir.exists() and folder_dir.is_dir():
-                            mp3_files = list(folder_dir.glob('*.mp3'))
-                            files['files'] = []
-                            for mp3_file in mp3_files:
+                for user_dir in list_subdirs(downloads_root):
+                    for folder_dir in list_subdirs(user_dir):
+                        if folder_dir.name != '__pycache__':
+                            for mp3_file in list_mp3s(folder_dir):
                                 try:
-                                    file_id = mp3_file.stem
+                                    file_id = mp3_file.path.stem
+                                    folder_name = folder_dir.name
+                                    
                                     file_obj = {
-                                        'filename': mp3_file.name,
+                                        'filename': mp3_file.path.name,
                                         'display_name': file_id,
-                                        'size': mp3_file.stat().st_size,
-                                        'modified': int(mp3_file.stat().st_mtime),
+                                        'size': mp3_file.size,
+                                        'modified': int(mp3_file.mtime),
                                         'url': f"/api/play/{file_id}",
-                                        'folder': folder_filter,
+                                        'folder': folder_name,
+                                        'source_url': None,
                                         'file_id': file_id,
                                         'download_url': f"/api/download/{file_id}"
                                     }
-                                    files['files'].append(file_obj)
+                                    
+                                    if folder_name not in files['folders']:
+                                        files['folders'][folder_name] = []
+                                    files['folders'][folder_name].append(file_obj)
                                 except Exception as e:
-                                    logger.error(f"Error processing file {mp3_file}: {e}")
+                                    logger.error(f"Error processing file {mp3_file.path}: {e}")
+        except Exception as e:
+            logger.error(f"Error scanning filesystem: {e}")
+    elif folder_filter and not (files.get('files') or songs):
+        # Fallback for specific folder
+        try:
+            logger.info(f"📂 Database unavailable for folder '{folder_filter}', scanning filesystem...")
+            downloads_root = DOWNLOADS_DIR
+            if downloads_root.exists():
+                for user_dir in list_subdirs(downloads_root):
+                    folder_dir = user_dir / folder_filter
+                    if folder_dir in list_subdirs(user_dir):
+                        mp3_files = list_mp3s(folder_dir)
+                        files['files'] = []
+                        for mp3_file in mp3_files:
+                            try:
+                                file_id = mp3_file.path.stem
+                                file_obj = {
+                                    'filename': mp3_file.path.name,
+                                    'display_name': file_id,
+                                    'size': mp3_file.size,
+                                    'modified': int(mp3_file.mtime),
+                                    'url': f"/api/play/{file_id}",
+                                    'folder': folder_filter,
+                                    'file_id': file_id,
+                                    'download_url': f"/api/download/{file_id}"
+                                }
+                                files['files'].append(file_obj)
+                            except Exception as e:
+                                logger.error(f"Error processing file {mp3_file.path}: {e}")
         except Exception as e:
             logger.error(f"Error in fallback folder scan: {e}")
     
-    return jsonify(files)
+    return files
+
+# ==========================================
+# Search
+# ==========================================
+
+SEARCH_MAX_LIMIT = 100
+# Record the channel/uploader of new songs so search covers it; needs
+# `ALTER TABLE conversions ADD COLUMN uploader text` first
+STORE_UPLOADER = os.environ.get('STORE_UPLOADER', '0') == '1'
+
+
+def search_library(query, limit=20, offset=0):
+    """Ranked search over completed songs: the replica's full-text index,
+    or a plain substring match in Supabase while the replica isn't ready.
+    Returns (songs, total); total is None when unknown."""
+    if replica_ready():
+        return replica.search(query, limit, offset)
+    words = re.findall(r'\w+', query)
+    if not words:
+        return [], 0
+    pattern = '*' + '*'.join(words) + '*'
+    clauses = ','.join(f'{column}.ilike."{pattern}"' for column in ('title', 'folder'))
+    songs = db_request('GET', 'conversions?status=eq.completed'
+                       f"&or=({urllib.parse.quote(clauses, safe='.,*()')})"
+                       f'&order=created_at.desc&limit={limit}&offset={offset}')
+    return (songs, None) if isinstance(songs, list) else ([], None)
+
+
+@app.route('/api/search')
+def search():
+    """Search songs by title, uploader and folder: /api/search?q=...&limit=&offset="""
+    query = request.args.get('q', '').strip()
+    try:
+        limit = max(1, min(int(request.args.get('limit', 20)), SEARCH_MAX_LIMIT))
+        offset = max(0, int(request.args.get('offset', 0)))
+    except ValueError:
+        return jsonify({'error': 'limit and offset must be integers'}), 400
+    if not query:
+        return jsonify({'error': 'Query parameter q is required'}), 400
+
+    songs, total = search_library(query, limit, offset)
+    results = []
+    for song in songs:
+        entry = song_file_entry(song)
+        if 'score' in song:
+            entry['score'] = song['score']
+        results.append(entry)
+    return jsonify({
+        'query': query,
+        'results': results,
+        'total': total,
+        'limit': limit,
+        'offset': offset,
+        'has_more': offset + len(results) < total if total is not None else len(results) == limit,
+    })
 
 # ==========================================
 # Download File by Filename
@@ -1414,8 +3611,8 @@ def download_file(filename):
     """Download file by filename (for library download button)"""
     try:
         # Extract file_id from filename
-        if filename.endswith('.mp3'):
-            file_id = filename.replace('.mp3', '')
+        if filename.endswith(AUDIO_EXTENSIONS):
+            file_id = filename.rsplit('.', 1)[0]
         else:
             file_id = filename
         
@@ -1451,7 +3648,9 @@ def song_info():
         }
         
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
+            # A preview isn't worth queueing behind conversions for long
+            with governed(upstream_host(url), max_wait=SONG_INFO_MAX_WAIT):
+                info = ydl.extract_info(url, download=False)
             
             return jsonify({
                 'title': info.get('title', 'Unknown'),
@@ -1461,6 +3660,15 @@ def song_info():
                 'view_count': info.get('view_count', 0)
             })
             
+    except Throttled as e:
+        retry_after = max(1, int(e.retry_after))
+        response = jsonify({
+            'error': 'YouTube is rate limiting requests',
+            'message': f'Try again in {retry_after}s.',
+            'retry_after': retry_after
+        })
+        response.headers['Retry-After'] = str(retry_after)
+        return response, 503
     except Exception as e:
         logger.error(f"Error in song-info endpoint: {e}")
         return jsonify({'error': str(e)}), 500
@@ -1472,12 +3680,28 @@ def health():
         test = db_request('GET', 'conversions?select=count&limit=1')
         
         owner_id = get_owner_id()
+        sync_age = replica.sync_age() if replica_ready() else None
+        refresh_upstream_gauges()
         
         return jsonify({
             'status': 'healthy' if test else 'degraded',
             'database': 'connected' if test else 'disconnected',
             'owner_set': bool(owner_id),
             'owner_id': owner_id,
+            'cache_backend': shared_cache.name,
+            'circuits': {circuit.name: circuit.snapshot() for circuit in (db_circuit, storage_circuit)},
+            'disk': {
+                'free_mb': round(janitor.free_bytes() / (1024 * 1024), 1),
+                'reserved_mb': round(janitor.reserved_bytes() / (1024 * 1024), 1),
+            },
+            'replica': {
+                'enabled': replica is not None,
+                'ready': replica_ready(),
+                'rows': replica.count() if replica_ready() else 0,
+                'last_sync_age': round(sync_age, 1) if sync_age is not None else None,
+            },
+            'upstream': upstream.snapshot(),
+            'metrics': metrics.summary(),
             'timestamp': datetime.utcnow().isoformat()
         })
             
@@ -1488,6 +3712,13 @@ def health():
         }), 500
 
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus text exposition of this worker's metrics"""
+    refresh_upstream_gauges()
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
 # --- Thumbnail proxy to avoid CORS/hotlink issues ---
 @app.route('/api/thumbnail')
 def thumbnail_proxy():
@@ -1496,42 +3727,29 @@ def thumbnail_proxy():
         return jsonify({'error': 'Invalid URL'}), 400
     try:
         # Server-side caching to avoid repeated upstream hits and hotlink/CORS issues
-        import hashlib
-        cache_dir = DOWNLOADS_DIR / '.thumbcache'
+        cache_file = thumbnail_cache_file(url)
+        cache_dir = cache_file.parent
         cache_dir.mkdir(parents=True, exist_ok=True)
-
-        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
-        # Guess extension from url or default to .jpg
-        ext = '.jpg'
-        parsed = urllib.parse.urlparse(url)
-        if parsed.path:
-            pext = Path(parsed.path).suffix
-            if pext and len(pext) <= 5:
-                ext = pext
-
-        cache_file = cache_dir / f"{key}{ext}"
+        key = cache_file.stem
 
         logger.info(f"Thumbnail proxy requested: {url} -> cache {cache_file}")
 
-        # Helper to map file extension to mimetype
-        def mimetype_for_path(p: Path):
-            ext = p.suffix.lower()
-            if ext in ('.jpg', '.jpeg'): return 'image/jpeg'
-            if ext == '.png': return 'image/png'
-            if ext == '.webp': return 'image/webp'
-            if ext == '.gif': return 'image/gif'
-            return 'application/octet-stream'
-
         # If cached and recent (5 minutes), serve directly
         if cache_file.exists() and (time.time() - cache_file.stat().st_mtime) < 300:
             logger.info(f"Serving cached thumbnail for {url}")
+            CACHE_REQUESTS.inc(cache='thumbnail', result='hit')
+            janitor.touch(cache_file)
             return send_file(str(cache_file), mimetype=mimetype_for_path(cache_file), conditional=True)
 
+        CACHE_REQUESTS.inc(cache='thumbnail', result='miss')
         headers = {'User-Agent': 'TuneVerse/1.0 (+https://example.com)'}
-        resp = requests.get(url, headers=headers, stream=True, timeout=10)
+        UPSTREAM_REQUESTS.inc(upstream='thumbnail')
+        with profiling.timed('http'):
+            resp = requests.get(url, headers=headers, stream=True, timeout=10)
         logger.info(f"Thumbnail upstream status {resp.status_code} for {url}")
         if resp.status_code != 200:
             logger.warning(f"Thumbnail proxy upstream returned {resp.status_code} for {url}")
+            UPSTREAM_ERRORS.inc(upstream='thumbnail')
             return ('', resp.status_code)
 
         # Write to temporary file then move
@@ -1574,6 +3792,65 @@ def thumbnail_proxy():
         return ('', 500)
 
 
+def serve_collage(folder, url):
+    """Serve a stored collage without buffering it in memory.
+
+    The local collage_<hash>.jpg is preferred (conditional send_file, so clients
+    get ETag/304 for free). Otherwise the public URL is either redirected to or
+    streamed through with iter_content, depending on COLLAGE_SERVE_MODE.
+    Returns None if the upstream collage could not be served.
+    """
+    local_file = collage_cache_file(folder)
+    if local_file.exists():
+        janitor.touch(local_file)
+        resp = send_file(str(local_file), mimetype='image/jpeg', conditional=True, etag=True)
+        resp.headers['Cache-Control'] = 'public, max-age=86400'
+        logger.info(f"✅ Served local collage file for {folder}")
+        return resp
+
+    if COLLAGE_SERVE_MODE != 'stream':
+        resp = redirect(url)
+        resp.headers['Cache-Control'] = 'public, max-age=3600'
+        logger.info(f"↪️ Redirecting to stored collage for {folder}")
+        return resp
+
+    headers = {'User-Agent': 'TuneVerse/1.0'}
+    if request.headers.get('If-None-Match'):
+        headers['If-None-Match'] = request.headers['If-None-Match']
+    if request.headers.get('If-Modified-Since'):
+        headers['If-Modified-Since'] = request.headers['If-Modified-Since']
+
+    with profiling.timed('http'):
+        upstream = requests.get(url, headers=headers, stream=True, timeout=5)
+    if upstream.status_code == 304:
+        upstream.close()
+        resp = Response(status=304)
+        if upstream.headers.get('ETag'):
+            resp.headers['ETag'] = upstream.headers['ETag']
+        resp.headers['Cache-Control'] = 'public, max-age=2592000'
+        return resp
+    if upstream.status_code != 200:
+        logger.warning(f"⚠️ Stored collage returned {upstream.status_code} for {folder}")
+        upstream.close()
+        return None
+
+    def generate():
+        try:
+            for chunk in upstream.iter_content(8192):
+                if chunk:
+                    yield chunk
+        finally:
+            upstream.close()
+
+    resp = Response(generate(), mimetype='image/jpeg')
+    for header in ('ETag', 'Last-Modified', 'Content-Length'):
+        if upstream.headers.get(header):
+            resp.headers[header] = upstream.headers[header]
+    resp.headers['Cache-Control'] = 'public, max-age=2592000'  # 30 days
+    logger.info(f"✅ Streaming stored collage for {folder}")
+    return resp
+
+
 @app.route('/api/folder_collage')
 def folder_collage():
     """Return a single collage image for a folder to speed up client loading.
@@ -1585,24 +3862,18 @@ def folder_collage():
         # First check if a public collage URL is stored in DB for this folder
         logger.info(f"📸 Checking for cached collage URL for folder: {folder}")
         try:
-            # Query the folder_collages table if it exists
+            # Look up the folder_collages map (one shared query for all folders)
             try:
-                entries = db_request('GET', f"folder_collages?folder=eq.{urllib.parse.quote(folder)}&select=collage_url")
-                if entries and isinstance(entries, list) and len(entries) > 0:
-                    url = entries[0].get('collage_url')
-                    if url:
-                        logger.info(f"✅ Found cached collage URL in DB for {folder}: {url}")
-                        # Try to fetch and serve the cached collage
-                        try:
-                            resp = requests.get(url, headers={'User-Agent': 'TuneVerse/1.0'}, timeout=5)
-                            if resp.status_code == 200:
-                                response = Response(resp.content, mimetype='image/jpeg')
-                                response.headers['Cache-Control'] = 'public, max-age=2592000'  # 30 days
-                                logger.info(f"✅ Served cached collage from Supabase for {folder}")
-                                return response
-                        except Exception as e:
-                            logger.warning(f"⚠️ Failed to fetch cached collage URL: {e}")
-                            # Fall through to regenerate
+                url = get_collage_url(folder)
+                if url:
+                    logger.info(f"✅ Found cached collage URL for {folder}: {url}")
+                    try:
+                        response = serve_collage(folder, url)
+                        if response is not None:
+                            return response
+                    except Exception as e:
+                        logger.warning(f"⚠️ Failed to serve cached collage URL: {e}")
+                        # Fall through to regenerate
             except Exception as e:
                 logger.info(f"⚠️ folder_collages table check failed (expected if table doesn't exist): {e}")
                 # Fall back to checking conversions table
@@ -1613,13 +3884,11 @@ def folder_collage():
                         if url:
                             logger.info(f"✅ Found collage URL in conversions table for {folder}: {url}")
                             try:
-                                resp = requests.get(url, headers={'User-Agent': 'TuneVerse/1.0'}, timeout=5)
-                                if resp.status_code == 200:
-                                    response = Response(resp.content, mimetype='image/jpeg')
-                                    response.headers['Cache-Control'] = 'public, max-age=2592000'
+                                response = serve_collage(folder, url)
+                                if response is not None:
                                     return response
                             except Exception as e:
-                                logger.warning(f"⚠️ Failed to fetch collage from conversions: {e}")
+                                logger.warning(f"⚠️ Failed to serve collage from conversions: {e}")
         except Exception as e:
             logger.warning(f"⚠️ Error checking cached collage: {e}")
 
@@ -1631,7 +3900,7 @@ def folder_collage():
             return jsonify({'error': 'No collage available'}), 404
         
         logger.info(f"✅ Generated collage for {folder} at {path}")
-        resp = send_file(path, mimetype='image/jpeg')
+        resp = send_file(path, mimetype='image/jpeg', conditional=True, etag=True)
         resp.headers['Cache-Control'] = 'public, max-age=86400'
         return resp
     except Exception as e:
@@ -1653,14 +3922,12 @@ def folder_collage_url():
     try:
         logger.info(f"📸 Getting collage URL for folder: {folder}")
         
-        # Check database for cached URL first (fast!)
+        # Check the in-memory folder_collages map first (no DB round trip)
         try:
-            entries = db_request('GET', f"folder_collages?folder=eq.{urllib.parse.quote(folder)}&select=collage_url")
-            if entries and isinstance(entries, list) and len(entries) > 0:
-                url = entries[0].get('collage_url')
-                if url:
-                    logger.info(f"✅ Found saved collage URL in DB: {url}")
-                    return jsonify({'url': url, 'cached': True})
+            url = get_collage_url(folder)
+            if url:
+                logger.info(f"✅ Found saved collage URL: {url}")
+                return jsonify({'url': url, 'cached': True})
         except Exception as e:
             logger.debug(f"folder_collages table not available: {e}")
             # Try conversions table
@@ -1683,16 +3950,14 @@ def folder_collage_url():
             logger.error(f"❌ Failed to generate collage for {folder}")
             return jsonify({'error': 'Could not generate collage'}), 404
         
-        logger.info(f"✅ Generated collage, now getting URL from database...")
+        logger.info(f"✅ Generated collage, now getting URL from the collage map...")
         
-        # After generation, URL should be saved to database. Retrieve it.
+        # After generation, the saved URL has been recorded in the map.
         try:
-            entries = db_request('GET', f"folder_collages?folder=eq.{urllib.parse.quote(folder)}&select=collage_url")
-            if entries and isinstance(entries, list) and len(entries) > 0:
-                url = entries[0].get('collage_url')
-                if url:
-                    logger.info(f"✅ Retrieved newly saved collage URL: {url}")
-                    return jsonify({'url': url, 'cached': False})
+            url = get_collage_url(folder)
+            if url:
+                logger.info(f"✅ Retrieved newly saved collage URL: {url}")
+                return jsonify({'url': url, 'cached': False})
         except Exception as e:
             logger.warning(f"Could not retrieve URL after generation: {e}")
         
@@ -1704,6 +3969,18 @@ def folder_collage_url():
         logger.error(f"❌ Error getting collage URL: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/folder_collage_urls')
+def folder_collage_urls():
+    """Return collage URLs for all folders at once (one request per folder grid).
+    Folders without a stored collage are absent; clients can fall back to
+    /api/folder_collage_url for those."""
+    try:
+        urls = load_collage_urls(force=request.args.get('refresh') == '1')
+        return jsonify({'urls': urls, 'count': len(urls)})
+    except Exception as e:
+        logger.error(f"❌ Error getting collage URLs: {e}")
+        return jsonify({'error': str(e)}), 500
+
 # --- Frontend Routes for different views ---
 @app.route('/admin')
 def admin_panel():
@@ -1715,6 +3992,35 @@ def user_view():
     """User view page - Everyone can access"""
     return send_file('user.html')
 
+# ==========================================
+# ADMIN: Request timing switch
+# ==========================================
+
+@app.route('/api/admin/profiling', methods=['GET', 'POST', 'OPTIONS'])
+def request_profiling_settings():
+    """Show or change request timing settings (admin only)"""
+    if request.method == 'OPTIONS':
+        return '', 200
+    
+    if not is_owner(get_client_id()):
+        return jsonify({'error': 'Only owner can change profiling settings'}), 403
+    
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        if 'enabled' in data:
+            REQUEST_TIMING['enabled'] = bool(data['enabled'])
+        if 'slow_ms' in data:
+            try:
+                REQUEST_TIMING['slow_ms'] = float(data['slow_ms'])
+            except (TypeError, ValueError):
+                return jsonify({'error': 'slow_ms must be a number'}), 400
+        logger.info(f"⏱️ Request timing settings: {REQUEST_TIMING}")
+    
+    return jsonify({
+        **REQUEST_TIMING,
+        'profile_hint': 'Add ?profile=1 to any request as owner for a cProfile report'
+    })
+
 # ==========================================
 # ADMIN: Regenerate all folder collages
 # ==========================================
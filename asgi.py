@@ -0,0 +1,343 @@
+"""ASGI serving mode: async handlers for the read-heavy API, Flask for the rest.
+
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT --workers 2
+
+The routes below wait on Supabase/ytimg through one pooled httpx.AsyncClient
+instead of holding a WSGI thread each, so hundreds of polling clients can be
+kept open cheaply. Every other route (convert, deletes, admin, static pages)
+falls through to the existing Flask app, which runs in a thread pool.
+"""
+import logging
+import os
+import time
+import urllib.parse
+from contextlib import asynccontextmanager
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import FileResponse, JSONResponse, RedirectResponse, Response
+from starlette.routing import Mount, Route
+
+import app as flask_app
+from app import (
+    ALL_CONVERSIONS_QUERY,
+    ALL_SONGS_QUERY,
+    CACHE_REQUESTS,
+    CLIENT_ID_HEADER,
+    DB_REQUEST_SECONDS,
+    LIBRARY_CACHE_TTL,
+    UPSTREAM_ERRORS,
+    UPSTREAM_REQUESTS,
+    build_files_listing,
+    circuit_allows,
+    collage_urls_fresh,
+    db_circuit,
+    generate_collage_for_folder,
+    get_all_conversions,
+    get_all_songs,
+    get_existing_folders,
+    get_songs_by_folder,
+    is_owner,
+    janitor,
+    last_good,
+    last_good_song,
+    library_cache_key,
+    load_collage_urls,
+    mimetype_for_path,
+    normalize_client_id,
+    play_batch_response,
+    play_payload,
+    record_status,
+    remember_good,
+    rendition_hints,
+    replica_ready,
+    shared_cache,
+    store_collage_urls,
+    thumbnail_cache_file,
+)
+
+logger = logging.getLogger(__name__)
+
+# Shared connection pool for Supabase and thumbnail origins
+HTTP_LIMITS = httpx.Limits(
+    max_connections=int(os.environ.get('ASYNC_HTTP_MAX_CONNECTIONS', '100')),
+    max_keepalive_connections=int(os.environ.get('ASYNC_HTTP_KEEPALIVE', '20')),
+)
+# Threads available to the mounted Flask app
+WSGI_THREADS = int(os.environ.get('WSGI_THREADS', '10'))
+
+http_client = None
+
+
+@asynccontextmanager
+async def lifespan(_app):
+    global http_client
+    http_client = httpx.AsyncClient(limits=HTTP_LIMITS, timeout=10)
+    logger.info("🚀 Async API client ready")
+    try:
+        yield
+    finally:
+        await http_client.aclose()
+
+
+def client_id_for(request):
+    return normalize_client_id(request.headers.get(CLIENT_ID_HEADER) or request.query_params.get('client_id'))
+
+
+async def db_get(endpoint):
+    """Async equivalent of db_request('GET', endpoint)"""
+    if not flask_app.SUPABASE_URL or not flask_app.SUPABASE_KEY:
+        return None
+    if not circuit_allows(db_circuit):
+        return None
+    headers = {
+        'apikey': flask_app.SUPABASE_KEY,
+        'Authorization': f'Bearer {flask_app.SUPABASE_KEY}',
+    }
+    UPSTREAM_REQUESTS.inc(upstream='supabase_db')
+    started = time.perf_counter()
+    try:
+        response = await http_client.get(f"{flask_app.SUPABASE_URL}/rest/v1/{endpoint}", headers=headers)
+    except Exception as e:
+        logger.error(f"Async DB request error: {e}")
+        UPSTREAM_ERRORS.inc(upstream='supabase_db')
+        db_circuit.record_failure()
+        return None
+    finally:
+        DB_REQUEST_SECONDS.observe(time.perf_counter() - started, method='GET')
+
+    record_status(db_circuit, response.status_code)
+
+    if response.status_code == 200:
+        try:
+            return response.json()
+        except ValueError:
+            return None
+    logger.error(f"Async DB GET failed: {response.status_code} - {response.text}")
+    UPSTREAM_ERRORS.inc(upstream='supabase_db')
+    return None
+
+
+async def db_read(endpoint):
+    """Async equivalent of app.db_read(); returns (rows, stale)"""
+    rows = await db_get(endpoint)
+    if isinstance(rows, list):
+        remember_good(endpoint, rows)
+        return rows, False
+    rows = last_good(endpoint)
+    return rows, rows is not None
+
+
+async def query_conversions(endpoint, local_query, *args):
+    """Run `local_query` against the SQLite replica when it is synced,
+    otherwise GET `endpoint` from PostgREST. Returns (rows, stale)."""
+    if replica_ready():
+        return await run_in_threadpool(local_query, *args), False
+    rows, stale = await db_read(endpoint)
+    return rows or [], stale
+
+
+async def get_song(file_id):
+    """(song or None, stale); songs being deleted read as missing"""
+    if replica_ready():
+        # Primary-key lookup, cheap enough to run on the event loop
+        song = flask_app.replica.get(file_id)
+        # Running jobs may have moved on elsewhere; see app.get_from_db
+        if song and song.get('status') not in flask_app.IN_PROGRESS_STATUSES:
+            CACHE_REQUESTS.inc(cache='song', result='hit')
+            return (song if song.get('status') != 'deleting' else None), False
+    CACHE_REQUESTS.inc(cache='song', result='miss')
+    result = await db_get(f'conversions?file_id=eq.{file_id}')
+    if isinstance(result, list):
+        return (result[0] if result and result[0].get('status') != 'deleting' else None), False
+    # Supabase is failing: the song as last seen in the library lists
+    song = last_good_song(file_id)
+    return (song if song and song.get('status') != 'deleting' else None), song is not None
+
+
+async def collage_urls():
+    if collage_urls_fresh():
+        return load_collage_urls()
+    entries = await db_get('folder_collages?select=folder,collage_url')
+    if entries is None and replica_ready():
+        entries = flask_app.replica.collages()
+    return store_collage_urls(entries)
+
+
+# --- Routes ---
+
+async def list_files(request):
+    folder_filter = request.query_params.get('folder')
+    cache_key = library_cache_key(f"files:{folder_filter or ''}")
+    body = shared_cache.get(cache_key)
+    if body is not None:
+        CACHE_REQUESTS.inc(cache='library', result='hit')
+        return Response(body, media_type='application/json')
+    CACHE_REQUESTS.inc(cache='library', result='miss')
+
+    songs, stale = [], False
+    if flask_app.SUPABASE_URL and flask_app.SUPABASE_KEY:
+        if folder_filter and folder_filter != 'root':
+            songs, stale = await query_conversions(
+                f"conversions?folder=eq.{urllib.parse.quote(folder_filter, safe='')}&status=eq.completed&order=created_at.desc",
+                get_songs_by_folder, folder_filter)
+        else:
+            songs, stale = await query_conversions(ALL_SONGS_QUERY, get_all_songs)
+    # Shaping 10k+ rows (and the filesystem fallback) is blocking work
+    payload = await run_in_threadpool(build_files_listing, songs, folder_filter)
+    if stale:
+        payload['stale'] = True
+    body = flask_app.app.json.dumps(payload)
+    if songs and not stale:
+        shared_cache.set(cache_key, body, ttl=LIBRARY_CACHE_TTL)
+    return Response(body, media_type='application/json')
+
+
+async def list_folders(request):
+    client_id = client_id_for(request)
+    songs, stale = [], False
+    if flask_app.SUPABASE_URL and flask_app.SUPABASE_KEY:
+        songs, stale = await query_conversions(ALL_SONGS_QUERY, get_all_songs)
+    folders = await run_in_threadpool(get_existing_folders, client_id, songs, stale)
+    return JSONResponse({'folders': folders, 'stale': stale})
+
+
+async def all_status(request):
+    if is_owner(client_id_for(request)):
+        result, stale = await query_conversions(ALL_CONVERSIONS_QUERY, get_all_conversions)
+    else:
+        result, stale = await query_conversions(ALL_SONGS_QUERY, get_all_songs)
+    return JSONResponse({'statuses': result, 'stale': stale})
+
+
+async def status(request):
+    song, stale = await get_song(request.path_params['file_id'])
+    if not song:
+        return JSONResponse({'error': 'Not found'}, status_code=404)
+    return JSONResponse({**song, 'stale': True} if stale else song)
+
+
+async def play(request):
+    file_id = request.path_params['file_id']
+    song, _ = await get_song(file_id)
+    if not song:
+        return JSONResponse({'error': 'Not found'}, status_code=404)
+    if song.get('status') != 'completed':
+        return JSONResponse({'error': 'File not ready'}, status_code=400)
+    if not song.get('storage_url'):
+        return JSONResponse({'error': 'Audio URL not available'}, status_code=404)
+    return JSONResponse(play_payload(song, rendition_hints(request.query_params, request.headers)))
+
+
+async def play_batch(request):
+    try:
+        body = await request.json()
+    except ValueError:
+        body = {}
+    payload, status_code = await run_in_threadpool(
+        play_batch_response, request.query_params, request.headers, body if isinstance(body, dict) else {})
+    return JSONResponse(payload, status_code=status_code)
+
+
+async def stream(request):
+    song, _ = await get_song(request.path_params['file_id'])
+    if not song or song.get('status') != 'completed':
+        return JSONResponse({'error': 'File not ready'}, status_code=400)
+    if song.get('storage_url'):
+        return RedirectResponse(song['storage_url'], status_code=302)
+    return JSONResponse({'error': 'Audio URL not available'}, status_code=404)
+
+
+async def thumbnail(request):
+    url = request.query_params.get('url')
+    if not url or not (url.startswith('http://') or url.startswith('https://')):
+        return JSONResponse({'error': 'Invalid URL'}, status_code=400)
+
+    cache_file = thumbnail_cache_file(url)
+    if cache_file.exists() and (time.time() - cache_file.stat().st_mtime) < 300:
+        CACHE_REQUESTS.inc(cache='thumbnail', result='hit')
+        janitor.touch(cache_file)
+        return FileResponse(cache_file, media_type=mimetype_for_path(cache_file))
+
+    CACHE_REQUESTS.inc(cache='thumbnail', result='miss')
+    UPSTREAM_REQUESTS.inc(upstream='thumbnail')
+    try:
+        upstream = await http_client.get(url, headers={'User-Agent': 'TuneVerse/1.0 (+https://example.com)'},
+                                         follow_redirects=True)
+    except Exception as e:
+        logger.error(f"Thumbnail proxy error for {url}: {e}")
+        UPSTREAM_ERRORS.inc(upstream='thumbnail')
+        return Response(status_code=500)
+    if upstream.status_code != 200:
+        logger.warning(f"Thumbnail proxy upstream returned {upstream.status_code} for {url}")
+        UPSTREAM_ERRORS.inc(upstream='thumbnail')
+        return Response(status_code=upstream.status_code)
+
+    content_type = upstream.headers.get('Content-Type', mimetype_for_path(cache_file))
+    if not upstream.content:
+        return Response(status_code=502)
+
+    def write_cache():
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_file.with_suffix('.tmp')
+        tmp_path.write_bytes(upstream.content)
+        tmp_path.replace(cache_file)
+
+    try:
+        await run_in_threadpool(write_cache)
+    except Exception as e:
+        logger.error(f"Error caching thumbnail {url}: {e}")
+        return Response(upstream.content, media_type=content_type,
+                        headers={'Cache-Control': 'public, max-age=300', 'Access-Control-Allow-Origin': '*'})
+    return FileResponse(cache_file, media_type=content_type, headers={'Cache-Control': 'public, max-age=86400'})
+
+
+async def folder_collage_url(request):
+    folder = request.query_params.get('folder')
+    if not folder:
+        return JSONResponse({'error': 'Folder required'}, status_code=400)
+
+    url = (await collage_urls()).get(folder)
+    CACHE_REQUESTS.inc(cache='collage', result='hit' if url else 'miss')
+    if url:
+        return JSONResponse({'url': url, 'cached': True})
+
+    # Generating a collage is blocking image work; it records the URL in the map
+    path = await run_in_threadpool(generate_collage_for_folder, folder)
+    if not path:
+        return JSONResponse({'error': 'Could not generate collage'}, status_code=404)
+    url = load_collage_urls().get(folder)
+    if url:
+        return JSONResponse({'url': url, 'cached': False})
+    return JSONResponse({'path': str(path), 'cached': False, 'local': True})
+
+
+async def folder_collage_urls(request):
+    urls = await collage_urls() if request.query_params.get('refresh') != '1' else \
+        store_collage_urls(await db_get('folder_collages?select=folder,collage_url'))
+    return JSONResponse({'urls': urls, 'count': len(urls)})
+
+
+app = Starlette(
+    routes=[
+        Route('/api/files', list_files, methods=['GET']),
+        Route('/api/folders', list_folders, methods=['GET']),
+        Route('/api/status', all_status, methods=['GET']),
+        Route('/api/status/{file_id}', status, methods=['GET']),
+        Route('/api/play/batch', play_batch, methods=['POST']),
+        Route('/api/play/{file_id}', play, methods=['GET']),
+        Route('/api/stream/{file_id}', stream, methods=['GET']),
+        Route('/api/thumbnail', thumbnail, methods=['GET']),
+        Route('/api/folder_collage_url', folder_collage_url, methods=['GET']),
+        Route('/api/folder_collage_urls', folder_collage_urls, methods=['GET']),
+        # Everything else (and non-GET methods on the paths above) is served by Flask
+        Mount('/', app=WSGIMiddleware(flask_app.app, workers=WSGI_THREADS)),
+    ],
+    # Same open CORS policy as CORS(app) on the Flask side
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+    lifespan=lifespan,
+)
@@ -0,0 +1,191 @@
+"""Benchmark the hot read endpoints of app.py against a local fake Supabase.
+
+Starts bench_fakes.FakeSupabase seeded with a synthetic library, runs app.py
+in a subprocess pointed at it, then hammers each endpoint with concurrent
+polling clients and reports p50/p99 latency and requests/sec.
+
+    python bench_api.py --songs 1000 10000 --clients 16 --duration 10
+    python bench_api.py --server gunicorn --workers 2 --threads 4 --output bench_output.txt
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import requests
+
+from bench_fakes import FakeSupabase
+
+REPO_DIR = Path(__file__).resolve().parent
+ENDPOINTS = ['files', 'folders', 'status', 'thumbnail', 'folder_collage_url']
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(q * (len(values) - 1))))
+    return values[idx]
+
+
+def start_app(port, supabase_url, server, workers, threads, workdir):
+    env = dict(os.environ)
+    env.update({
+        'SUPABASE_URL': supabase_url,
+        'SUPABASE_ANON_KEY': 'bench-key',
+        'PORT': str(port),
+        'PYTHONPATH': str(REPO_DIR),
+        'PYTHONUNBUFFERED': '1',
+    })
+    # The app keeps owner_id.txt and downloads/ relative to its cwd
+    Path(workdir, 'owner_id.txt').write_text('bench-owner', encoding='utf-8')
+    if server == 'gunicorn':
+        cmd = [sys.executable, '-m', 'gunicorn', 'app:app', '--bind', f'127.0.0.1:{port}',
+               '--workers', str(workers), '--threads', str(threads), '--timeout', '120',
+               '--log-level', 'warning']
+    else:
+        cmd = [sys.executable, '-c',
+               'import logging, app; logging.disable(logging.INFO); '
+               f'app.app.run(host="127.0.0.1", port={port}, threaded=True)']
+    proc = subprocess.Popen(cmd, cwd=workdir, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            requests.get(f'http://127.0.0.1:{port}/manifest.json', timeout=1)
+            return proc
+        except requests.RequestException:
+            if proc.poll() is not None:
+                raise RuntimeError('app.py exited during startup')
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError('app.py did not start within 30s')
+
+
+def endpoint_url(base, name, folders, rng, thumb_origin):
+    if name == 'files':
+        return f'{base}/api/files'
+    if name == 'folders':
+        return f'{base}/api/folders?client_id=bench-user'
+    if name == 'status':
+        return f'{base}/api/status?client_id=bench-user'
+    if name == 'thumbnail':
+        # A fresh URL every few requests so both the cache and the origin are exercised
+        vid = rng.randint(0, 50)
+        thumb = f"{thumb_origin}/thumb/vi/{vid}/hqdefault.jpg"
+        return f'{base}/api/thumbnail?url={requests.utils.quote(thumb, safe="")}'
+    if name == 'folder_collage_url':
+        folder = rng.choice(folders)
+        return f'{base}/api/folder_collage_url?folder={requests.utils.quote(folder)}'
+    raise ValueError(name)
+
+
+def run_load(base, name, folders, clients, duration, thumb_origin):
+    """Run `clients` polling threads against one endpoint for `duration` seconds"""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + duration
+
+    def client(seed):
+        rng = random.Random(seed)
+        session = requests.Session()
+        local = []
+        local_errors = 0
+        while time.perf_counter() < stop_at:
+            url = endpoint_url(base, name, folders, rng, thumb_origin)
+            started = time.perf_counter()
+            try:
+                resp = session.get(url, timeout=60)
+                resp.content
+                if resp.status_code >= 400:
+                    local_errors += 1
+            except requests.RequestException:
+                local_errors += 1
+            local.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local)
+            errors[0] += local_errors
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    return {
+        'endpoint': name,
+        'requests': len(latencies),
+        'errors': errors[0],
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else 0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 1) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--songs', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='library sizes to benchmark')
+    parser.add_argument('--endpoints', nargs='+', default=ENDPOINTS, choices=ENDPOINTS)
+    parser.add_argument('--clients', type=int, default=16, help='concurrent polling clients')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per endpoint')
+    parser.add_argument('--server', choices=['werkzeug', 'gunicorn'], default='werkzeug')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--db-latency', type=float, default=0.0,
+                        help='artificial latency (seconds) added by the fake Supabase')
+    parser.add_argument('--output', help='also write results as JSON lines to this file')
+    args = parser.parse_args()
+
+    fake = FakeSupabase(port=free_port(), latency=args.db_latency).start()
+    results = []
+    try:
+        for songs in args.songs:
+            folders = fake.seed_library(songs)
+            workdir = tempfile.mkdtemp(prefix='ytmp3-bench-')
+            port = free_port()
+            proc = start_app(port, fake.url, args.server, args.workers, args.threads, workdir)
+            base = f'http://127.0.0.1:{port}'
+            try:
+                print(f"\n=== {songs} songs, {len(folders)} folders, {args.clients} clients, {args.server} ===")
+                print(f"{'endpoint':<22}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+                for name in args.endpoints:
+                    row = run_load(base, name, folders, args.clients, args.duration, fake.url)
+                    row.update({'songs': songs, 'clients': args.clients, 'server': args.server})
+                    results.append(row)
+                    print(f"{name:<22}{row['requests']:>10}{row['errors']:>8}{row['rps']:>10}"
+                          f"{str(row['p50_ms']):>10}{str(row['p99_ms']):>10}")
+            finally:
+                proc.terminate()
+                try:
+                    proc.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                shutil.rmtree(workdir, ignore_errors=True)
+    finally:
+        fake.stop()
+
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as f:
+            for row in results:
+                f.write(json.dumps(row) + '\n')
+
+
+if __name__ == '__main__':
+    main()
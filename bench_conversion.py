@@ -0,0 +1,185 @@
+"""Offline throughput benchmark for the process_conversion pipeline.
+
+Synthetic audio is generated with ffmpeg's lavfi sine source and served from a
+local media origin; yt-dlp fetches it through its generic extractor and runs
+the real FFmpegExtractAudio step. Uploads and DB writes go to the in-memory
+fake Supabase from bench_fakes.py, so nothing leaves the machine.
+
+Each (bitrate, workers) combination runs in its own child process and reports
+jobs/minute, CPU seconds per minute of audio (app + ffmpeg), peak RSS and the
+disk high-water mark of downloads/.
+
+    python bench_conversion.py --bitrates 64 128 --workers 1 2 4 --jobs 8 --audio-seconds 180
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from bench_fakes import FakeSupabase
+
+REPO_DIR = Path(__file__).resolve().parent
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def make_source_audio(seconds, workdir):
+    """Render a stereo AAC track similar to YouTube's m4a audio streams"""
+    ffmpeg = shutil.which('ffmpeg')
+    if not ffmpeg:
+        sys.exit('ffmpeg is required for this benchmark (it is also required by the app)')
+    out = Path(workdir) / 'source.m4a'
+    subprocess.run([
+        ffmpeg, '-hide_banner', '-loglevel', 'error', '-y',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}:sample_rate=48000',
+        '-f', 'lavfi', '-i', f'sine=frequency=660:duration={seconds}:sample_rate=48000',
+        '-filter_complex', '[0:a][1:a]join=inputs=2:channel_layout=stereo',
+        '-c:a', 'aac', '-b:a', '128k', str(out)
+    ], check=True)
+    return out
+
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def run_child(args):
+    """Runs inside the child process: convert --jobs songs with --workers threads"""
+    import logging
+    logging.disable(logging.WARNING)
+    Path('owner_id.txt').write_text('bench-owner', encoding='utf-8')
+    import app
+
+    downloads = app.DOWNLOADS_DIR
+    high_water = [0]
+    stop = threading.Event()
+
+    def sample_disk():
+        while not stop.is_set():
+            high_water[0] = max(high_water[0], dir_size(downloads))
+            stop.wait(0.05)
+
+    sampler = threading.Thread(target=sample_disk, daemon=True)
+    sampler.start()
+
+    file_ids = []
+    for i in range(args.jobs):
+        file_id = str(uuid.uuid4())
+        app.save_to_db({
+            'file_id': file_id, 'client_id': 'bench-owner', 'status': 'queued',
+            'url': args.media_url, 'bitrate': args.bitrate, 'progress': 0,
+        })
+        file_ids.append(file_id)
+
+    before_self = resource.getrusage(resource.RUSAGE_SELF)
+    before_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.perf_counter()
+    # process_conversion() takes each job off the queue-depth gauge
+    app.QUEUE_DEPTH.inc(len(file_ids))
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        results = list(pool.map(
+            lambda fid: app.process_conversion(args.media_url, fid, 'bench-owner', 'bench', args.bitrate),
+            file_ids))
+    elapsed = time.perf_counter() - started
+    after_self = resource.getrusage(resource.RUSAGE_SELF)
+    after_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    stop.set()
+    sampler.join()
+
+    cpu = ((after_self.ru_utime + after_self.ru_stime) - (before_self.ru_utime + before_self.ru_stime)
+           + (after_children.ru_utime + after_children.ru_stime)
+           - (before_children.ru_utime + before_children.ru_stime))
+    audio_minutes = args.jobs * args.audio_seconds / 60
+    print(json.dumps({
+        'bitrate': args.bitrate,
+        'workers': args.workers,
+        'jobs': args.jobs,
+        'completed': sum(1 for r in results if r),
+        'wall_s': round(elapsed, 2),
+        'jobs_per_min': round(args.jobs / elapsed * 60, 2),
+        'cpu_s_per_audio_min': round(cpu / audio_minutes, 2),
+        # ru_maxrss is KiB on Linux. For children it is the largest single ffmpeg
+        # process, which is never below the RSS it was forked with.
+        'peak_rss_mb': round(after_self.ru_maxrss / 1024, 1),
+        'peak_child_rss_mb': round(after_children.ru_maxrss / 1024, 1),
+        'disk_high_water_mb': round(high_water[0] / (1024 * 1024), 2),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bitrates', nargs='+', default=['64', '128'], choices=['64', '128'])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--jobs', type=int, default=8, help='conversions per run')
+    parser.add_argument('--audio-seconds', type=int, default=180, help='length of each synthetic song')
+    parser.add_argument('--output', help='also write results as JSON lines to this file')
+    # Internal: child mode
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--bitrate', help=argparse.SUPPRESS)
+    parser.add_argument('--media-url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        args.workers = args.workers[0]
+        return run_child(args)
+
+    tmp = tempfile.mkdtemp(prefix='ytmp3-convbench-')
+    fake = FakeSupabase(port=free_port()).start()
+    results = []
+    try:
+        source = make_source_audio(args.audio_seconds, tmp)
+        fake.media['source.m4a'] = source.read_bytes()
+        media_url = f"{fake.url}/media/source.m4a"
+        print(f"{'bitrate':>8}{'workers':>9}{'jobs/min':>10}{'cpu s/min':>11}"
+              f"{'rss MB':>9}{'ffmpeg MB':>11}{'disk MB':>9}{'ok':>6}")
+        for bitrate in args.bitrates:
+            for workers in args.workers:
+                workdir = tempfile.mkdtemp(dir=tmp)
+                env = dict(os.environ, SUPABASE_URL=fake.url, SUPABASE_ANON_KEY='bench-key',
+                           PYTHONPATH=str(REPO_DIR))
+                out = subprocess.run(
+                    [sys.executable, str(REPO_DIR / 'bench_conversion.py'), '--child',
+                     '--bitrate', bitrate, '--workers', str(workers), '--jobs', str(args.jobs),
+                     '--audio-seconds', str(args.audio_seconds), '--media-url', media_url],
+                    cwd=workdir, env=env, capture_output=True, text=True)
+                if out.returncode != 0:
+                    print(out.stderr[-2000:], file=sys.stderr)
+                    continue
+                row = json.loads(out.stdout.strip().splitlines()[-1])
+                results.append(row)
+                print(f"{bitrate:>8}{workers:>9}{row['jobs_per_min']:>10}{row['cpu_s_per_audio_min']:>11}"
+                      f"{row['peak_rss_mb']:>9}{row['peak_child_rss_mb']:>11}{row['disk_high_water_mb']:>9}"
+                      f"{row['completed']:>4}/{row['jobs']}")
+    finally:
+        fake.stop()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as f:
+            for row in results:
+                f.write(json.dumps(row) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,293 @@
+"""Local stand-ins for Supabase (PostgREST + Storage), the ytimg thumbnail
+origin and a media origin for yt-dlp, used by the benchmark scripts.
+Everything is held in memory.
+
+    from bench_fakes import FakeSupabase
+    fake = FakeSupabase(port=54321)
+    fake.seed_library(10000)
+    fake.start()
+"""
+import fnmatch
+import json
+import random
+import threading
+import urllib.parse
+import uuid
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+from PIL import Image
+
+
+def _make_jpeg(color, size=120):
+    buf = BytesIO()
+    Image.new('RGB', (size, size), color).save(buf, format='JPEG', quality=70)
+    return buf.getvalue()
+
+
+def _parse_value(raw):
+    if raw == 'null':
+        return None
+    if raw in ('true', 'false'):
+        return raw == 'true'
+    return raw
+
+
+def _matches(row, column, expr):
+    """Evaluate a single PostgREST filter such as eq.completed or in.(a,b)"""
+    op, _, raw = expr.partition('.')
+    value = row.get(column)
+    if op == 'eq':
+        return str(value) == raw if value is not None else False
+    if op == 'neq':
+        return str(value) != raw
+    if op == 'is':
+        return value is _parse_value(raw) if raw in ('null', 'true', 'false') else False
+    if op == 'in':
+        items = [i.strip().strip('"') for i in raw.strip('()').split(',') if i.strip()]
+        return value is not None and str(value) in items
+    if op in ('lt', 'lte', 'gt', 'gte'):
+        if value is None:
+            return False
+        a, b = str(value), raw.strip('"')
+        return {'lt': a < b, 'lte': a <= b, 'gt': a > b, 'gte': a >= b}[op]
+    if op == 'ilike':
+        return value is not None and fnmatch.fnmatchcase(str(value).lower(), raw.strip('"').lower())
+    if op == 'not':
+        return not _matches(row, column, raw)
+    return True
+
+
+def _matches_or(row, expr):
+    """Evaluate or=(col.op.value,...) as used by the replica's incremental pull"""
+    for part in expr.strip('()').split(','):
+        column, _, condition = part.partition('.')
+        if _matches(row, column, condition):
+            return True
+    return False
+
+
+class _QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping keep-alive connections is normal under load
+        pass
+
+
+class FakeSupabase:
+    """Minimal PostgREST/Storage/thumbnail server good enough for app.py"""
+
+    RESERVED = ('select', 'order', 'limit', 'offset', 'on_conflict')
+
+    def __init__(self, host='127.0.0.1', port=54321, latency=0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency  # optional artificial per-request delay (seconds)
+        self.tables = {'conversions': [], 'folder_collages': []}
+        self.objects = {}
+        self.media = {}  # name -> bytes, served at /media/<name> for the download stage
+        self.lock = threading.Lock()
+        self._response_cache = {}
+        self._thumb = _make_jpeg((200, 80, 80))
+        self.server = None
+        self.requests_served = 0
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    # --- Seeding ---
+
+    def seed_library(self, songs, songs_per_folder=50, with_collages=True, seed=42):
+        """Create `songs` completed conversions spread over folders"""
+        rng = random.Random(seed)
+        folder_count = max(1, songs // songs_per_folder)
+        folders = [f"folder {i:04d}" for i in range(folder_count)]
+        base = datetime(2024, 1, 1)
+        rows = []
+        for i in range(songs):
+            file_id = str(uuid.UUID(int=rng.getrandbits(128)))
+            folder = folders[i % folder_count] if i % 10 else None
+            created = base + timedelta(minutes=i)
+            rows.append({
+                'id': i + 1,
+                'file_id': file_id,
+                'client_id': 'bench-owner',
+                'status': 'completed',
+                'folder': folder,
+                'url': f"https://www.youtube.com/watch?v=bench{i:07d}",
+                'bitrate': '64',
+                'progress': 100,
+                'title': f"Synthetic song {i}",
+                'thumbnail': f"{self.url}/thumb/vi/bench{i:07d}/hqdefault.jpg",
+                'duration': rng.randint(120, 600),
+                'file_size': rng.randint(1_000_000, 6_000_000),
+                'storage_url': f"{self.url}/storage/v1/object/public/yt-downloads/owner/{file_id}.mp3",
+                'file_path': f"owner/{file_id}.mp3",
+                'created_at': created.isoformat(),
+                'started_at': created.isoformat(),
+                'completed_at': (created + timedelta(seconds=30)).isoformat(),
+            })
+        with self.lock:
+            self.tables['conversions'] = rows
+            self.tables['folder_collages'] = [
+                {'folder': f, 'collage_url': f"{self.url}/storage/v1/object/public/yt-downloads/owner/folder_collages/{i}.jpg",
+                 'created_at': base.isoformat()}
+                for i, f in enumerate(folders)
+            ] if with_collages else []
+            self._response_cache.clear()
+        return folders
+
+    # --- Query evaluation ---
+
+    def query(self, table, params):
+        with self.lock:
+            rows = self.tables.setdefault(table, [])
+            result = [r for r in rows if all(
+                _matches_or(r, expr) if col == 'or' else _matches(r, col, expr)
+                for col, expr in params.items() if col not in self.RESERVED)]
+        order = params.get('order')
+        if order:
+            for part in reversed(order.split(',')):
+                column, _, direction = part.partition('.')
+                result.sort(key=lambda r: (r.get(column) is None, str(r.get(column) or '')),
+                            reverse=direction.startswith('desc'))
+        offset = int(params.get('offset', 0) or 0)
+        if params.get('limit'):
+            result = result[offset:offset + int(params['limit'])]
+        elif offset:
+            result = result[offset:]
+        select = params.get('select')
+        if select == 'count':
+            return [{'count': len(result)}]
+        if select and select != '*':
+            columns = [c.strip() for c in select.split(',')]
+            result = [{c: r.get(c) for c in columns} for r in result]
+        return result
+
+    def write(self, method, table, params, body):
+        with self.lock:
+            rows = self.tables.setdefault(table, [])
+            self._response_cache.clear()
+            if method == 'POST':
+                items = body if isinstance(body, list) else [body]
+                conflict = params.get('on_conflict')
+                out = []
+                for item in items:
+                    existing = next((r for r in rows if conflict and r.get(conflict) == item.get(conflict)), None)
+                    if existing is not None:
+                        existing.update(item)
+                        out.append(existing)
+                    else:
+                        row = dict(item)
+                        row.setdefault('id', len(rows) + 1)
+                        rows.append(row)
+                        out.append(row)
+                return out
+            filters = {c: e for c, e in params.items() if c not in self.RESERVED}
+            matched = [r for r in rows if all(_matches(r, c, e) for c, e in filters.items())]
+            if method == 'PATCH':
+                for r in matched:
+                    r.update(body or {})
+                return matched
+            if method == 'DELETE':
+                self.tables[table] = [r for r in rows if r not in matched]
+                return matched
+        return []
+
+    # --- HTTP plumbing ---
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body=b'', content_type='application/json'):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+
+            def _read_body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return self.rfile.read(length) if length else b''
+
+            def _dispatch(self):
+                if fake.latency:
+                    threading.Event().wait(fake.latency)
+                fake.requests_served += 1
+                parsed = urllib.parse.urlsplit(self.path)
+                path = urllib.parse.unquote(parsed.path)
+                params = dict(urllib.parse.parse_qsl(parsed.query, keep_blank_values=True))
+
+                if path.startswith('/rest/v1/'):
+                    table = path[len('/rest/v1/'):]
+                    if table.startswith('rpc/'):
+                        # No Postgres functions here; callers fall back like they would on a real 404
+                        return self._send(404, b'{"message":"function not found"}')
+                    if self.command == 'GET':
+                        key = (table, parsed.query)
+                        body = fake._response_cache.get(key)
+                        if body is None:
+                            body = json.dumps(fake.query(table, params)).encode()
+                            fake._response_cache[key] = body
+                        return self._send(200, body)
+                    raw = self._read_body()
+                    payload = json.loads(raw) if raw else None
+                    result = fake.write(self.command, table, params, payload)
+                    return self._send(201 if self.command == 'POST' else 200, json.dumps(result).encode())
+
+                if path.startswith('/storage/v1/object/public/'):
+                    key = path[len('/storage/v1/object/public/'):]
+                    data = fake.objects.get(key)
+                    if data is None and key.endswith('.jpg'):
+                        data = fake._thumb
+                    if data is None:
+                        return self._send(404, b'{"error":"not found"}')
+                    return self._send(200, data, 'image/jpeg' if key.endswith('.jpg') else 'audio/mpeg')
+
+                if path.startswith('/storage/v1/object/'):
+                    key = path[len('/storage/v1/object/'):]
+                    if self.command in ('POST', 'PUT'):
+                        data = self._read_body()
+                        if key in fake.objects and self.headers.get('x-upsert') != 'true':
+                            return self._send(400, b'{"error":"Duplicate"}')
+                        fake.objects[key] = data
+                        return self._send(200, json.dumps({'Key': key}).encode())
+                    if self.command == 'DELETE':
+                        fake.objects.pop(key, None)
+                        return self._send(200, b'{}')
+
+                if path.startswith('/thumb/'):
+                    return self._send(200, fake._thumb, 'image/jpeg')
+
+                if path.startswith('/media/'):
+                    data = fake.media.get(path[len('/media/'):])
+                    if data is None:
+                        return self._send(404, b'{"error":"not found"}')
+                    return self._send(200, data, 'audio/mp4')
+
+                return self._send(404, b'{"error":"unknown path"}')
+
+            do_GET = do_POST = do_PATCH = do_DELETE = do_PUT = do_HEAD = _dispatch
+
+        return Handler
+
+    def start(self):
+        self.server = _QuietServer((self.host, self.port), self._handler())
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
@@ -0,0 +1,115 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+HALF_OPEN = 'half_open'
+OPEN = 'open'
+STATES = (CLOSED, HALF_OPEN, OPEN)
+
+
+class CircuitBreaker:
+    """Fails fast while a dependency is down instead of waiting out its timeout.
+
+    - closed: calls go through; `failure_threshold` failures in a row open it.
+    - open: allow() says no until `reset_timeout` seconds have passed.
+    - half_open: one probe call goes through. Success closes the circuit,
+      failure opens it for another `reset_timeout`.
+
+    Callers ask allow() before each call and report the outcome with
+    record_success() / record_failure(). `on_change(breaker, state)` is called
+    on every state change.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30, on_change=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.on_change = on_change
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_started = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        return self._state
+
+    def _set_state(self, state):
+        """Call with the lock held; returns the state to report, if it changed"""
+        if state == self._state:
+            return None
+        self._state = state
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        return state
+
+    def _changed(self, state):
+        if state is None:
+            return
+        if state == OPEN:
+            logger.warning(f"🔌 {self.name} circuit open, failing fast for {self.reset_timeout}s")
+        else:
+            logger.info(f"🔌 {self.name} circuit {state.replace('_', '-')}")
+        if self.on_change:
+            try:
+                self.on_change(self, state)
+            except Exception:
+                pass
+
+    def allow(self):
+        now = time.monotonic()
+        changed = None
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN:
+                if now - self._opened_at < self.reset_timeout:
+                    return False
+                changed = self._set_state(HALF_OPEN)
+                self._probe_started = None
+            # Half-open: one probe at a time; a probe that never reported
+            # back doesn't keep the circuit stuck
+            if self._probe_started is not None and now - self._probe_started < self.reset_timeout:
+                allowed = False
+            else:
+                self._probe_started = now
+                allowed = True
+        self._changed(changed)
+        return allowed
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._probe_started = None
+            changed = self._set_state(CLOSED)
+        self._changed(changed)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_started = None
+            changed = None
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                changed = self._set_state(OPEN)
+                # A failed probe restarts the wait as well
+                self._opened_at = time.monotonic()
+        self._changed(changed)
+
+    def retry_after(self):
+        """Seconds until the next probe may go through"""
+        with self._lock:
+            if self._state != OPEN:
+                return 0.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+    def snapshot(self):
+        """State for metrics and /api/health"""
+        return {
+            'state': self._state,
+            'failures': self._failures,
+            'retry_after': round(self.retry_after(), 1),
+        }
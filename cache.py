@@ -0,0 +1,200 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class BaseCache(ABC):
+    """String key/value cache with TTLs and version-stamped namespaces.
+
+    Values are strings (callers store JSON or pre-rendered response bodies).
+    A namespace is invalidated by bumping its version: keys built with
+    ns_key() embed the current version, so every worker sharing the backend
+    stops seeing the old entries at once and they simply expire.
+    """
+
+    name = 'base'
+    DECODED_MAX = 256  # decoded JSON values kept per process (LRU)
+
+    def __init__(self):
+        self._decoded = OrderedDict()
+        self._decoded_lock = threading.Lock()
+
+    @abstractmethod
+    def get(self, key):
+        raise NotImplementedError
+
+    @abstractmethod
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, key):
+        raise NotImplementedError
+
+    @abstractmethod
+    def incr(self, key):
+        raise NotImplementedError
+
+    # --- Helpers shared by all backends ---
+
+    def version(self, namespace):
+        return int(self.get(f'{namespace}:__version__') or 0)
+
+    def bump(self, namespace):
+        """Invalidate everything stored under ns_key(namespace, ...)"""
+        return self.incr(f'{namespace}:__version__')
+
+    def ns_key(self, namespace, key):
+        return f'{namespace}:v{self.version(namespace)}:{key}'
+
+    def get_json(self, key):
+        """Decoded JSON value. The decoded object is reused while the stored
+        string is unchanged, so treat it as read-only."""
+        raw = self.get(key)
+        if raw is None:
+            return None
+        with self._decoded_lock:
+            memo = self._decoded.get(key)
+            if memo and memo[0] == raw:
+                self._decoded.move_to_end(key)
+                return memo[1]
+        value = json.loads(raw)
+        with self._decoded_lock:
+            self._decoded[key] = (raw, value)
+            self._decoded.move_to_end(key)
+            while len(self._decoded) > self.DECODED_MAX:
+                self._decoded.popitem(last=False)
+        return value
+
+    def set_json(self, key, value, ttl=None):
+        self.set(key, json.dumps(value), ttl)
+
+
+class MemoryCache(BaseCache):
+    """Per-process cache (each gunicorn worker has its own copy)"""
+
+    name = 'memory'
+
+    def __init__(self):
+        super().__init__()
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires is not None and expires <= time.time():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, time.time() + ttl if ttl else None)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            value = int(self._data.get(key, (0, None))[0]) + 1
+            self._data[key] = (str(value), None)
+            return value
+
+
+class FileCache(BaseCache):
+    """SQLite file shared by every worker on the host (WAL mode)"""
+
+    name = 'file'
+    PURGE_EVERY = 500  # sets between sweeps of expired rows
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._sets = 0
+        self._conn().execute(
+            'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.path), timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute(
+            'SELECT value FROM cache WHERE key = ? AND (expires IS NULL OR expires > ?)',
+            (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value, ttl=None):
+        conn = self._conn()
+        conn.execute('INSERT OR REPLACE INTO cache(key, value, expires) VALUES (?, ?, ?)',
+                     (key, value, time.time() + ttl if ttl else None))
+        self._sets += 1
+        if self._sets % self.PURGE_EVERY == 0:
+            conn.execute('DELETE FROM cache WHERE expires IS NOT NULL AND expires <= ?', (time.time(),))
+
+    def delete(self, key):
+        self._conn().execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def incr(self, key):
+        row = self._conn().execute(
+            'INSERT INTO cache(key, value, expires) VALUES (?, 1, NULL) '
+            'ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1 RETURNING value',
+            (key,)).fetchone()
+        return int(row[0])
+
+
+class RedisCache(BaseCache):
+    """Redis (or any Redis-protocol server, e.g. Valkey/KeyDB/Dragonfly)"""
+
+    name = 'redis'
+
+    def __init__(self, url, prefix='ytmp3:'):
+        super().__init__()
+        import redis  # optional dependency, only needed for this backend
+        self.client = redis.Redis.from_url(url, decode_responses=True, socket_timeout=2)
+        self.client.ping()
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, value, ex=int(ttl) if ttl else None)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + key)
+
+
+def create_cache(backend, path=None, url=None):
+    """Build the configured backend, falling back to an in-process cache
+    if it can't be set up (missing redis package, server down, bad path)."""
+    try:
+        if backend == 'redis':
+            return RedisCache(url)
+        if backend == 'file':
+            return FileCache(path)
+    except Exception as e:
+        logger.error(f"❌ Cache backend '{backend}' unavailable ({e}), using in-process cache")
+    return MemoryCache()
@@ -0,0 +1,105 @@
+import os
+import threading
+import time
+from collections import namedtuple
+from pathlib import Path
+
+FileEntry = namedtuple('FileEntry', 'path size mtime')
+
+
+class _Listing:
+    __slots__ = ('mtime_ns', 'checked', 'dirs', 'files')
+
+    def __init__(self, mtime_ns, dirs, files):
+        self.mtime_ns = mtime_ns
+        self.checked = time.monotonic()
+        self.dirs = dirs      # sorted subdirectory names
+        self.files = files    # name -> (size, mtime)
+
+
+class DirectoryIndex:
+    """In-memory index of a directory tree built with os.scandir.
+
+    Each directory's listing (subdirectories plus file sizes and mtimes) is
+    kept until the directory's own mtime changes. Adding, removing or renaming
+    an entry changes that mtime, so changes made by other processes are
+    picked up too, at the cost of one stat() per directory every
+    `revalidate` seconds. Writers in this process call invalidate() to see
+    their changes immediately.
+    """
+
+    def __init__(self, root, revalidate=2.0):
+        self.root = Path(root)
+        self.revalidate = revalidate
+        self._listings = {}
+        self._lock = threading.Lock()
+        self.scans = 0
+
+    def _listing(self, path):
+        key = str(path)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._listings.get(key)
+        if cached is not None and now - cached.checked < self.revalidate:
+            return cached
+        try:
+            mtime_ns = os.stat(key).st_mtime_ns
+        except OSError:
+            with self._lock:
+                self._listings.pop(key, None)
+            return None
+        if cached is not None and cached.mtime_ns == mtime_ns:
+            cached.checked = now
+            return cached
+
+        dirs, files = [], {}
+        try:
+            with os.scandir(key) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs.append(entry.name)
+                        elif entry.is_file():
+                            st = entry.stat()
+                            files[entry.name] = (st.st_size, st.st_mtime)
+                    except OSError:
+                        continue  # removed while we were scanning
+        except OSError:
+            return None
+        dirs.sort()
+        listing = _Listing(mtime_ns, dirs, files)
+        with self._lock:
+            self._listings[key] = listing
+            self.scans += 1
+        return listing
+
+    def subdirs(self, path):
+        """Subdirectories of `path` (empty if it doesn't exist)"""
+        listing = self._listing(path)
+        return [Path(path) / name for name in listing.dirs] if listing else []
+
+    def files(self, path, suffix=None):
+        """FileEntry(path, size, mtime) for files directly in `path`"""
+        listing = self._listing(path)
+        if not listing:
+            return []
+        return [FileEntry(Path(path) / name, size, mtime)
+                for name, (size, mtime) in sorted(listing.files.items())
+                if suffix is None or name.endswith(suffix)]
+
+    def files_recursive(self, path, suffix=None):
+        """Like files(), for `path` and everything below it"""
+        found = self.files(path, suffix)
+        for sub in self.subdirs(path):
+            found.extend(self.files_recursive(sub, suffix))
+        return found
+
+    def invalidate(self, path=None):
+        """Forget `path` (and its parent, whose listing includes it), or everything"""
+        with self._lock:
+            if path is None:
+                self._listings.clear()
+                return
+            path = Path(path)
+            for p in (path, path.parent):
+                self._listings.pop(str(p), None)
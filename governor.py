@@ -0,0 +1,171 @@
+import logging
+import random
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Per-host budget: requests in flight at once, sustained requests/second, and
+# how many requests may go out back to back after an idle period
+HostLimits = namedtuple('HostLimits', 'concurrency rate burst')
+DEFAULT_LIMITS = HostLimits(8, 10.0, 20)
+
+
+class Throttled(Exception):
+    """The host is backing off (or busy) for longer than the caller can wait"""
+
+    def __init__(self, host, retry_after):
+        super().__init__(f'{host} is rate limiting, retry in {retry_after:.0f}s')
+        self.host = host
+        self.retry_after = retry_after
+
+
+class _HostState:
+    def __init__(self, limits):
+        self.limits = limits
+        self.in_flight = 0
+        self.tokens = float(limits.burst)
+        self.refilled = time.monotonic()
+        self.blocked_until = 0.0
+        self.failures = 0
+
+
+class UpstreamGovernor:
+    """Paces requests to upstream hosts so bursts turn into a steady stream.
+
+    - Each host gets a concurrency cap and a token bucket (`HostLimits`).
+    - throttled() puts a host into exponential backoff with jitter; nothing
+      is sent to it until the backoff ends. succeeded() resets the streak.
+    - With a `shared` store (get_json/set_json), a backoff started by one
+      process is honoured by every process sharing the store.
+    """
+
+    def __init__(self, limits=None, default=None, backoff_base=30, backoff_max=900, shared=None):
+        self.limits = dict(limits or {})
+        self.default = default or DEFAULT_LIMITS
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.shared = shared
+        self._hosts = {}
+        self._cond = threading.Condition()
+
+    def _state(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = _HostState(self.limits.get(host, self.default))
+        return state
+
+    def _refill(self, state, now):
+        limits = state.limits
+        state.tokens = min(limits.burst, state.tokens + (now - state.refilled) * limits.rate)
+        state.refilled = now
+
+    def _merge_shared(self, host, state):
+        """Adopt a longer backoff started by another process"""
+        if self.shared is None:
+            return
+        try:
+            entry = self.shared.get_json(f'upstream_backoff:{host}')
+        except Exception:
+            return
+        remaining = entry.get('until', 0) - time.time() if entry else 0
+        if remaining > 0:
+            with self._cond:
+                state.blocked_until = max(state.blocked_until, time.monotonic() + remaining)
+                state.failures = max(state.failures, entry.get('failures', 0))
+
+    @contextmanager
+    def slot(self, host, max_wait=None, interrupt=None):
+        """Wait for a backoff to end, a token and a free slot, then hold the
+        slot for the duration of the block. Raises Throttled when that would
+        take more than `max_wait` seconds. `interrupt` is called about once a
+        second while waiting and may raise to give up."""
+        self.acquire(host, max_wait, interrupt)
+        try:
+            yield
+        finally:
+            self.release(host)
+
+    def acquire(self, host, max_wait=None, interrupt=None):
+        with self._cond:
+            state = self._state(host)
+        self._merge_shared(host, state)
+        deadline = None if max_wait is None else time.monotonic() + max_wait
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(state, now)
+                if state.blocked_until > now:
+                    wait = state.blocked_until - now
+                elif state.in_flight >= state.limits.concurrency:
+                    wait = None
+                elif state.tokens < 1:
+                    wait = (1 - state.tokens) / state.limits.rate
+                else:
+                    state.tokens -= 1
+                    state.in_flight += 1
+                    return
+                if deadline is not None and now + (wait or 0) > deadline:
+                    raise Throttled(host, wait if wait is not None else 1)
+                timeout = 1.0 if wait is None else min(wait, 1.0)
+                if deadline is not None:
+                    timeout = min(timeout, max(deadline - now, 0.01))
+                self._cond.wait(timeout)
+                if interrupt is not None:
+                    interrupt()
+
+    def release(self, host):
+        with self._cond:
+            state = self._hosts.get(host)
+            if state is not None and state.in_flight > 0:
+                state.in_flight -= 1
+                self._cond.notify_all()
+
+    def throttled(self, host):
+        """Record a throttling response; returns the backoff in seconds"""
+        with self._cond:
+            state = self._state(host)
+            state.failures += 1
+            delay = min(self.backoff_max, self.backoff_base * 2 ** (state.failures - 1))
+            delay = random.uniform(delay / 2, delay)
+            state.blocked_until = max(state.blocked_until, time.monotonic() + delay)
+            state.tokens = 0.0
+            failures = state.failures
+            self._cond.notify_all()
+        logger.warning(f"🐢 {host} is throttling us (x{failures}), backing off {delay:.0f}s")
+        if self.shared is not None:
+            try:
+                self.shared.set_json(f'upstream_backoff:{host}',
+                                     {'until': time.time() + delay, 'failures': failures}, ttl=int(delay) + 1)
+            except Exception:
+                pass
+        return delay
+
+    def succeeded(self, host):
+        with self._cond:
+            state = self._hosts.get(host)
+            if state is not None:
+                state.failures = 0
+
+    def backoff_remaining(self, host):
+        with self._cond:
+            state = self._state(host)
+        self._merge_shared(host, state)
+        return max(0.0, state.blocked_until - time.monotonic())
+
+    def snapshot(self):
+        """Per-host state for metrics and /api/health"""
+        now = time.monotonic()
+        with self._cond:
+            hosts = {}
+            for host, state in self._hosts.items():
+                self._refill(state, now)
+                hosts[host] = {
+                    'in_flight': state.in_flight,
+                    'tokens': round(state.tokens, 2),
+                    'backoff_seconds': round(max(0.0, state.blocked_until - now), 1),
+                    'failures': state.failures,
+                }
+            return hosts
@@ -0,0 +1,265 @@
+import logging
+import os
+import re
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Intermediate files a conversion leaves behind: yt-dlp partials/fragments,
+# the downloaded source container, HLS segments, stage checkpoints and temp
+# files. Finished .mp3s are not swept here, since the filesystem library
+# fallback may still list them.
+JOB_ARTIFACT_SUFFIXES = ('.part', '.ytdl', '.webm', '.m4a', '.mp4', '.opus', '.ogg', '.aac',
+                         '.ts', '.m3u8', '.json', '.temp', '.tmp')
+FILE_ID_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+
+
+class Janitor:
+    """Keeps a downloads directory within its disk.
+
+    - Cache directories are trimmed least-recently-used first, to a byte
+      budget and whenever free space drops below `min_free`.
+    - Intermediate job files (<file_id>.<ext> under per-user folders)
+      whose job isn't running anymore are deleted after `grace` seconds.
+    - Disk-space reservations let the job scheduler admit only work that
+      fits: admit() reserves the expected bytes, release() returns them.
+      With `reservations` (a SQLite file on the same disk) every process
+      using the disk sees the others' reservations. Those expire after
+      `reservation_ttl` seconds unless their process calls refresh().
+    """
+
+    def __init__(self, root, cache_dirs=(), cache_budget=0, min_free=0, grace=600, quota=0,
+                 reservations=None, reservation_ttl=300):
+        self.root = Path(root)
+        self.cache_dirs = [Path(d) for d in cache_dirs]
+        self.cache_budget = cache_budget
+        self.min_free = min_free
+        self.grace = grace
+        self.quota = quota  # optional cap on root's own usage, for shared disks
+        self.reservation_ttl = reservation_ttl
+        self._reservations_path = Path(reservations) if reservations else None
+        self._local = threading.local()
+        self._reserved = {}  # this process's reservations
+        self._touched = {}
+        self._lock = threading.Lock()
+        self._usage = (0.0, 0)
+
+    # --- Disk accounting ---
+
+    def usage(self, max_age=10):
+        """Bytes used under root (cached for `max_age` seconds)"""
+        measured_at, used = self._usage
+        if time.monotonic() - measured_at > max_age:
+            used = _tree_size(self.root)
+            self._usage = (time.monotonic(), used)
+        return used
+
+    def free_bytes(self):
+        """Free space for root: the disk's free space, capped by the quota"""
+        free = shutil.disk_usage(self.root).free
+        if self.quota:
+            free = min(free, max(0, self.quota - self.usage()))
+        return free
+
+    def reserved_bytes(self):
+        return sum(self.reservations().values())
+
+    def reserved_ids(self):
+        return set(self.reservations())
+
+    def reservations(self):
+        """job_id -> reserved bytes, for every process sharing the disk"""
+        if self._reservations_path is None:
+            with self._lock:
+                return dict(self._reserved)
+        rows = self._db().execute('SELECT job_id, bytes FROM reservations WHERE expires > ?',
+                                  (time.time(),)).fetchall()
+        return dict(rows)
+
+    def available_bytes(self, job_id=None):
+        """Free space not already promised to admitted jobs, above the floor.
+        With `job_id`, that job's own reservation counts as available to it."""
+        reserved = self.reservations()
+        reserved.pop(job_id, None)
+        return self.free_bytes() - sum(reserved.values()) - self.min_free
+
+    def admit(self, job_id, expected_bytes):
+        """Reserve space for a job. Evicts caches if that makes it fit;
+        returns False when it still doesn't."""
+        short = expected_bytes - self.available_bytes()
+        if short > 0:
+            self.evict_caches(short)
+        if self._reservations_path is None:
+            with self._lock:
+                if expected_bytes > self.available_bytes(job_id):
+                    return False
+                self._reserved[job_id] = expected_bytes
+            return True
+        conn = self._db()
+        now = time.time()
+        # BEGIN IMMEDIATE takes the write lock: admits from all processes
+        # are checked against each other one at a time
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM reservations WHERE expires <= ?', (now,))
+            (others,) = conn.execute('SELECT COALESCE(SUM(bytes), 0) FROM reservations WHERE job_id != ?',
+                                     (job_id,)).fetchone()
+            if expected_bytes > self.free_bytes() - others - self.min_free:
+                conn.execute('ROLLBACK')
+                return False
+            conn.execute('INSERT OR REPLACE INTO reservations(job_id, bytes, holder, expires) VALUES (?, ?, ?, ?)',
+                         (job_id, expected_bytes, _holder(), now + self.reservation_ttl))
+            conn.execute('COMMIT')
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        with self._lock:
+            self._reserved[job_id] = expected_bytes
+        return True
+
+    def release(self, job_id):
+        with self._lock:
+            self._reserved.pop(job_id, None)
+        if self._reservations_path is not None:
+            self._db().execute('DELETE FROM reservations WHERE job_id = ? AND holder = ?', (job_id, _holder()))
+
+    def refresh(self):
+        """Keep this process's reservations from expiring; call it well
+        within `reservation_ttl`"""
+        if self._reservations_path is None:
+            return
+        with self._lock:
+            ids = list(self._reserved)
+        conn = self._db()
+        expires = time.time() + self.reservation_ttl
+        for job_id in ids:
+            conn.execute('UPDATE reservations SET expires = ? WHERE job_id = ? AND holder = ?',
+                         (expires, job_id, _holder()))
+
+    def _db(self):
+        conn = getattr(self._local, 'conn', None)
+        # A connection must not cross a fork (gunicorn --preload)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(str(self._reservations_path), timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS reservations '
+                         '(job_id TEXT PRIMARY KEY, bytes INTEGER, holder TEXT, expires REAL)')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    # --- Cache eviction ---
+
+    def touch(self, path):
+        """Record a cache hit so LRU eviction sees it (atime is often noatime/relatime)"""
+        with self._lock:
+            self._touched[str(path)] = time.time()
+
+    def _cache_files(self):
+        files = []
+        for cache_dir in self.cache_dirs:
+            try:
+                with os.scandir(cache_dir) as it:
+                    for entry in it:
+                        try:
+                            if not entry.is_file(follow_symlinks=False):
+                                continue
+                            st = entry.stat()
+                        except OSError:
+                            continue
+                        last_used = max(st.st_atime, st.st_mtime, self._touched.get(entry.path, 0))
+                        files.append((last_used, st.st_size, entry.path))
+            except OSError:
+                continue
+        return files
+
+    def evict_caches(self, need_bytes=0):
+        """Delete least recently used cache files until the caches fit their
+        budget, `need_bytes` have been freed and free space is above the floor.
+        Returns (files, bytes) deleted."""
+        files = sorted(self._cache_files())
+        total = sum(size for _, size, _ in files)
+        free = self.free_bytes()
+        deleted = freed = 0
+        for _, size, path in files:
+            over_budget = self.cache_budget and total > self.cache_budget
+            if not (over_budget or freed < need_bytes or free + freed < self.min_free):
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            with self._lock:
+                self._touched.pop(path, None)
+            total -= size
+            freed += size
+            deleted += 1
+        if deleted:
+            logger.info(f"🧹 Evicted {deleted} cache files ({freed / (1024 * 1024):.1f} MB)")
+        return deleted, freed
+
+    # --- Orphaned job artifacts ---
+
+    def sweep_orphans(self, active_ids=None, max_age=6 * 3600):
+        """Delete job artifacts whose job isn't active. `active_ids` is the set
+        of file_ids still being worked on; if it is None (unknown, e.g. the
+        DB is down) only artifacts older than `max_age` are removed.
+        Returns (files, bytes) deleted."""
+        cache_dirs = {str(d) for d in self.cache_dirs}
+        now = time.time()
+        deleted = freed = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            # Skip caches and hidden dirs; only per-user trees hold job files
+            dirnames[:] = [d for d in dirnames
+                           if not d.startswith('.') and os.path.join(dirpath, d) not in cache_dirs]
+            if Path(dirpath) == self.root:
+                continue
+            for name in filenames:
+                if not name.endswith(JOB_ARTIFACT_SUFFIXES):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                age = now - st.st_mtime
+                file_id = name.split('.', 1)[0]
+                if not FILE_ID_RE.match(file_id):
+                    continue
+                if active_ids is None:
+                    orphaned = age > max_age
+                else:
+                    orphaned = age > self.grace and file_id not in active_ids
+                if not orphaned:
+                    continue
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                deleted += 1
+                freed += st.st_size
+        if deleted:
+            logger.info(f"🧹 Removed {deleted} orphaned job files ({freed / (1024 * 1024):.1f} MB)")
+        return deleted, freed
+
+
+def _holder():
+    # Evaluated per call, so forked workers don't share an identity
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _tree_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
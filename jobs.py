@@ -0,0 +1,136 @@
+import logging
+import subprocess
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    """Raised inside a job's thread once the job has been cancelled"""
+
+    def __init__(self, file_id, reason):
+        super().__init__(f'{file_id} {reason}')
+        self.file_id = file_id
+        self.reason = reason
+
+
+class Job:
+    """One conversion running in this process.
+
+    The job's thread calls check() between steps (yt-dlp calls it from its
+    progress hook) and starts its subprocesses through run(), so cancel()
+    from any thread stops the download at the next chunk and terminates a
+    running ffmpeg right away.
+    """
+
+    def __init__(self, file_id):
+        self.file_id = file_id
+        self.reason = None
+        self._cancelled = threading.Event()
+        self._procs = set()
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self, reason='cancelled'):
+        with self._lock:
+            if self._cancelled.is_set():
+                return
+            self.reason = reason
+            self._cancelled.set()
+            procs = list(self._procs)
+        for proc in procs:
+            _terminate(proc)
+
+    def wait(self, timeout):
+        """Sleep up to `timeout` seconds; returns True (early) if cancelled"""
+        return self._cancelled.wait(timeout)
+
+    def check(self):
+        if self._cancelled.is_set():
+            raise JobCancelled(self.file_id, self.reason)
+
+    def run(self, cmd, timeout=None):
+        """subprocess.run(cmd, capture_output=True, text=True) that cancel() can stop"""
+        self.check()
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        with self._lock:
+            self._procs.add(proc)
+            cancelled = self._cancelled.is_set()
+        if cancelled:
+            # cancel() ran between check() and registering the process
+            _terminate(proc)
+        try:
+            stdout, stderr = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            _terminate(proc)
+            raise
+        finally:
+            with self._lock:
+                self._procs.discard(proc)
+        self.check()
+        return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+
+class JobRegistry:
+    """The jobs running in this process, by file_id. The thread that
+    start()s a job sees it as current() until it finish()es."""
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def start(self, file_id):
+        job = Job(file_id)
+        with self._lock:
+            self._jobs[file_id] = job
+        self._local.job = job
+        return job
+
+    def finish(self, file_id):
+        with self._lock:
+            self._jobs.pop(file_id, None)
+        if getattr(self._local, 'job', None) is not None and self._local.job.file_id == file_id:
+            self._local.job = None
+
+    def current(self):
+        return getattr(self._local, 'job', None)
+
+    def get(self, file_id):
+        with self._lock:
+            return self._jobs.get(file_id)
+
+    def ids(self):
+        with self._lock:
+            return list(self._jobs)
+
+    def cancel(self, file_id, reason='cancelled'):
+        """Cancel a job if it runs here; returns whether it did"""
+        job = self.get(file_id)
+        if job is None:
+            return False
+        logger.info(f"🛑 Cancelling {file_id}: {reason}")
+        job.cancel(reason)
+        return True
+
+    def run(self, cmd, timeout=None):
+        """Run a subprocess on behalf of the current job, if there is one"""
+        job = self.current()
+        if job is None:
+            return subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+        return job.run(cmd, timeout=timeout)
+
+
+def _terminate(proc, grace=5):
+    if proc.poll() is not None:
+        return
+    try:
+        proc.terminate()
+        proc.wait(timeout=grace)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+    except OSError:
+        pass
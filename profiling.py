@@ -0,0 +1,74 @@
+import cProfile
+import io
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+# Each request is served by one thread, so per-request timings live in a thread-local
+_local = threading.local()
+
+
+class RequestTimings:
+    """Accumulates time spent per category (db, http, fs) during one request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.totals = {}
+        self.calls = {}
+
+    def add(self, category, seconds):
+        self.totals[category] = self.totals.get(category, 0.0) + seconds
+        self.calls[category] = self.calls.get(category, 0) + 1
+
+    def breakdown(self):
+        """Return total ms plus ms/calls per category; 'other' is everything unaccounted"""
+        total = time.perf_counter() - self.started
+        parts = {
+            category: {'ms': round(seconds * 1000, 1), 'calls': self.calls[category]}
+            for category, seconds in sorted(self.totals.items())
+        }
+        accounted = sum(self.totals.values())
+        parts['other'] = {'ms': round(max(0.0, total - accounted) * 1000, 1), 'calls': 0}
+        return round(total * 1000, 1), parts
+
+
+def start_request():
+    _local.timings = RequestTimings()
+    return _local.timings
+
+
+def finish_request():
+    timings = getattr(_local, 'timings', None)
+    _local.timings = None
+    return timings
+
+
+def record(category, seconds):
+    """Add time to the current request's breakdown (no-op outside a timed request)"""
+    timings = getattr(_local, 'timings', None)
+    if timings is not None:
+        timings.add(category, seconds)
+
+
+@contextmanager
+def timed(category):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(category, time.perf_counter() - start)
+
+
+def start_profiler():
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def profiler_report(profiler, limit=40):
+    """Stop the profiler and return its top functions by cumulative time"""
+    profiler.disable()
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(limit)
+    return out.getvalue()
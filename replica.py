@@ -0,0 +1,428 @@
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import urllib.parse
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Columns pulled out of the JSON row so they can be indexed and filtered on
+INDEXED_COLUMNS = ('folder', 'status', 'client_id', 'url', 'created_at')
+
+# Timestamps used as incremental-pull high-water marks. `updated_at` only
+# exists once the trigger from the README is installed; without it, status and
+# progress changes made by other hosts arrive with the next full sync.
+SYNC_MARKS = ('created_at', 'completed_at', 'error_time', 'updated_at')
+
+# Rows per request; PostgREST caps responses at its max-rows (1000 by default)
+SYNC_PAGE_SIZE = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversions (
+    file_id TEXT PRIMARY KEY,
+    folder TEXT,
+    status TEXT,
+    client_id TEXT,
+    url TEXT,
+    created_at TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_conversions_folder ON conversions(folder);
+CREATE INDEX IF NOT EXISTS idx_conversions_status_created ON conversions(status, created_at);
+CREATE INDEX IF NOT EXISTS idx_conversions_created ON conversions(created_at);
+CREATE INDEX IF NOT EXISTS idx_conversions_url ON conversions(url);
+CREATE INDEX IF NOT EXISTS idx_conversions_client ON conversions(client_id);
+CREATE TABLE IF NOT EXISTS folder_collages (
+    folder TEXT PRIMARY KEY,
+    collage_url TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+INSERT OR IGNORE INTO sync_state(key, value) VALUES ('generation', '0');
+"""
+
+# Full-text index over completed songs, kept in step with `conversions` by
+# triggers so every write path (write-through, pulls, deletes) maintains it.
+# Rows share rowids with `conversions`.
+SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS conversions_fts USING fts5(
+    title, uploader, folder,
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS conversions_vocab USING fts5vocab(conversions_fts, row);
+CREATE TRIGGER IF NOT EXISTS conversions_fts_insert AFTER INSERT ON conversions
+WHEN new.status = 'completed' BEGIN
+    INSERT INTO conversions_fts(rowid, title, uploader, folder)
+    VALUES (new.rowid, json_extract(new.data, '$.title'), json_extract(new.data, '$.uploader'), new.folder);
+END;
+CREATE TRIGGER IF NOT EXISTS conversions_fts_delete AFTER DELETE ON conversions BEGIN
+    DELETE FROM conversions_fts WHERE rowid = old.rowid;
+END;
+CREATE TRIGGER IF NOT EXISTS conversions_fts_update AFTER UPDATE ON conversions BEGIN
+    DELETE FROM conversions_fts WHERE rowid = old.rowid;
+    INSERT INTO conversions_fts(rowid, title, uploader, folder)
+    SELECT new.rowid, json_extract(new.data, '$.title'), json_extract(new.data, '$.uploader'), new.folder
+    WHERE new.status = 'completed';
+END;
+"""
+
+# bm25 column weights: title, uploader, folder
+SEARCH_WEIGHTS = (10.0, 4.0, 2.0)
+SEARCH_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# Sentinel for "any folder" in list queries (None means root / no folder)
+ANY = object()
+
+
+class LocalReplica:
+    """SQLite read replica of the Supabase `conversions` and `folder_collages` tables.
+
+    Kept current by write-through from our own writes plus periodic pulls.
+    The file lives on the downloads disk, so all gunicorn workers share it and
+    it survives restarts (reads keep working while Supabase is unreachable).
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._ready = False
+        # Decoded list() results, valid while the shared generation counter is unchanged
+        self._list_cache = {}
+        self._list_cache_lock = threading.Lock()
+        conn = self._conn().conn
+        conn.executescript(SCHEMA)
+        conn.executescript(SEARCH_SCHEMA)
+        if self._get_state('search_index') is None:
+            # Replica files from before the search index: backfill it once
+            with self._conn() as conn:
+                conn.execute('DELETE FROM conversions_fts')
+                conn.execute("INSERT INTO conversions_fts(rowid, title, uploader, folder) "
+                             "SELECT rowid, json_extract(data, '$.title'), json_extract(data, '$.uploader'), folder "
+                             "FROM conversions WHERE status = 'completed'")
+                self._set_state(conn, 'search_index', '1')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.path), timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return _Transaction(conn)
+
+    # --- Sync state ---
+
+    def _get_state(self, key):
+        with self._conn() as conn:
+            row = conn.execute('SELECT value FROM sync_state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_state(self, conn, key, value):
+        conn.execute('INSERT INTO sync_state(key, value) VALUES (?, ?) '
+                     'ON CONFLICT(key) DO UPDATE SET value = excluded.value', (key, value))
+
+    def _bump_generation(self, conn):
+        # Every write bumps this, so each worker process knows when its
+        # cached list() results are out of date (whoever made the write)
+        conn.execute("UPDATE sync_state SET value = CAST(value AS INTEGER) + 1 WHERE key = 'generation'")
+
+    @property
+    def ready(self):
+        """True once a full sync has completed (now or in a previous run)"""
+        if not self._ready:
+            self._ready = self._get_state('last_full_sync') is not None
+        return self._ready
+
+    def sync_age(self, key='last_sync'):
+        """Seconds since the last (full) sync by any worker, None if never"""
+        value = self._get_state(key)
+        return time.time() - float(value) if value else None
+
+    def generation(self):
+        """Counter bumped by every write to the conversions table"""
+        return int(self._get_state('generation') or 0)
+
+    def count(self):
+        with self._conn() as conn:
+            return conn.execute('SELECT COUNT(*) FROM conversions').fetchone()[0]
+
+    # --- Writes ---
+
+    @staticmethod
+    def _row_values(row):
+        return (row['file_id'], *(row.get(c) for c in INDEXED_COLUMNS), json.dumps(row))
+
+    def upsert(self, rows, conn=None):
+        rows = [r for r in (rows if isinstance(rows, list) else [rows]) if r and r.get('file_id')]
+        if not rows:
+            return
+        sql = ('INSERT INTO conversions(file_id, folder, status, client_id, url, created_at, data) '
+               'VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(file_id) DO UPDATE SET '
+               'folder=excluded.folder, status=excluded.status, client_id=excluded.client_id, '
+               'url=excluded.url, created_at=excluded.created_at, data=excluded.data '
+               'WHERE conversions.data IS NOT excluded.data')
+        with (_Transaction(conn) if conn is not None else self._conn()) as conn:
+            conn.executemany(sql, [self._row_values(r) for r in rows])
+            self._bump_generation(conn)
+
+    def patch(self, file_id, update_data):
+        """Merge an update into a replicated row (no-op if we don't have it)"""
+        with self._conn() as conn:
+            row = conn.execute('SELECT data FROM conversions WHERE file_id = ?', (file_id,)).fetchone()
+            if not row:
+                return False
+            data = json.loads(row[0])
+            data.update(update_data)
+            self.upsert(data, conn=conn)
+        return True
+
+    def delete(self, file_id):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM conversions WHERE file_id = ?', (file_id,))
+            self._bump_generation(conn)
+
+    def upsert_collage(self, folder, collage_url):
+        with self._conn() as conn:
+            conn.execute('INSERT INTO folder_collages(folder, collage_url, data) VALUES (?, ?, ?) '
+                         'ON CONFLICT(folder) DO UPDATE SET collage_url = excluded.collage_url, data = excluded.data',
+                         (folder, collage_url, json.dumps({'folder': folder, 'collage_url': collage_url})))
+
+    # --- Reads ---
+
+    def get(self, file_id):
+        with self._conn() as conn:
+            row = conn.execute('SELECT data FROM conversions WHERE file_id = ?', (file_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_many(self, file_ids):
+        """Rows for the given file_ids (missing ones are left out)"""
+        file_ids = list(file_ids)
+        rows = []
+        with self._conn() as conn:
+            for i in range(0, len(file_ids), 500):
+                chunk = file_ids[i:i + 500]
+                rows += conn.execute(f"SELECT data FROM conversions WHERE file_id IN ({','.join('?' * len(chunk))})",
+                                     chunk).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def list(self, status=None, folder=ANY, client_id=None, url=None):
+        """Rows matching the filters, newest first (like order=created_at.desc)"""
+        clauses, params = [], []
+        if status is not None:
+            clauses.append('status = ?')
+            params.append(status)
+        if folder is None:
+            clauses.append('folder IS NULL')
+        elif folder is not ANY:
+            clauses.append('folder = ?')
+            params.append(folder)
+        if client_id is not None:
+            clauses.append('client_id = ?')
+            params.append(client_id)
+        if url is not None:
+            clauses.append('url = ?')
+            params.append(url)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        key = (where, tuple(params))
+        with self._conn() as conn:
+            generation = self._get_state('generation')
+            with self._list_cache_lock:
+                cached = self._list_cache.get(key)
+            if cached and cached[0] == generation:
+                return list(cached[1])
+            rows = conn.execute(f'SELECT data FROM conversions {where} ORDER BY created_at DESC', params).fetchall()
+        result = [json.loads(r[0]) for r in rows]
+        with self._list_cache_lock:
+            if len(self._list_cache) > 256:
+                self._list_cache.clear()
+            self._list_cache[key] = (generation, result)
+        return list(result)
+
+    def collages(self):
+        with self._conn() as conn:
+            rows = conn.execute('SELECT folder, collage_url FROM folder_collages').fetchall()
+        return [{'folder': f, 'collage_url': u} for f, u in rows]
+
+    # --- Search ---
+
+    def search(self, query, limit=20, offset=0):
+        """Completed songs matching `query` over title, uploader and folder,
+        best match first. Every word must match, as a prefix of an indexed
+        term; a word matching nothing also accepts terms one edit away.
+        Single characters match whole terms only. Returns (rows, total)."""
+        words = [_fold(w) for w in SEARCH_TOKEN_RE.findall(query or '')]
+        if not words:
+            return [], 0
+        with self._conn() as conn:
+            groups = []
+            for word in words:
+                alternatives = [f'"{word}"*' if len(word) > 1 else f'"{word}"']
+                if not self._has_prefix(conn, word):
+                    alternatives += [f'"{term}"' for term in self._near_terms(conn, word)]
+                groups.append(f"({' OR '.join(alternatives)})")
+            match = ' AND '.join(groups)
+            # Rank and page inside the index; only the page's rows are joined.
+            # Ties go to the most recently replicated row.
+            rows = conn.execute(
+                'WITH hits AS MATERIALIZED (SELECT rowid, bm25(conversions_fts, ?, ?, ?) AS score '
+                'FROM conversions_fts WHERE conversions_fts MATCH ?), '
+                'page AS (SELECT rowid, score FROM hits ORDER BY score, rowid DESC LIMIT ? OFFSET ?) '
+                'SELECT c.data, page.score, (SELECT COUNT(*) FROM hits) '
+                'FROM page JOIN conversions c ON c.rowid = page.rowid ORDER BY page.score, page.rowid DESC',
+                (*SEARCH_WEIGHTS, match, limit, offset)).fetchall()
+            if rows or not offset:
+                total = rows[0][2] if rows else 0
+            else:
+                # Paged past the end, so no row carried the count
+                total = conn.execute('SELECT COUNT(*) FROM conversions_fts WHERE conversions_fts MATCH ?',
+                                     (match,)).fetchone()[0]
+        results = []
+        for data, score, _ in rows:
+            row = json.loads(data)
+            row['score'] = round(-score, 3)
+            results.append(row)
+        return results, total
+
+    @staticmethod
+    def _has_prefix(conn, word):
+        return conn.execute('SELECT 1 FROM conversions_vocab WHERE term >= ? AND term < ? LIMIT 1',
+                            (word, word + '\U0010ffff')).fetchone() is not None
+
+    @staticmethod
+    def _near_terms(conn, word, limit=8):
+        """Indexed terms within one edit (typo) of `word`. Only words of 4+
+        characters, and only terms sharing the first letter, to stay cheap."""
+        if len(word) < 4:
+            return []
+        rows = conn.execute(
+            'SELECT term FROM conversions_vocab WHERE term >= ? AND term < ? '
+            'AND length(term) BETWEEN ? AND ? ORDER BY doc DESC',
+            (word[0], word[0] + '\U0010ffff', len(word) - 1, len(word) + 1)).fetchall()
+        return [t for (t,) in rows if _within_one_edit(word, t)][:limit]
+
+    # --- Pulls from Supabase ---
+
+    def sync(self, fetch, full=False):
+        """Pull changes using `fetch(endpoint)` (db_request-style GET, None on failure).
+
+        Incremental pulls fetch rows created, completed or failed after the
+        newest timestamps seen; a full pull replaces both tables so deletes
+        made elsewhere are reflected too.
+        """
+        marks = {m: self._get_state(f'mark_{m}') for m in SYNC_MARKS}
+        if full or not self.ready or not any(marks.values()):
+            # Only a complete fetch may decide which local rows were deleted
+            rows = self._fetch_all(fetch, 'conversions?order=created_at.desc,file_id.asc')
+            if rows is None:
+                return False
+            collages = fetch('folder_collages?select=folder,collage_url')
+            with self._conn() as conn:
+                # Apply the difference: unchanged rows aren't rewritten, so
+                # the search index only sees real changes
+                conn.execute('CREATE TEMP TABLE IF NOT EXISTS fetched_ids (file_id TEXT PRIMARY KEY)')
+                conn.execute('DELETE FROM fetched_ids')
+                conn.executemany('INSERT OR IGNORE INTO fetched_ids(file_id) VALUES (?)',
+                                 [(r['file_id'],) for r in rows if r.get('file_id')])
+                conn.execute('DELETE FROM conversions WHERE file_id NOT IN (SELECT file_id FROM fetched_ids)')
+                self._bump_generation(conn)
+                self.upsert(rows, conn=conn)
+                if isinstance(collages, list):
+                    conn.execute('DELETE FROM folder_collages')
+                    conn.executemany(
+                        'INSERT OR REPLACE INTO folder_collages(folder, collage_url, data) VALUES (?, ?, ?)',
+                        [(c['folder'], c.get('collage_url'), json.dumps(c)) for c in collages if c.get('folder')])
+                self._update_marks(conn, rows, reset=True)
+                now = str(time.time())
+                self._set_state(conn, 'last_full_sync', now)
+                self._set_state(conn, 'last_sync', now)
+            logger.info(f"🗄️ Replica full sync: {len(rows)} conversions")
+            return True
+
+        clauses = [f'{m}.gt."{v}"' for m, v in marks.items() if v]
+        rows = self._fetch_all(fetch, 'conversions?or=(' + urllib.parse.quote(','.join(clauses), safe='.,"()') + ')'
+                               '&order=created_at.desc,file_id.asc')
+        if rows is None:
+            return False
+        collages = fetch('folder_collages?select=folder,collage_url')
+        with self._conn() as conn:
+            self.upsert(rows, conn=conn)
+            if isinstance(collages, list):
+                conn.executemany(
+                    'INSERT OR REPLACE INTO folder_collages(folder, collage_url, data) VALUES (?, ?, ?)',
+                    [(c['folder'], c.get('collage_url'), json.dumps(c)) for c in collages if c.get('folder')])
+            self._update_marks(conn, rows)
+            self._set_state(conn, 'last_sync', str(time.time()))
+        if rows:
+            logger.info(f"🗄️ Replica pulled {len(rows)} changed conversions")
+        return True
+
+    @staticmethod
+    def _fetch_all(fetch, endpoint):
+        """Every row of `endpoint`, a page at a time until a short page; None
+        if any page fails"""
+        rows = []
+        while True:
+            page = fetch(f'{endpoint}&limit={SYNC_PAGE_SIZE}&offset={len(rows)}')
+            if not isinstance(page, list):
+                return None
+            rows.extend(page)
+            if len(page) < SYNC_PAGE_SIZE:
+                return rows
+
+    def _update_marks(self, conn, rows, reset=False):
+        for mark in SYNC_MARKS:
+            values = [r.get(mark) for r in rows if r.get(mark)]
+            current = None if reset else self._get_state(f'mark_{mark}')
+            newest = max(values + ([current] if current else []), default=None)
+            if newest:
+                self._set_state(conn, f'mark_{mark}', newest)
+
+
+def _fold(word):
+    """Lowercase and strip diacritics, like the index's unicode61 tokenizer"""
+    decomposed = unicodedata.normalize('NFKD', word.lower())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def _within_one_edit(a, b):
+    """True if b is a, or a with one character inserted, deleted, replaced
+    or two adjacent characters swapped"""
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) > 1:
+        return False
+    i = 0
+    while i < min(len(a), len(b)) and a[i] == b[i]:
+        i += 1
+    if len(a) == len(b):
+        return a[i + 1:] == b[i + 1:] or (a[i + 2:] == b[i + 2:] and a[i:i + 2] == b[i:i + 2][::-1])
+    return a[i + 1:] == b[i:] if len(a) > len(b) else a[i:] == b[i + 1:]
+
+
+class _Transaction:
+    """`with` wrapper giving BEGIN/COMMIT semantics on an autocommit connection"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        if not self.conn.in_transaction:
+            self.conn.execute('BEGIN')
+            self._owns = True
+        else:
+            self._owns = False
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._owns:
+            self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+        return False
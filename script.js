@@ -178,6 +178,66 @@ function withClientId(url) {
     return `${url}${separator}client_id=${encodeURIComponent(CLIENT_ID)}`;
 }
 
+// Hints for /api/play so the server can pick a rendition (bitrate/codec)
+// that suits this device and connection
+function playbackHints() {
+    const params = new URLSearchParams();
+    try {
+        const conn = navigator.connection;
+        if (conn && (conn.saveData || ['slow-2g', '2g', '3g'].includes(conn.effectiveType))) {
+            params.set('quality', 'low');
+        }
+        const codecs = ['mp3'];
+        const probe = document.createElement('audio');
+        if (probe.canPlayType && probe.canPlayType('audio/ogg; codecs="opus"')) codecs.push('opus');
+        // Native HLS (Safari, iOS, Android) starts long tracks after the first segment
+        if (probe.canPlayType && probe.canPlayType('application/vnd.apple.mpegurl')) codecs.push('hls');
+        params.set('codecs', codecs.join(','));
+    } catch (e) {}
+    return params.toString();
+}
+
+// /api/play payloads resolved ahead of time for the current queue (file_id -> {data, at})
+const resolvedPlayback = new Map();
+const RESOLVED_PLAYBACK_TTL = 10 * 60 * 1000;
+const PLAY_BATCH_SIZE = 200;
+
+// Resolve a whole queue up front (one request per 200 tracks) so moving
+// to the next/previous track doesn't wait on the network
+function prefetchPlayback(fileIds) {
+    const now = Date.now();
+    const ids = [...new Set(fileIds.filter(Boolean))].filter(id => {
+        const hit = resolvedPlayback.get(id);
+        return !hit || now - hit.at > RESOLVED_PLAYBACK_TTL;
+    });
+    const requests = [];
+    for (let i = 0; i < ids.length; i += PLAY_BATCH_SIZE) {
+        requests.push(fetch(withClientId(`${API_BASE}/play/batch?${playbackHints()}`), {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json', 'X-Client-Id': CLIENT_ID },
+            body: JSON.stringify({ file_ids: ids.slice(i, i + PLAY_BATCH_SIZE) })
+        })
+        .then(response => response.ok ? response.json() : { tracks: [] })
+        .then(data => {
+            (data.tracks || []).forEach(track => resolvedPlayback.set(track.file_id, { data: track, at: Date.now() }));
+        })
+        .catch(err => console.warn('Playback prefetch failed:', err)));
+    }
+    return Promise.all(requests);
+}
+
+// /api/play payload for a track: prefetched when available, fetched otherwise
+function resolvePlayback(fileId) {
+    const hit = resolvedPlayback.get(fileId);
+    if (hit && Date.now() - hit.at < RESOLVED_PLAYBACK_TTL) {
+        return Promise.resolve(hit.data);
+    }
+    return fetch(withClientId(`${API_BASE}/play/${fileId}?${playbackHints()}`), {
+        headers: { 'X-Client-Id': CLIENT_ID }
+    })
+    .then(response => response.json());
+}
+
 // Remember last selected folder for admin so they don't have to re-select repeatedly
 const SELECTED_FOLDER_KEY = 'ytmp3_selected_folder_v1';
 
@@ -406,7 +466,7 @@ function startStatusCheck() {
                     loadFolders();
                     loadLibrary(currentFolder || null);
                 }, 2000);
-            } else if (data.status === 'error') {
+            } else if (data.status === 'error' || data.status === 'cancelled') {
                 clearInterval(statusCheckInterval);
                 showError(data.message || 'Conversion failed');
                 resetButton();
@@ -878,20 +938,7 @@ function createLibraryItem(file) {
         
         try {
             // First get the audio URL from /api/play endpoint
-            const playUrl = withClientId(`${API_BASE}/play/${fileId}`);
-            console.log("📡 Fetching audio URL from:", playUrl);
-            
-            const response = await fetch(playUrl, {
-                headers: {
-                    'X-Client-Id': CLIENT_ID
-                }
-            });
-            
-            if (!response.ok) {
-                throw new Error(`Failed to get audio URL: ${response.status}`);
-            }
-            
-            const data = await response.json();
+            const data = await resolvePlayback(fileId);
             console.log("📡 Audio URL response:", data);
             
             if (data.success && data.url) {
@@ -1570,6 +1617,7 @@ window.addEventListener('beforeunload', () => {
 function playSongWithAutoplay(fileId, title, playlist = [], index = -1) {
     if (playlist.length > 0 && index >= 0) {
         currentPlaylist = playlist;
+        prefetchPlayback(playlist.map(song => song.file_id));
         currentPlaylistIndex = index;
         isAutoPlayEnabled = true;
     }
@@ -1745,10 +1793,7 @@ function playNextInPlaylist() {
         currentPlaylistIndex = nextIndex;
         
         // Get audio URL and play
-        fetch(withClientId(`${API_BASE}/play/${nextSong.file_id}`), {
-            headers: { 'X-Client-Id': CLIENT_ID }
-        })
-        .then(response => response.json())
+        resolvePlayback(nextSong.file_id)
         .then(data => {
             if (data.success && data.url) {
                 console.log('🎵 Playing next song:', nextSong.display_name, 'from playlist index', currentPlaylistIndex);
@@ -1900,6 +1945,7 @@ function playAllSongs() {
 
     if (playlist.length > 0) {
         currentPlaylist = playlist;
+        prefetchPlayback(playlist.map(song => song.file_id));
         currentPlaylistIndex = 0;
         isAutoPlayEnabled = true;
         // Safe: only save if AUTO_PLAY_SETTINGS exists
@@ -1916,10 +1962,7 @@ function playAllSongs() {
         requestNotificationPermission().catch(()=>{});
 
         console.log('🎵 Fetching first song:', playlist[0].file_id);
-        fetch(withClientId(`${API_BASE}/play/${playlist[0].file_id}`), {
-            headers: { 'X-Client-Id': CLIENT_ID }
-        })
-        .then(response => response.json())
+        resolvePlayback(playlist[0].file_id)
         .then(data => {
             console.log('🎵 Got first song data:', data);
             if (data.success && data.url) {
@@ -1980,6 +2023,8 @@ function playFolderSongs(folderName) {
         }));
 
         currentPlaylist = playlist;
+
+        prefetchPlayback(playlist.map(song => song.file_id));
         currentPlaylistIndex = 0;
         // CRITICAL: Force autoplay enabled for folder playback
         isAutoPlayEnabled = true;
@@ -1994,16 +2039,7 @@ function playFolderSongs(folderName) {
         console.log('🎵 Playlist built:', playlist.length, 'songs. isAutoPlayEnabled:', isAutoPlayEnabled);
 
         // Play first song
-        fetch(withClientId(`${API_BASE}/play/${playlist[0].file_id}`), {
-            headers: { 'X-Client-Id': CLIENT_ID }
-        })
-        .then(async resp => {
-            if (!resp.ok) {
-                const tx = await resp.text().catch(()=>'');
-                throw new Error(`Play endpoint returned ${resp.status}: ${tx}`);
-            }
-            return resp.json();
-        })
+        resolvePlayback(playlist[0].file_id)
         .then(data => {
             if (data.success && data.url) {
                 playAudioDirectWithAutoplay(data.url, playlist[0].display_name);
@@ -2046,10 +2082,7 @@ function initAutoplaySystem() {
             currentPlaylistIndex = Math.max(0, currentPlaylistIndex - 1);
             const prevSong = currentPlaylist[currentPlaylistIndex];
             if (prevSong) {
-                fetch(withClientId(`${API_BASE}/play/${prevSong.file_id}`), {
-                    headers: { 'X-Client-Id': CLIENT_ID }
-                })
-                .then(response => response.json())
+                resolvePlayback(prevSong.file_id)
                 .then(data => {
                     if (data.success && data.url) {
                         playAudioDirectWithAutoplay(data.url, prevSong.display_name);
@@ -2223,6 +2256,21 @@ async function loadCollagesInBackground(folders) {
     const cards = document.querySelectorAll('.folder-card');
     console.log('Found', cards.length, 'folder cards in DOM');
     
+    // Resolve every known collage URL in a single request; only folders that
+    // are missing from the map fall back to the per-folder endpoint below.
+    let batchUrls = {};
+    try {
+        const batchResponse = await fetch(withClientId(`${API_BASE}/folder_collage_urls`), {
+            headers: { 'X-Client-Id': CLIENT_ID }
+        });
+        if (batchResponse.ok) {
+            const batchData = await batchResponse.json();
+            batchUrls = batchData.urls || {};
+        }
+    } catch (error) {
+        console.warn('⚠️ Batch collage URL lookup failed:', error);
+    }
+    
     // Process each card IN PARALLEL (not sequentially)
     let loadedCount = 0;
     let failedCount = 0;
@@ -2258,6 +2306,11 @@ async function loadCollagesInBackground(folders) {
                 collageUrl = collageCache[folderName].url;
                 fromCache = true;
                 console.log('🔄 Using cached collage URL for:', folderName);
+            } else if (batchUrls[folderName]) {
+                collageUrl = batchUrls[folderName];
+                collageCache[folderName] = { url: collageUrl, timestamp: Date.now() };
+                setCollageCache(collageCache);
+                console.log('📥 Got collage URL from batch lookup for:', folderName);
             } else {
                 // Fetch URL from server (which will check database)
                 try {
@@ -3069,6 +3122,8 @@ async function showFolderSongs(folderName, songCount) {
         }));
         
         currentPlaylist = playlist;
+        
+        prefetchPlayback(playlist.map(song => song.file_id));
         currentPlaylistIndex = 0;
         isAutoPlayEnabled = true;
         if (typeof AUTO_PLAY_SETTINGS !== 'undefined') {
@@ -3106,10 +3161,7 @@ async function showFolderSongs(folderName, songCount) {
 function playFirstSongInFolder(song) {
     if (!song || !song.file_id) return;
     
-    fetch(withClientId(`${API_BASE}/play/${song.file_id}`), {
-        headers: { 'X-Client-Id': CLIENT_ID }
-    })
-    .then(response => response.json())
+    resolvePlayback(song.file_id)
     .then(data => {
         if (data.success && data.url) {
             playAudioDirectWithAutoplay(data.url, song.display_name || 'Unknown');
@@ -3127,10 +3179,7 @@ function playSongFromFolder(index, fileId, displayName) {
     
     currentPlaylistIndex = index;
     
-    fetch(withClientId(`${API_BASE}/play/${fileId}`), {
-        headers: { 'X-Client-Id': CLIENT_ID }
-    })
-    .then(response => response.json())
+    resolvePlayback(fileId)
     .then(data => {
         if (data.success && data.url) {
             playAudioDirectWithAutoplay(data.url, displayName);
@@ -0,0 +1,48 @@
+import importlib
+import os
+import socket
+import sys
+from pathlib import Path
+
+import pytest
+
+# The app's modules live at the repository root, next to app.py
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bench_fakes import FakeSupabase  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture(scope='session')
+def fake():
+    server = FakeSupabase(port=free_port())
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(scope='session')
+def app(fake, tmp_path_factory):
+    # app.py configures itself from the environment and the working
+    # directory when it is imported
+    env = {'SUPABASE_URL': fake.url, 'SUPABASE_ANON_KEY': 'test', 'LOCAL_REPLICA': '0',
+           'CACHE_BACKEND': 'memory', 'JOB_CLAIM_RPC': '', 'JOB_QUEUE': '', 'JOB_RECOVERY': '',
+           'TRASH_PURGE_INTERVAL': '3600'}
+    saved_env = {k: os.environ.get(k) for k in env}
+    saved_cwd = os.getcwd()
+    os.environ.update(env)
+    os.chdir(tmp_path_factory.mktemp('app'))
+    try:
+        yield importlib.import_module('app')
+    finally:
+        os.chdir(saved_cwd)
+        for k, v in saved_env.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
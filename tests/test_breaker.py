@@ -0,0 +1,88 @@
+import pytest
+
+import breaker
+from breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(breaker.time, 'monotonic', lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def changes():
+    return []
+
+
+@pytest.fixture
+def circuit(clock, changes):
+    return CircuitBreaker('db', failure_threshold=3, reset_timeout=30,
+                          on_change=lambda b, state: changes.append(state))
+
+
+def test_opens_after_threshold_consecutive_failures(circuit, changes):
+    circuit.record_failure()
+    circuit.record_failure()
+    assert circuit.state == CLOSED and circuit.allow()
+    circuit.record_failure()
+    assert circuit.state == OPEN
+    assert not circuit.allow()
+    assert changes == [OPEN]
+
+
+def test_success_resets_failure_streak(circuit):
+    circuit.record_failure()
+    circuit.record_failure()
+    circuit.record_success()
+    circuit.record_failure()
+    circuit.record_failure()
+    assert circuit.state == CLOSED
+
+
+def test_half_open_lets_one_probe_through(circuit, clock, changes):
+    for _ in range(3):
+        circuit.record_failure()
+    clock[0] += 29
+    assert not circuit.allow()
+    assert circuit.retry_after() == pytest.approx(1)
+    clock[0] += 1
+    assert circuit.allow()
+    assert circuit.state == HALF_OPEN
+    assert not circuit.allow()  # probe still in flight
+    circuit.record_success()
+    assert circuit.state == CLOSED and circuit.allow()
+    assert changes == [OPEN, HALF_OPEN, CLOSED]
+
+
+def test_failed_probe_reopens_for_a_full_timeout(circuit, clock):
+    for _ in range(3):
+        circuit.record_failure()
+    clock[0] += 30
+    assert circuit.allow()
+    clock[0] += 5
+    circuit.record_failure()
+    assert circuit.state == OPEN
+    assert circuit.retry_after() == pytest.approx(30)
+    clock[0] += 29
+    assert not circuit.allow()
+
+
+def test_lost_probe_does_not_wedge_half_open(circuit, clock):
+    for _ in range(3):
+        circuit.record_failure()
+    clock[0] += 30
+    assert circuit.allow()
+    clock[0] += 10
+    assert not circuit.allow()
+    clock[0] += 20  # the probe never reported back
+    assert circuit.allow()
+
+
+def test_on_change_errors_are_ignored(clock):
+    def boom(b, state):
+        raise RuntimeError('listener failed')
+    circuit = CircuitBreaker('db', failure_threshold=1, on_change=boom)
+    circuit.record_failure()
+    assert circuit.snapshot() == {'state': OPEN, 'failures': 1, 'retry_after': 30.0}
@@ -0,0 +1,40 @@
+import pytest
+
+from cache import BaseCache, FileCache, MemoryCache
+
+
+def test_incomplete_backend_fails_on_construction():
+    class NoIncr(BaseCache):
+        def get(self, key):
+            return None
+
+        def set(self, key, value, ttl=None):
+            pass
+
+        def delete(self, key):
+            pass
+
+    with pytest.raises(TypeError):
+        NoIncr()
+
+
+@pytest.fixture(params=['memory', 'file'])
+def store(request, tmp_path):
+    return MemoryCache() if request.param == 'memory' else FileCache(tmp_path / 'cache.sqlite3')
+
+
+def test_bump_invalidates_namespace(store):
+    key = store.ns_key('library', 'files')
+    store.set(key, 'old')
+    store.bump('library')
+    assert store.get(store.ns_key('library', 'files')) is None
+    assert store.get(key) == 'old'
+
+
+def test_decoded_memo_is_bounded(store):
+    for i in range(store.DECODED_MAX * 2):
+        store.set_json(f'k{i}', {'i': i})
+        assert store.get_json(f'k{i}') == {'i': i}
+    assert len(store._decoded) == store.DECODED_MAX
+    store.set_json('k0', {'i': 'new'})
+    assert store.get_json('k0') == {'i': 'new'}
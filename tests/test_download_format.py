@@ -0,0 +1,54 @@
+import pytest
+
+
+def audio(format_id, abr, size, acodec='opus', protocol='https', **extra):
+    return {'format_id': format_id, 'abr': abr, 'filesize': size, 'acodec': acodec,
+            'vcodec': 'none', 'protocol': protocol, **extra}
+
+
+@pytest.fixture
+def pick(app):
+    return app.pick_download_format
+
+
+def test_lowest_sufficient_bitrate_wins(pick):
+    formats = [audio('139', 48, 1000), audio('250', 70, 2000), audio('251', 130, 4000)]
+    assert pick(formats, 64)['format_id'] == '250'
+
+
+def test_same_bitrate_prefers_the_non_drc_variant(pick):
+    formats = [audio('251-drc', 130, 3900), audio('251', 130, 4000)]
+    assert pick(formats, 128)['format_id'] == '251'
+    assert pick(list(reversed(formats)), 128)['format_id'] == '251'
+
+
+def test_same_bitrate_prefers_plain_https(pick):
+    formats = [audio('251-dash', 130, 3900, protocol='http_dash_segments'), audio('251', 130, 4000)]
+    assert pick(formats, 128)['format_id'] == '251'
+
+
+def test_same_bitrate_same_protocol_prefers_the_smaller(pick):
+    formats = [audio('a', 130, 4000), audio('b', 130, 3900)]
+    assert pick(formats, 128)['format_id'] == 'b'
+
+
+def test_below_target_takes_the_best_non_drc(pick):
+    formats = [audio('139', 48, 1000), audio('250-drc', 70, 1900), audio('250', 70, 2000)]
+    assert pick(formats, 128)['format_id'] == '250'
+
+
+def test_drm_and_video_only_formats_are_skipped(pick):
+    formats = [audio('251', 130, 4000, has_drm=True), audio('140', 129, 5000, acodec='mp4a.40.2'),
+               {'format_id': '137', 'acodec': 'none', 'vcodec': 'avc1', 'filesize': 10}]
+    assert pick(formats, 128)['format_id'] == '140'
+
+
+def test_muxed_formats_only_when_there_is_no_audio_only_stream(pick):
+    formats = [{'format_id': '18', 'acodec': 'mp4a.40.2', 'vcodec': 'avc1', 'filesize': 9000, 'tbr': 500},
+               {'format_id': '22', 'acodec': 'mp4a.40.2', 'vcodec': 'avc1', 'filesize': 20000, 'tbr': 1200}]
+    assert pick(formats, 128)['format_id'] == '18'
+
+
+def test_preferred_codec_wins_over_a_smaller_one(pick):
+    formats = [audio('251', 130, 4000), audio('140', 129, 5000, acodec='mp4a.40.2')]
+    assert pick(formats, 128, codecs=['aac'])['format_id'] == '140'
@@ -0,0 +1,81 @@
+import os
+import shutil
+
+from fsindex import DirectoryIndex
+
+
+def names(entries):
+    return [e.path.name for e in entries]
+
+
+def test_listing_is_reused_until_invalidated(tmp_path):
+    (tmp_path / 'a.mp3').write_bytes(b'x')
+    index = DirectoryIndex(tmp_path, revalidate=3600)
+    assert names(index.files(tmp_path)) == ['a.mp3']
+    (tmp_path / 'b.mp3').write_bytes(b'xy')
+    assert names(index.files(tmp_path)) == ['a.mp3']
+    assert index.scans == 1
+    index.invalidate(tmp_path)
+    assert names(index.files(tmp_path)) == ['a.mp3', 'b.mp3']
+    assert index.scans == 2
+
+
+def test_invalidating_a_file_drops_its_directory(tmp_path):
+    folder = tmp_path / 'rock'
+    folder.mkdir()
+    index = DirectoryIndex(tmp_path, revalidate=3600)
+    assert index.files(folder) == []
+    song = folder / 'song.mp3'
+    song.write_bytes(b'abc')
+    index.invalidate(song)
+    [entry] = index.files(folder)
+    assert entry.path == song and entry.size == 3
+
+
+def test_invalidating_a_directory_drops_its_parent(tmp_path):
+    index = DirectoryIndex(tmp_path, revalidate=3600)
+    assert index.subdirs(tmp_path) == []
+    (tmp_path / 'jazz').mkdir()
+    index.invalidate(tmp_path / 'jazz')
+    assert index.subdirs(tmp_path) == [tmp_path / 'jazz']
+
+
+def test_invalidate_everything(tmp_path):
+    (tmp_path / 'pop').mkdir()
+    index = DirectoryIndex(tmp_path, revalidate=3600)
+    assert index.files_recursive(tmp_path) == []
+    (tmp_path / 'pop' / 'x.mp3').write_bytes(b'x')
+    (tmp_path / 'y.mp3').write_bytes(b'y')
+    index.invalidate()
+    assert sorted(names(index.files_recursive(tmp_path, '.mp3'))) == ['x.mp3', 'y.mp3']
+
+
+def test_changes_by_other_processes_show_up_after_revalidate(tmp_path):
+    index = DirectoryIndex(tmp_path, revalidate=0)
+    assert index.files(tmp_path) == []
+    (tmp_path / 'a.mp3').write_bytes(b'x')
+    assert names(index.files(tmp_path)) == ['a.mp3']
+    scans = index.scans
+    assert names(index.files(tmp_path)) == ['a.mp3']
+    assert index.scans == scans  # unchanged mtime: no rescan
+
+
+def test_unchanged_mtime_keeps_the_listing(tmp_path):
+    (tmp_path / 'a.mp3').write_bytes(b'x')
+    index = DirectoryIndex(tmp_path, revalidate=0)
+    index.files(tmp_path)
+    st = os.stat(tmp_path)
+    (tmp_path / 'b.mp3').write_bytes(b'x')
+    os.utime(tmp_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert names(index.files(tmp_path)) == ['a.mp3']
+
+
+def test_removed_directory_lists_as_empty(tmp_path):
+    folder = tmp_path / 'gone'
+    folder.mkdir()
+    (folder / 'a.mp3').write_bytes(b'x')
+    index = DirectoryIndex(tmp_path, revalidate=0)
+    assert names(index.files(folder)) == ['a.mp3']
+    shutil.rmtree(folder)
+    assert index.files(folder) == []
+    assert index.subdirs(folder) == []
@@ -0,0 +1,97 @@
+import pytest
+
+import governor
+from cache import MemoryCache
+from governor import HostLimits, Throttled, UpstreamGovernor
+
+HOST = 'www.youtube.com'
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(governor.time, 'monotonic', lambda: now[0])
+    return now
+
+
+@pytest.fixture(autouse=True)
+def no_jitter(monkeypatch):
+    # Always take the top of the jitter range so backoffs are predictable
+    monkeypatch.setattr(governor.random, 'uniform', lambda low, high: high)
+
+
+def test_burst_then_rate(clock):
+    gov = UpstreamGovernor({HOST: HostLimits(concurrency=10, rate=2.0, burst=3)})
+    for _ in range(3):
+        gov.acquire(HOST, max_wait=0)
+        gov.release(HOST)
+    with pytest.raises(Throttled) as exc:
+        gov.acquire(HOST, max_wait=0)
+    assert exc.value.retry_after == pytest.approx(0.5)
+    clock[0] += 0.5
+    gov.acquire(HOST, max_wait=0)
+    gov.release(HOST)
+
+
+def test_bucket_refills_up_to_burst(clock):
+    gov = UpstreamGovernor({HOST: HostLimits(concurrency=10, rate=1.0, burst=2)})
+    gov.acquire(HOST)
+    gov.release(HOST)
+    clock[0] += 60
+    assert gov.snapshot()[HOST]['tokens'] == 2
+
+
+def test_concurrency_cap():
+    gov = UpstreamGovernor({HOST: HostLimits(concurrency=1, rate=100.0, burst=10)})
+    with gov.slot(HOST):
+        assert gov.snapshot()[HOST]['in_flight'] == 1
+        with pytest.raises(Throttled):
+            gov.acquire(HOST, max_wait=0.05)
+    with gov.slot(HOST, max_wait=0):
+        pass
+    assert gov.snapshot()[HOST]['in_flight'] == 0
+
+
+def test_other_hosts_use_the_default_limits():
+    gov = UpstreamGovernor({HOST: HostLimits(1, 1.0, 1)}, default=HostLimits(2, 1.0, 5))
+    with gov.slot('i.ytimg.com'), gov.slot('i.ytimg.com'):
+        with pytest.raises(Throttled):
+            gov.acquire('i.ytimg.com', max_wait=0.05)
+
+
+def test_backoff_doubles_up_to_the_cap(clock):
+    gov = UpstreamGovernor(backoff_base=30, backoff_max=100)
+    assert [gov.throttled(HOST) for _ in range(4)] == [30, 60, 100, 100]
+
+
+def test_backoff_blocks_until_it_ends(clock):
+    gov = UpstreamGovernor(backoff_base=30)
+    gov.throttled(HOST)
+    assert gov.backoff_remaining(HOST) == pytest.approx(30)
+    with pytest.raises(Throttled) as exc:
+        gov.acquire(HOST, max_wait=10)
+    assert exc.value.retry_after == pytest.approx(30)
+    clock[0] += 30
+    gov.acquire(HOST, max_wait=0)  # the backoff also emptied the bucket; it has refilled
+    gov.release(HOST)
+
+
+def test_success_resets_the_streak(clock):
+    gov = UpstreamGovernor(backoff_base=30)
+    gov.throttled(HOST)
+    gov.throttled(HOST)
+    gov.succeeded(HOST)
+    clock[0] += 1000
+    assert gov.throttled(HOST) == 30
+
+
+def test_backoff_is_shared_between_processes():
+    store = MemoryCache()
+    first = UpstreamGovernor(backoff_base=30, shared=store)
+    second = UpstreamGovernor(backoff_base=30, shared=store)
+    first.throttled(HOST)
+    assert second.backoff_remaining(HOST) > 25
+    with pytest.raises(Throttled):
+        second.acquire(HOST, max_wait=0)
+    # A later throttle on the second one continues the streak
+    assert second.throttled(HOST) == 60
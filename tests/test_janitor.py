@@ -0,0 +1,97 @@
+import os
+import time
+import uuid
+
+import pytest
+
+from janitor import Janitor
+
+GRACE = 600
+
+
+@pytest.fixture
+def root(tmp_path):
+    (tmp_path / 'owner').mkdir()
+    (tmp_path / '.thumbcache').mkdir()
+    return tmp_path
+
+
+@pytest.fixture
+def janitor(root):
+    return Janitor(root, cache_dirs=[root / '.thumbcache'], grace=GRACE)
+
+
+def artifact(directory, name, age):
+    path = directory / name
+    path.write_bytes(b'x' * 10)
+    then = time.time() - age
+    os.utime(path, (then, then))
+    return path
+
+
+def test_old_artifacts_of_inactive_jobs_are_removed(root, janitor):
+    file_id = str(uuid.uuid4())
+    part = artifact(root / 'owner', f'{file_id}.webm.part', GRACE + 60)
+    assert janitor.sweep_orphans(active_ids=set()) == (1, 10)
+    assert not part.exists()
+
+
+def test_grace_period_protects_new_files(root, janitor):
+    fresh = artifact(root / 'owner', f'{uuid.uuid4()}.webm', GRACE - 60)
+    assert janitor.sweep_orphans(active_ids=set()) == (0, 0)
+    assert fresh.exists()
+
+
+def test_active_jobs_are_kept_however_old(root, janitor):
+    file_id = str(uuid.uuid4())
+    files = [artifact(root / 'owner', f'{file_id}{suffix}', 24 * 3600)
+             for suffix in ('.m4a', '.json', '.ts', '.m3u8')]
+    assert janitor.sweep_orphans(active_ids={file_id}) == (0, 0)
+    assert all(f.exists() for f in files)
+
+
+def test_unknown_active_set_only_removes_very_old_files(root, janitor):
+    day_old = artifact(root / 'owner', f'{uuid.uuid4()}.part', 24 * 3600)
+    hour_old = artifact(root / 'owner', f'{uuid.uuid4()}.part', 3600)
+    assert janitor.sweep_orphans(active_ids=None, max_age=6 * 3600) == (1, 10)
+    assert not day_old.exists() and hour_old.exists()
+
+
+def test_only_job_artifacts_under_user_folders_are_touched(root, janitor):
+    file_id = str(uuid.uuid4())
+    kept = [
+        artifact(root / 'owner', f'{file_id}.mp3', 24 * 3600),          # finished song
+        artifact(root / 'owner', 'notes.json', 24 * 3600),              # not a job file
+        artifact(root, f'{file_id}.part', 24 * 3600),                   # root level
+        artifact(root / '.thumbcache', f'{file_id}.json', 24 * 3600),   # cache dir
+    ]
+    assert janitor.sweep_orphans(active_ids=set()) == (0, 0)
+    assert all(f.exists() for f in kept)
+
+
+def shared_janitor(root, monkeypatch, ttl=300):
+    janitor = Janitor(root, reservations=root / '.reservations.sqlite3', reservation_ttl=ttl)
+    monkeypatch.setattr(janitor, 'free_bytes', lambda: 1000)
+    return janitor
+
+
+def test_processes_sharing_a_disk_cannot_over_commit_it(root, monkeypatch):
+    first, second = shared_janitor(root, monkeypatch), shared_janitor(root, monkeypatch)
+    assert first.admit('a', 600)
+    assert not second.admit('b', 600)
+    assert second.reserved_ids() == {'a'}
+    assert second.available_bytes() == 400
+    assert first.available_bytes('a') == 1000
+    first.release('a')
+    assert second.admit('b', 600)
+
+
+def test_reservations_of_a_dead_process_expire(root, monkeypatch):
+    dead, alive = shared_janitor(root, monkeypatch, ttl=0.2), shared_janitor(root, monkeypatch, ttl=0.2)
+    assert dead.admit('a', 600)
+    assert alive.admit('b', 300)
+    time.sleep(0.15)
+    alive.refresh()
+    time.sleep(0.1)
+    assert alive.reserved_ids() == {'b'}
+    assert alive.admit('c', 600)
@@ -0,0 +1,106 @@
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+from breaker import CircuitBreaker
+
+WORKERS = 16
+
+
+def seed(fake, rows):
+    with fake.lock:
+        fake.tables['conversions'] = rows
+        fake._response_cache.clear()
+
+
+def conversion(i, **fields):
+    now = datetime.utcnow()
+    row = {
+        'id': i + 1,
+        'file_id': str(uuid.uuid4()),
+        'client_id': 'owner',
+        'status': 'queued',
+        'url': f'https://www.youtube.com/watch?v=test{i:07d}',
+        'bitrate': '64',
+        'created_at': (now - timedelta(minutes=60 - i)).isoformat(),
+        'started_at': now.isoformat(),
+        'worker_id': None,
+        'lease_expires_at': None,
+        'attempts': 0,
+    }
+    row.update(fields)
+    return row
+
+
+def race(app, workers=WORKERS):
+    """Call claim_job_patch from `workers` threads at once"""
+    barrier = threading.Barrier(workers)
+    claims = [None] * workers
+
+    def claim(i):
+        barrier.wait()
+        claims[i] = app.claim_job_patch(f'host:{i}')
+
+    threads = [threading.Thread(target=claim, args=(i,)) for i in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(30)
+    return [c for c in claims if c]
+
+
+def test_each_queued_row_is_claimed_once(app, fake):
+    rows = [conversion(i) for i in range(5)]
+    seed(fake, rows)
+    claims = race(app)
+    assert sorted(c['file_id'] for c in claims) == sorted(r['file_id'] for r in rows)
+    assert len({c['worker_id'] for c in claims}) == len(rows)
+    for row in fake.tables['conversions']:
+        assert row['status'] == 'downloading'
+        assert row['attempts'] == 1
+        assert row['lease_expires_at'] > datetime.utcnow().isoformat()
+
+
+def test_expired_lease_is_taken_over_once(app, fake):
+    expired = (datetime.utcnow() - timedelta(minutes=5)).isoformat()
+    row = conversion(0, status='converting', worker_id='dead-host:1', lease_expires_at=expired, attempts=1)
+    live = conversion(1, status='converting', worker_id='live-host:1',
+                      lease_expires_at=(datetime.utcnow() + timedelta(minutes=5)).isoformat(), attempts=1)
+    seed(fake, [row, live])
+    claims = race(app)
+    assert [c['file_id'] for c in claims] == [row['file_id']]
+    taken = next(r for r in fake.tables['conversions'] if r['file_id'] == row['file_id'])
+    assert taken['worker_id'] == claims[0]['worker_id'] != 'dead-host:1'
+    assert taken['attempts'] == 2
+    kept = next(r for r in fake.tables['conversions'] if r['file_id'] == live['file_id'])
+    assert kept['worker_id'] == 'live-host:1'
+
+
+def test_empty_queue_claims_nothing(app, fake):
+    seed(fake, [conversion(0, status='completed')])
+    assert race(app, workers=4) == []
+
+
+@pytest.fixture
+def claim_rpc(app, monkeypatch):
+    monkeypatch.setattr(app, 'JOB_CLAIM_RPC', 'claim_conversion')
+    monkeypatch.setitem(app._claim_rpc_state, 'failed_at', 0.0)
+    return app._claim_rpc_state
+
+
+def test_missing_claim_rpc_falls_back_to_patch(app, fake, claim_rpc):
+    row = conversion(0)
+    seed(fake, [row])
+    assert app.claim_job('host:1')['file_id'] == row['file_id']  # the fake answers rpc/ with 404
+    assert claim_rpc['failed_at'] > 0
+
+
+def test_outage_does_not_switch_off_the_claim_rpc(app, fake, claim_rpc, monkeypatch):
+    circuit = CircuitBreaker('supabase_db', failure_threshold=1, reset_timeout=3600)
+    circuit.record_failure()
+    monkeypatch.setattr(app, 'db_circuit', circuit)
+    seed(fake, [conversion(0)])
+    assert app.claim_job('host:1') is None
+    assert claim_rpc['failed_at'] == 0.0
@@ -0,0 +1,42 @@
+import uuid
+from collections import OrderedDict
+
+import pytest
+
+from breaker import CircuitBreaker
+
+
+@pytest.fixture
+def song(app, fake):
+    row = {'id': 1, 'file_id': str(uuid.uuid4()), 'client_id': 'owner', 'status': 'completed',
+           'title': 'Song', 'created_at': '2024-01-01T00:00:00'}
+    with fake.lock:
+        fake.tables['conversions'] = [row]
+        fake._response_cache.clear()
+    return row
+
+
+def test_single_song_reads_keep_no_copies(app, song):
+    assert app.get_from_db(song['file_id'])['title'] == 'Song'
+    assert app.shared_cache.get_json(f"last_good:conversions?file_id=eq.{song['file_id']}") is None
+    assert not any('file_id' in endpoint for endpoint in app._last_good_saved)
+
+
+def test_outage_serves_a_song_from_the_library_copy(app, song, monkeypatch):
+    monkeypatch.setattr(app, 'LAST_GOOD_REFRESH_SECONDS', 0)
+    assert app.get_all_conversions()
+    app.shared_cache.delete(f"song:{song['file_id']}")
+    monkeypatch.setattr(app, 'db_circuit', CircuitBreaker('supabase_db', failure_threshold=1, reset_timeout=3600))
+    app.db_circuit.record_failure()
+    with app.app.test_request_context():
+        assert app.get_from_db(song['file_id'])['title'] == 'Song'
+        assert app.served_stale()
+        assert app.get_from_db(str(uuid.uuid4())) is None
+
+
+def test_saved_queries_are_capped(app, monkeypatch):
+    monkeypatch.setattr(app, 'LAST_GOOD_MAX_QUERIES', 3)
+    monkeypatch.setattr(app, '_last_good_saved', OrderedDict())
+    for i in range(10):
+        app.remember_good(f'conversions?folder=eq.f{i}', [])
+    assert list(app._last_good_saved) == [f'conversions?folder=eq.f{i}' for i in (7, 8, 9)]
@@ -0,0 +1,112 @@
+import os
+import threading
+import time
+
+import pytest
+
+RACERS = 20
+
+
+@pytest.fixture
+def owner_file(app, tmp_path, monkeypatch):
+    path = tmp_path / 'owner_id.txt'
+    monkeypatch.setattr(app, 'OWNER_FILE', path)
+    monkeypatch.setattr(app, '_owner_cache', {'stat': None, 'owner_id': None})
+    return path
+
+
+def refuse_link(src, dst, *args, **kwargs):
+    raise PermissionError(1, 'Operation not permitted')
+
+
+@pytest.fixture
+def no_hard_links(monkeypatch):
+    monkeypatch.setattr(os, 'link', refuse_link)
+
+
+def race(app):
+    barrier = threading.Barrier(RACERS)
+    results = [None] * RACERS
+
+    def claim(i):
+        barrier.wait()
+        results[i] = app.claim_owner(f'client{i}')
+
+    threads = [threading.Thread(target=claim, args=(i,)) for i in range(RACERS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(10)
+    return results
+
+
+def age(path, seconds):
+    then = time.time() - seconds
+    os.utime(path, (then, then))
+
+
+def leftovers(owner_file):
+    return sorted(p.name for p in owner_file.parent.iterdir() if p != owner_file)
+
+
+def test_one_racer_wins(app, owner_file):
+    results = race(app)
+    winner = owner_file.read_text()
+    assert winner.startswith('client')
+    assert set(results) == {winner}
+    assert leftovers(owner_file) == []
+
+
+def test_one_racer_wins_without_hard_links(app, owner_file, no_hard_links):
+    results = race(app)
+    winner = owner_file.read_text()
+    assert set(results) - {None} == {winner}
+    assert winner in results
+    assert leftovers(owner_file) == []
+
+
+def test_existing_owner_is_kept(app, owner_file):
+    owner_file.write_text('alice')
+    assert app.claim_owner('bob') == 'alice'
+    assert not app.is_owner('bob')
+
+
+def test_fresh_blank_owner_file_is_left_alone(app, owner_file):
+    owner_file.write_text('')
+    assert not app.claim_owner('bob')
+    assert owner_file.read_text() == ''
+
+
+@pytest.mark.parametrize('links', [True, False])
+def test_stale_blank_owner_file_is_claimed_once(app, owner_file, monkeypatch, links):
+    if not links:
+        monkeypatch.setattr(os, 'link', refuse_link)
+    owner_file.write_text('\n')
+    age(owner_file, app.OWNER_CLAIM_GRACE + 5)
+    results = race(app)
+    winner = owner_file.read_text()
+    assert winner.startswith('client')
+    assert set(results) - {None} == {winner}
+
+
+def test_owner_installed_after_the_check_is_not_replaced(app, owner_file):
+    owner_file.write_text('')
+    age(owner_file, app.OWNER_CLAIM_GRACE + 5)
+    blank = app._blank_owner_stat()
+    assert blank is not None
+    # Another claimer takes over the blank file before we get the lock
+    replacement = owner_file.with_name('other.tmp')
+    replacement.write_text('alice')
+    os.replace(replacement, owner_file)
+    tmp = app._write_owner_tmp('bob')
+    assert not app._install_owner_locked(tmp, blank)
+    assert owner_file.read_text() == 'alice'
+
+
+def test_stale_lock_is_cleared_but_a_live_one_blocks(app, owner_file, no_hard_links):
+    lock = owner_file.with_name('owner_id.txt.lock')
+    lock.write_text('')
+    assert app.claim_owner('bob') is None
+    age(lock, app.OWNER_CLAIM_GRACE + 5)
+    assert app.claim_owner('bob') == 'bob'
+    assert leftovers(owner_file) == []
@@ -0,0 +1,34 @@
+import pytest
+
+from replica import _within_one_edit
+
+
+@pytest.mark.parametrize('a, b', [
+    ('queen', 'queen'),
+    ('queen', 'quen'),       # deletion
+    ('queen', 'queeen'),     # insertion
+    ('queen', 'qeuen'),      # adjacent swap
+    ('queen', 'queem'),      # substitution, last character
+    ('queen', 'aueen'),      # substitution, first character
+    ('queen', 'ueen'),       # deletion, first character
+    ('queen', 'queenn'),     # insertion at the end
+    ('ab', 'ba'),
+    ('', 'a'),
+])
+def test_one_edit_apart(a, b):
+    assert _within_one_edit(a, b)
+    assert _within_one_edit(b, a)
+
+
+@pytest.mark.parametrize('a, b', [
+    ('queen', 'qen'),        # two deletions
+    ('queen', 'quuun'),      # two substitutions
+    ('queen', 'qnuee'),      # swap of non-adjacent characters
+    ('queen', 'eueqn'),
+    ('abc', 'cab'),          # rotation
+    ('queen', 'queen!!'),
+    ('', 'ab'),
+])
+def test_more_than_one_edit_apart(a, b):
+    assert not _within_one_edit(a, b)
+    assert not _within_one_edit(b, a)
@@ -0,0 +1,83 @@
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def waiting(app, fake, tmp_path, monkeypatch):
+    """A local job that was re-queued by YouTube throttling an hour ago"""
+    monkeypatch.setattr(app, 'JOB_HEARTBEAT_SECONDS', 0.05)
+    monkeypatch.setattr(app, 'JOB_POLL_SECONDS', 0.01)
+    monkeypatch.setattr(app.janitor, 'admit', lambda file_id, expected: True)
+    backoff = {'seconds': 60.0}
+    monkeypatch.setattr(app.upstream, 'backoff_remaining', lambda host: backoff['seconds'])
+    monkeypatch.setattr(app, 'job_download_dir', lambda client_id, folder=None: tmp_path)
+    hour_ago = (datetime.utcnow() - timedelta(hours=1)).isoformat()
+    row = {'id': 1, 'file_id': str(uuid.uuid4()), 'client_id': 'owner', 'status': 'queued',
+           'url': 'https://www.youtube.com/watch?v=test', 'bitrate': '64',
+           'created_at': hour_ago, 'started_at': hour_ago}
+    with fake.lock:
+        fake.tables['conversions'] = [row]
+        fake._response_cache.clear()
+    (tmp_path / f"{row['file_id']}.webm.part").write_bytes(b'partial')
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(
+        held=app.hold_requeued_job(row['file_id'], 'owner')))
+    thread.start()
+    deadline = time.time() + 5
+    while row['started_at'] == hour_ago and time.time() < deadline:
+        time.sleep(0.01)
+    yield row, backoff, thread, result
+    backoff['seconds'] = 0
+    thread.join(5)
+
+
+def finish(thread, result):
+    thread.join(5)
+    assert not thread.is_alive()
+    return result['held']
+
+
+def files_left(tmp_path):
+    return [p.name for p in tmp_path.iterdir()]
+
+
+def test_waiting_job_is_not_swept(app, waiting):
+    row, backoff, thread, result = waiting
+    assert row['started_at'] > (datetime.utcnow() - timedelta(minutes=1)).isoformat()
+    assert app.jobs.get(row['file_id']) is not None
+    assert app.resume_stuck_jobs() == 0
+    backoff['seconds'] = 0
+    assert finish(thread, result) is True
+    assert row['status'] == 'queued'
+
+
+def test_row_taken_by_another_process_is_left_to_it(app, fake, waiting, tmp_path):
+    row, backoff, thread, result = waiting
+    with fake.lock:
+        row['started_at'] = datetime.utcnow().isoformat()  # another sweep's claim
+        fake._response_cache.clear()
+    assert finish(thread, result) is False
+    assert files_left(tmp_path)
+
+
+def test_reaped_row_is_not_retried(app, fake, waiting, tmp_path):
+    row, backoff, thread, result = waiting
+    with fake.lock:
+        row['status'] = 'error'
+        fake._response_cache.clear()
+    backoff['seconds'] = 0
+    assert finish(thread, result) is False
+    assert row['status'] == 'error'
+    assert files_left(tmp_path) == []
+
+
+def test_cancel_stops_the_wait(app, waiting, tmp_path):
+    row, backoff, thread, result = waiting
+    assert app.cancel_jobs([row['file_id']]) == [row['file_id']]
+    assert finish(thread, result) is False
+    assert app.jobs.get(row['file_id']) is None
+    assert files_left(tmp_path) == []
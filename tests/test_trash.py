@@ -0,0 +1,72 @@
+import uuid
+from datetime import datetime
+
+import pytest
+
+from breaker import CircuitBreaker
+
+
+@pytest.fixture
+def deleting(app, fake, monkeypatch):
+    monkeypatch.setattr(app, 'storage_circuit', CircuitBreaker('supabase_storage', failure_threshold=3))
+    monkeypatch.setattr(app, 'TRASH_BATCH_SIZE', 5)
+    rows = [{'id': i + 1, 'file_id': str(uuid.uuid4()), 'client_id': 'owner', 'status': 'deleting',
+             'folder': None, 'file_path': f'owner/{i}.mp3', 'created_at': f'2024-01-01T00:{i:02d}:00'}
+            for i in range(8)]
+    with fake.lock:
+        fake.tables['conversions'] = rows
+        fake._response_cache.clear()
+    return rows
+
+
+def statuses(fake):
+    return sorted(r['status'] for r in fake.tables['conversions'])
+
+
+def failing_for(monkeypatch, app, bad):
+    real = app.delete_from_storage
+    monkeypatch.setattr(app, 'delete_from_storage',
+                        lambda path: path not in bad and real(path))
+
+
+def test_failed_song_backs_off_without_blocking_the_queue(app, fake, deleting, monkeypatch):
+    first = deleting[0]
+    failing_for(monkeypatch, app, {first['file_path']})
+    assert app.purge_trash() == 5
+    assert first['error_time'] > datetime.utcnow().isoformat()
+    assert first['file_id'] not in [r['file_id'] for r in app.due_trash_rows()]
+    assert app.purge_trash() == 3
+    assert [r['file_id'] for r in fake.tables['conversions']] == [first['file_id']]
+
+
+def test_gives_up_after_max_attempts(app, fake, deleting, monkeypatch):
+    failing_for(monkeypatch, app, {r['file_path'] for r in deleting})
+    for _ in range(app.TRASH_MAX_ATTEMPTS):
+        with fake.lock:
+            for row in fake.tables['conversions']:
+                if row['status'] == 'deleting':
+                    row['error_time'] = None  # due again
+            fake._response_cache.clear()
+        app.purge_trash()
+        app.purge_trash()
+    assert statuses(fake) == ['error'] * 8
+    assert all('delete it again' in r['message'] for r in fake.tables['conversions'])
+
+
+def test_storage_outage_counts_no_attempts(app, fake, deleting):
+    for _ in range(3):
+        app.storage_circuit.record_failure()
+    assert app.purge_trash() == 0
+    assert statuses(fake) == ['deleting'] * 8
+    assert not any(r.get('error_time') for r in deleting)
+
+
+def test_outage_during_a_pass_stops_it(app, fake, deleting, monkeypatch):
+    def down(path):
+        app.storage_circuit.record_failure()
+        return False
+    monkeypatch.setattr(app, 'delete_from_storage', down)
+    assert app.purge_trash() < 5
+    assert statuses(fake) == ['deleting'] * 8
+    failed = [r for r in deleting if r.get('error_time')]
+    assert len(failed) <= 2  # failures before the circuit opened are real attempts
@@ -0,0 +1,57 @@
+"""Standalone conversion worker: drains queued rows from `conversions`.
+
+    JOB_QUEUE=1 python worker.py --concurrency 2
+
+Run it next to the web app (started with JOB_QUEUE=1, so /api/convert only
+enqueues) on as many machines as needed. Each slot claims one job at a time
+through app.claim_job(), holds a lease on it with heartbeats, and runs the
+same pipeline the web process runs inline. On SIGTERM/SIGINT the worker stops
+claiming and exits once its running jobs finish; if it is killed instead, the
+leases of its jobs expire and another worker takes them over.
+"""
+import argparse
+import logging
+import os
+import signal
+import threading
+
+import app
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int, default=int(os.environ.get('WORKER_CONCURRENCY', '1')),
+                        help='jobs to run at once (WORKER_CONCURRENCY, default 1)')
+    parser.add_argument('--worker-id', default=app.WORKER_ID,
+                        help='prefix for the worker_id written to claimed rows (default host:pid)')
+    args = parser.parse_args()
+    if not app.JOB_QUEUE:
+        # Without it the web app runs jobs itself and would race the workers
+        parser.error('JOB_QUEUE=1 must be set, for this worker and for the web app')
+
+    stop = threading.Event()
+
+    def shutdown(signum, frame):
+        logger.info(f"🛑 Signal {signum}: finishing running jobs, not claiming new ones")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    slots = [
+        threading.Thread(target=app.queue_worker, args=(f"{args.worker_id}:{i}", stop), name=f'worker-{i}')
+        for i in range(max(1, args.concurrency))
+    ]
+    for slot in slots:
+        slot.start()
+    logger.info(f"👷 Worker {args.worker_id} draining the queue with {len(slots)} slot(s)")
+    # Joining with a timeout keeps the main thread responsive to signals
+    while any(slot.is_alive() for slot in slots):
+        for slot in slots:
+            slot.join(timeout=1)
+
+
+if __name__ == '__main__':
+    main()